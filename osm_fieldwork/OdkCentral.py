@@ -30,6 +30,7 @@
 # NOTE as pyodk does not support async workflows.
 
 import concurrent.futures
+import csv
 import json
 import logging
 import os
@@ -37,17 +38,23 @@ import sys
 import zlib
 from base64 import b64encode
 from datetime import datetime
-from io import BytesIO
+from functools import lru_cache
+from io import BytesIO, TextIOWrapper
 from pathlib import Path
-from typing import Optional, Union
+from tempfile import SpooledTemporaryFile
+from typing import IO, Iterator, Optional, Union
 from uuid import uuid4
 from xml.etree import ElementTree
+from zipfile import ZipFile
 
 import requests
 import segno
 from codetiming import Timer
 from cpuinfo import get_cpu_info
 
+from osm_fieldwork.odata import ODataQuery
+from osm_fieldwork.transport import MeteredSession, RequestMetrics, ResponseCache, RetryAdapter, RetryPolicy
+
 # Instantiate logger
 log_level = os.getenv("LOG_LEVEL", default="INFO")
 # Set log level for urllib
@@ -56,13 +63,113 @@ logging.getLogger("urllib3").setLevel(log_level)
 log = logging.getLogger(__name__)
 
 
-def downloadThread(project_id: int, xforms: list, odk_credentials: dict, filters: dict = None):
+@lru_cache(maxsize=16)
+def getMediaFilenames(xml: Union[str, bytes]) -> tuple[str, ...]:
+    """Get the names of the media files an XForm expects to be attached.
+
+    The result is cached, so an XForm is only parsed once.
+
+    Args:
+        xml (str, bytes): The XForm XML.
+
+    Returns:
+        (tuple): The filenames, from the src of each external file instance.
+    """
+    namespaces = {
+        "h": "http://www.w3.org/1999/xhtml",
+        "odk": "http://www.opendatakit.org/xforms",
+        "xforms": "http://www.w3.org/2002/xforms",
+    }
+
+    root = ElementTree.fromstring(xml)
+    instances = root.findall(".//xforms:model/xforms:instance[@src]", namespaces)
+
+    filenames = []
+    for inst in instances:
+        src_value = inst.attrib.get("src", "")
+        # Skip other instances, such as jr://instance/last-saved
+        for prefix in ("jr://file/", "jr://file-csv/"):
+            if src_value.startswith(prefix):
+                filenames.append(src_value[len(prefix) :])
+    return tuple(filenames)
+
+
+def getQRSettings(
+    base: str,
+    odk_id: int,
+    project_name: str,
+    appuser_token: str,
+    basemap: str = "osm",
+    osm_username: str = "svchotosm",
+    upstream_task_id: str = "",
+) -> dict:
+    """Get the ODK Collect settings for an app-user, as encoded in the QR code.
+
+    Args:
+        base (str): The base URL of the ODK Central REST API.
+        odk_id (int): The ID of the project on ODK Central
+        project_name (str): The name of the project to set
+        appuser_token (str): The user's token
+        basemap (str): Default basemap to use on Collect.
+        osm_username (str): The OSM username to attribute to the mapping.
+        upstream_task_id (str): A task id from an upstream application.
+
+    Returns:
+        (dict): The ODK Collect settings.
+    """
+    return {
+        "general": {
+            "server_url": f"{base}key/{appuser_token}/projects/{odk_id}",
+            "form_update_mode": "manual",
+            "basemap_source": basemap,
+            "autosend": "wifi_and_cellular",
+            "metadata_username": osm_username,
+            "metadata_email": upstream_task_id,
+        },
+        "project": {"name": f"{project_name}"},
+        "admin": {},
+    }
+
+
+def makeQRCode(settings: dict) -> segno.QRCode:
+    """Make the QR code for ODK Collect settings.
+
+    Args:
+        settings (dict): The settings from getQRSettings.
+
+    Returns:
+        (segno.QRCode): The QR code object.
+    """
+    # Base64 encode JSON params for QR code
+    qr_data = b64encode(zlib.compress(json.dumps(settings).encode("utf-8")))
+    return segno.make(qr_data, micro=False)
+
+
+def renderQRCode(settings: dict, scale: int = 5) -> bytes:
+    """Render the QR code for ODK Collect settings as a PNG image.
+
+    This is a module level function, so it can be run in a process pool.
+
+    Args:
+        settings (dict): The settings from getQRSettings.
+        scale (int): The size of each module of the QR code, in pixels.
+
+    Returns:
+        (bytes): The PNG image.
+    """
+    image = BytesIO()
+    makeQRCode(settings).save(image, kind="png", scale=scale)
+    return image.getvalue()
+
+
+def downloadThread(project_id: int, xforms: list, odk_credentials: dict, filters: Optional[dict | ODataQuery] = None):
     """Download a list of submissions from ODK Central.
 
     Args:
         project_id (int): The ID of the project on ODK Central
         xforms (list): A list of the XForms to down the submissions from
         odk_credentials (dict): The authentication credentials for ODK Collect
+        filters (dict, ODataQuery): The OData query for the submissions
 
     Returns:
         (list): The submissions in JSON format
@@ -86,7 +193,115 @@ def downloadThread(project_id: int, xforms: list, odk_credentials: dict, filters
     return data
 
 
+class SubmissionArchive(object):
+    """A submissions.csv.zip export from ODK Central, spooled to a temporary file.
+
+    The CSV files and media files in the archive are only read when
+    iterated, so large exports can be processed in constant memory.
+    """
+
+    def __init__(
+        self,
+        spool: IO[bytes],
+        xform: str,
+    ):
+        """Wrap a spooled export.
+
+        Args:
+            spool (IO[bytes]): The file object containing the ZIP data.
+            xform (str): The XForm the submissions are for.
+
+        Returns:
+            (SubmissionArchive): An instance of this object
+        """
+        self.spool = spool
+        self.xform = xform
+        self.zip = ZipFile(spool)
+
+    def __enter__(self):
+        """Open the archive in a context manager."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the archive, and delete the temporary file."""
+        self.close()
+
+    def close(self):
+        """Close the archive, and delete the temporary file."""
+        self.zip.close()
+        self.spool.close()
+
+    def csvFiles(self) -> list[str]:
+        """List the CSV files in the archive.
+
+        The first is the submissions, any others are repeat groups.
+
+        Returns:
+            (list[str]): The CSV filenames in the archive
+        """
+        names = [name for name in self.zip.namelist() if name.endswith(".csv") and not name.startswith("media/")]
+        return sorted(names, key=lambda name: name != f"{self.xform}.csv")
+
+    def openCsv(
+        self,
+        filename: Optional[str] = None,
+    ) -> TextIOWrapper:
+        """Open a CSV file in the archive as a text stream.
+
+        This can be passed directly as the data to ODKParsers.CSVparser().
+
+        Args:
+            filename (str): The CSV file to open, defaults to the submissions
+
+        Returns:
+            (TextIOWrapper): The decoded CSV data
+        """
+        if not filename:
+            filenames = self.csvFiles()
+            if not filenames:
+                raise FileNotFoundError(f"No CSV file in submissions archive for {self.xform}")
+            filename = filenames[0]
+        return TextIOWrapper(self.zip.open(filename), encoding="utf-8", newline="")
+
+    def rows(
+        self,
+        filename: Optional[str] = None,
+    ) -> Iterator[dict]:
+        """Iterate over the rows of a CSV file in the archive.
+
+        Args:
+            filename (str): The CSV file to read, defaults to the submissions
+
+        Returns:
+            (Iterator[dict]): Each row of the CSV file
+        """
+        with self.openCsv(filename) as data:
+            yield from csv.DictReader(data, delimiter=",")
+
+    def media(self) -> Iterator[tuple[str, IO[bytes]]]:
+        """Iterate over the media files in the archive.
+
+        Each file is opened only when reached, and closed after.
+
+        Returns:
+            (Iterator[tuple[str, IO[bytes]]]): The filename and file object
+        """
+        for info in self.zip.infolist():
+            if info.is_dir() or not info.filename.startswith("media/"):
+                continue
+            with self.zip.open(info) as media:
+                yield info.filename[len("media/") :], media
+
+
 class OdkCentral(object):
+    # When to retry a failed request, shared by all instances.
+    # Set to RetryPolicy(retries=0) to disable retries.
+    retry = RetryPolicy()
+    # Set to a RequestMetrics to record every request
+    metrics: Optional[RequestMetrics] = None
+    # Set to a ResponseCache to cache the form and dataset metadata
+    cache: Optional[ResponseCache] = None
+
     def __init__(
         self,
         url: Optional[str] = None,
@@ -157,7 +372,11 @@ class OdkCentral(object):
         self.base = self.url + "/" + self.version + "/"
 
         # Use a persistant connect, better for multiple requests
-        self.session = requests.Session()
+        self.session = MeteredSession(self.metrics, self.cache)
+        # Retry temporary errors, and stop when Central is overloaded
+        adapter = RetryAdapter(self.retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         # Authentication with session token
         self.authenticate()
@@ -428,12 +647,13 @@ class OdkProject(OdkCentral):
         self.forms = result.json()
         return self.forms
 
-    def getAllSubmissions(self, project_id: int, xforms: list = None, filters: dict = None):
+    def getAllSubmissions(self, project_id: int, xforms: list = None, filters: Optional[dict | ODataQuery] = None):
         """Fetch a list of submissions in a project on an ODK Central server.
 
         Args:
             project_id (int): The ID of the project on ODK Central
             xforms (list): The list of XForms to get the submissions of
+            filters (dict, ODataQuery): The OData query for the submissions
 
         Returns:
             (json): All of the submissions for all of the XForm in a project
@@ -712,7 +932,7 @@ class OdkForm(OdkCentral):
         result = self.session.get(url, verify=self.verify)
         return result.json()
 
-    def listSubmissions(self, projectId: int, xform: str, filters: dict = None):
+    def listSubmissions(self, projectId: int, xform: str, filters: Optional[dict | ODataQuery] = None):
         """Fetch a list of submission instances for a given form.
 
         Returns data in format:
@@ -723,14 +943,20 @@ class OdkForm(OdkCentral):
             "@odata.count":0
         }
 
+        Only the submissions matching the filters are downloaded, for example
+        ODataQuery().submittedOn(date.today()).reviewState("approved")
+
         Args:
             projectId (int): The ID of the project on ODK Central
             xform (str): The XForm to get the details of from ODK Central
+            filters (dict, ODataQuery): The OData query, or URL params such as $filter
 
         Returns:
             (json): The JSON of Submissions.
         """
         url = f"{self.base}projects/{projectId}/forms/{xform}.svc/Submissions"
+        if isinstance(filters, ODataQuery):
+            filters = filters.params()
         try:
             result = self.session.get(url, params=filters, verify=self.verify)
             result.raise_for_status()  # Raise an error for non-2xx status codes
@@ -823,6 +1049,9 @@ class OdkForm(OdkCentral):
     ):
         """Fetch a ZIP file of the submissions with media to a survey form.
 
+        The whole archive is held in memory, for large exports use
+        streamSubmissionMedia instead.
+
         Args:
             projectId (int): The ID of the project on ODK Central
             xform (str): The XForm to get the details of from ODK Central
@@ -834,6 +1063,45 @@ class OdkForm(OdkCentral):
         result = self.session.get(url, params=filters, verify=self.verify)
         return result
 
+    def streamSubmissionMedia(
+        self,
+        projectId: int,
+        xform: str,
+        filters: Optional[dict] = None,
+        chunk_size: int = 1048576,
+        max_memory: int = 10485760,
+    ) -> SubmissionArchive:
+        """Stream the ZIP file of the submissions with media to a temporary file.
+
+        Unlike getSubmissionMedia, the archive is never held in memory as a
+        whole. It is downloaded in chunks to a spooled temporary file, which
+        moves to disk once larger than max_memory.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            xform (str): The XForm to get the details of from ODK Central
+            filters (dict): Any query parameters for the export
+            chunk_size (int): The size of each chunk to download
+            max_memory (int): The size in bytes to spool in memory
+
+        Returns:
+            (SubmissionArchive): The CSV rows and media in the archive
+        """
+        url = self.base + f"projects/{projectId}/forms/{xform}/submissions.csv.zip"
+        spool = SpooledTemporaryFile(max_size=max_memory)
+        try:
+            with self.session.get(url, params=filters, verify=self.verify, stream=True) as result:
+                result.raise_for_status()
+                for chunk in result.iter_content(chunk_size=chunk_size):
+                    spool.write(chunk)
+        except requests.exceptions.RequestException as e:
+            spool.close()
+            log.error(f"Couldn't download submissions for {xform} from Central: {e}")
+            raise
+        log.debug(f"Downloaded {spool.tell()} bytes of submissions for {xform}")
+        spool.seek(0)
+        return SubmissionArchive(spool, xform)
+
     def getSubmissionPhoto(
         self,
         projectId: int,
@@ -920,26 +1188,10 @@ class OdkForm(OdkCentral):
         """Validate the specified filename is present in the XForm."""
         if not self.xml:
             return
-        xform_filenames = []
-        namespaces = {
-            "h": "http://www.w3.org/1999/xhtml",
-            "odk": "http://www.opendatakit.org/xforms",
-            "xforms": "http://www.w3.org/2002/xforms",
-        }
-
-        root = ElementTree.fromstring(self.xml)
-        instances = root.findall(".//xforms:model/xforms:instance[@src]", namespaces)
-
-        for inst in instances:
-            src_value = inst.attrib.get("src", "")
-            if src_value.startswith("jr://"):
-                src_value = src_value[len("jr://") :]  # Remove jr:// prefix
-            if src_value.startswith("file/"):
-                src_value = src_value[len("file/") :]  # Remove file/ prefix
-            xform_filenames.append(src_value)
+        xform_filenames = getMediaFilenames(self.xml)
 
         if filename not in xform_filenames:
-            log.error(f"Filename ({filename}) is not present in XForm media: {xform_filenames}")
+            log.error(f"Filename ({filename}) is not present in XForm media: {list(xform_filenames)}")
             return False
 
         return True
@@ -1393,23 +1645,9 @@ class OdkAppUser(OdkCentral):
         """
         log.info(f"Generating QR Code for project ({odk_id}) {project_name}")
 
-        self.settings = {
-            "general": {
-                "server_url": f"{self.base}key/{appuser_token}/projects/{odk_id}",
-                "form_update_mode": "manual",
-                "basemap_source": basemap,
-                "autosend": "wifi_and_cellular",
-                "metadata_username": osm_username,
-                "metadata_email": upstream_task_id,
-            },
-            "project": {"name": f"{project_name}"},
-            "admin": {},
-        }
-
-        # Base64 encode JSON params for QR code
-        qr_data = b64encode(zlib.compress(json.dumps(self.settings).encode("utf-8")))
+        self.settings = getQRSettings(self.base, odk_id, project_name, appuser_token, basemap, osm_username, upstream_task_id)
         # Generate QR code
-        self.qrcode = segno.make(qr_data, micro=False)
+        self.qrcode = makeQRCode(self.settings)
 
         if save_qrcode:
             log.debug(f"Saving QR code to {project_name}.png")
@@ -1678,6 +1916,7 @@ class OdkDataset(OdkCentral):
         self,
         projectId: int,
         datasetName: str,
+        query: Optional[ODataQuery] = None,
     ):
         """Get a lightweight JSON of the entity data fields in a dataset.
 
@@ -1707,12 +1946,14 @@ class OdkDataset(OdkCentral):
         Args:
             projectId (int): The ID of the project on ODK Central.
             datasetName (int): The name of a dataset, specific to a project.
+            query (ODataQuery): Only get the matching entities and fields.
 
         Returns:
-            list: All entity data for a project dataset.
+            list: All (or filtered) entity data for a project dataset.
         """
         url = f"{self.base}projects/{projectId}/datasets/{datasetName}.svc/Entities"
-        response = self.session.get(url, verify=self.verify)
+        params = query.params() if query else None
+        response = self.session.get(url, params=params, verify=self.verify)
 
         if not response.ok:
             if response.status_code == 404:
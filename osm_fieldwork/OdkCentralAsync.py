@@ -17,17 +17,54 @@
 #
 """The async counterpart to OdkCentral.py, an ODK Central API client."""
 
+import json
 import logging
+import mimetypes
 import os
-from asyncio import gather
-from typing import Any, Optional, TypedDict
+import sqlite3
+from asyncio import CancelledError, Lock, Queue, Semaphore, TimeoutError, create_task, gather, sleep, to_thread
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from io import BytesIO
+from itertools import repeat
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, Optional, TypedDict, Union
 from uuid import uuid4
+from xml.etree import ElementTree
+from zipfile import ZIP_STORED, ZipFile
 
 import aiohttp
 
+from osm_fieldwork.odata import ODataQuery
+from osm_fieldwork.OdkCentral import getMediaFilenames, getQRSettings, renderQRCode
+from osm_fieldwork.transport import RequestMetrics, ResponseCache, RetryPolicy, RetrySession
+
 log = logging.getLogger(__name__)
 
 
+def pageParams(
+    params: Optional[dict],
+    page_size: int,
+) -> tuple[dict, Optional[int]]:
+    """Split the OData params into the params for each page and a row limit.
+
+    A $top is a limit on the rows returned, as for the sync client, so
+    the pages are requested with the smaller of it and the page size.
+
+    Args:
+        params (dict): The OData URL params, if any.
+        page_size (int): The number of rows per request.
+
+    Returns:
+        (dict, int): The params for the first page, and the row limit if any.
+    """
+    params = dict(params or {})
+    limit = int(params["$top"]) if "$top" in params else None
+    params["$top"] = str(page_size if limit is None else max(min(page_size, limit), 1))
+    return params, limit
+
+
 class EntityIn(TypedDict):
     """Required format for Entity uploads to ODK Central."""
 
@@ -35,14 +72,442 @@ class EntityIn(TypedDict):
     data: dict[str, Any]
 
 
+class EntityUpdate(TypedDict, total=False):
+    """Format for bulk Entity updates to ODK Central.
+
+    The uuid is required, plus one of either label or data.
+    If baseVersion is omitted, the update is forced.
+    """
+
+    uuid: str
+    label: str
+    data: dict[str, Any]
+    baseVersion: int
+
+
+class AppUserIn(TypedDict, total=False):
+    """Format for bulk app-user creation.
+
+    The name is required. The app-user is given the role (default 2,
+    app-user) on each of the forms.
+    """
+
+    name: str
+    forms: list[str]
+    roleId: int
+
+
+class EntityCache(object):
+    """The current state of the Entities in a dataset, keyed by UUID.
+
+    This is kept up to date by OdkDataset.syncEntities, which only requests
+    the Entities changed since the last sync. By default the Entities are
+    held in memory, optionally they can be persisted to a SQLite file, so
+    a sync can resume after a restart.
+    """
+
+    def __init__(
+        self,
+        dbname: Optional[str] = None,
+    ):
+        """Create an empty cache, or load it from a SQLite file.
+
+        Args:
+            dbname (str): The SQLite file to persist the Entities to.
+
+        Returns:
+            (EntityCache): An instance of this object
+        """
+        self.entities = dict()
+        self.lastUpdated = None
+        self.lastDeleted = None
+        self.db = None
+        if dbname:
+            self.db = sqlite3.connect(dbname)
+            self.db.execute("CREATE TABLE IF NOT EXISTS entities (uuid TEXT PRIMARY KEY, entity TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sync (key TEXT PRIMARY KEY, value TEXT)")
+            sync = dict(self.db.execute("SELECT key, value FROM sync"))
+            self.lastUpdated = sync.get("lastUpdated")
+            self.lastDeleted = sync.get("lastDeleted")
+            for uuid, entity in self.db.execute("SELECT uuid, entity FROM entities"):
+                self.entities[uuid] = json.loads(entity)
+
+    def __len__(self) -> int:
+        """The number of Entities in the cache."""
+        return len(self.entities)
+
+    def __contains__(self, uuid: str) -> bool:
+        """Check if an Entity is in the cache."""
+        return uuid in self.entities
+
+    def get(
+        self,
+        uuid: str,
+    ) -> Optional[dict]:
+        """Get the current data for an Entity.
+
+        Args:
+            uuid (str): The Entity UUID.
+
+        Returns:
+            dict: The Entity data, or None if not in the cache.
+        """
+        return self.entities.get(uuid)
+
+    def values(self) -> Iterator[dict]:
+        """Iterate over all the Entities in the cache."""
+        return iter(self.entities.values())
+
+    def update(
+        self,
+        entities: list[dict],
+        deleted: list[str],
+        lastUpdated: Optional[str],
+        lastDeleted: Optional[str],
+    ):
+        """Apply a set of changes from ODK Central.
+
+        Args:
+            entities (list[dict]): The new or modified Entities.
+            deleted (list[str]): The UUIDs of the deleted Entities.
+            lastUpdated (str): The latest creation or update time seen.
+            lastDeleted (str): The latest deletion time seen.
+        """
+        for entity in entities:
+            self.entities[entity["__id"]] = entity
+        for uuid in deleted:
+            self.entities.pop(uuid, None)
+        self.lastUpdated = lastUpdated
+        self.lastDeleted = lastDeleted
+
+        if not self.db:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entities (uuid, entity) VALUES (?, ?)",
+                [(entity["__id"], json.dumps(entity)) for entity in entities],
+            )
+            self.db.executemany("DELETE FROM entities WHERE uuid = ?", [(uuid,) for uuid in deleted])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO sync (key, value) VALUES (?, ?)",
+                [("lastUpdated", lastUpdated), ("lastDeleted", lastDeleted)],
+            )
+
+    def close(self):
+        """Close the SQLite file, if used."""
+        if self.db:
+            self.db.close()
+            self.db = None
+
+
+class SubmissionExport(object):
+    """Write the submissions of many forms to a single file as they arrive.
+
+    Each row is written as soon as its page is received, so memory use
+    does not depend on the number of submissions. The format is one of:
+
+    - ndjson: one JSON submission per line.
+    - geojsonseq: one GeoJSON Feature per record (RFC 8142), using the
+      first geopoint, geotrace or geoshape in the submission.
+    - sqlite: a 'submissions' table of (xform, id, submission JSON).
+
+    The XForm ID is added to each row as '__xform'.
+    """
+
+    FORMATS = {
+        ".ndjson": "ndjson",
+        ".jsonl": "ndjson",
+        ".geojsons": "geojsonseq",
+        ".geojsonl": "geojsonseq",
+        ".geojsonseq": "geojsonseq",
+        ".db": "sqlite",
+        ".sqlite": "sqlite",
+        ".sqlite3": "sqlite",
+    }
+
+    def __init__(
+        self,
+        outfile: str | Path,
+        format: Optional[str] = None,
+    ):
+        """Open the output file.
+
+        Args:
+            outfile (str, Path): The file to write the submissions to.
+            format (str): One of ndjson, geojsonseq or sqlite,
+                default is from the file extension.
+
+        Returns:
+            (SubmissionExport): An instance of this object
+        """
+        outfile = Path(outfile)
+        if not format:
+            format = self.FORMATS.get(outfile.suffix.lower())
+        if format not in set(self.FORMATS.values()):
+            raise ValueError(f"Unsupported export format for {outfile}, use one of ndjson, geojsonseq or sqlite")
+        self.format = format
+        self.outfile = outfile
+        self.file = None
+        self.db = None
+        if format == "sqlite":
+            self.db = sqlite3.connect(outfile)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS submissions (xform TEXT, id TEXT, submission TEXT, PRIMARY KEY (xform, id))"
+            )
+        else:
+            self.file = open(outfile, "w", encoding="utf-8")
+
+    @staticmethod
+    def popGeometry(data: dict) -> Optional[dict]:
+        """Remove and return the first GeoJSON geometry in a submission.
+
+        Args:
+            data (dict): The submission, or a group within it.
+
+        Returns:
+            dict: The geometry, or None if there is none.
+        """
+        for key, value in data.items():
+            if not isinstance(value, dict):
+                continue
+            if "type" in value and "coordinates" in value:
+                return data.pop(key)
+            geometry = SubmissionExport.popGeometry(value)
+            if geometry:
+                return geometry
+        return None
+
+    def write(
+        self,
+        xform: str,
+        rows: list[dict],
+    ):
+        """Write a page of submissions for a form.
+
+        Args:
+            xform (str): The XForm the submissions are from.
+            rows (list[dict]): The submissions, from the OData endpoint.
+        """
+        if self.db:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO submissions (xform, id, submission) VALUES (?, ?, ?)",
+                    [(xform, row.get("__id"), json.dumps({"__xform": xform, **row})) for row in rows],
+                )
+            return
+
+        lines = []
+        for row in rows:
+            if self.format == "geojsonseq":
+                geometry = self.popGeometry(row)
+                feature = {"type": "Feature", "id": row.get("__id"), "geometry": geometry, "properties": {"__xform": xform, **row}}
+                lines.append(f"\x1e{json.dumps(feature)}\n")
+            else:
+                lines.append(f"{json.dumps({'__xform': xform, **row})}\n")
+        self.file.writelines(lines)
+
+    def close(self):
+        """Close the output file."""
+        if self.db:
+            self.db.close()
+            self.db = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class OdkCentralSession(object):
+    """A long-lived, connection pooled session for an ODK Central server.
+
+    Logging in and opening a TLS connection for every request is slow, so
+    in a web server a single session should be opened at startup, then
+    shared by all the OdkProject, OdkForm and OdkDataset instances.
+    The bearer token is refreshed automatically before it expires.
+
+    Example:
+        central = OdkCentralSession(url, user, passwd)
+        await central.open()
+
+        async with OdkDataset(session=central) as odk_dataset:
+            ...
+
+        await central.close()
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        user: Optional[str] = None,
+        passwd: Optional[str] = None,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 60,
+        ttl_dns_cache: int = 300,
+        refresh_margin: int = 3600,
+        retry: Optional[RetryPolicy] = None,
+        metrics: Optional[RequestMetrics] = None,
+        cache: Optional[ResponseCache] = None,
+    ):
+        """Set up the session, which connects when opened.
+
+        Args:
+            url (str): The URL of the ODK Central
+            user (str): The user's account name on ODK Central
+            passwd (str):  The user's account password on ODK Central
+            limit (int): The maximum number of open connections.
+            limit_per_host (int): The maximum connections per host, 0 is no limit.
+            keepalive_timeout (float): Seconds to keep an idle connection open.
+            ttl_dns_cache (int): Seconds to cache DNS lookups.
+            refresh_margin (int): Seconds before the token expires to refresh it.
+            retry (RetryPolicy): When to retry a failed request, the defaults if not set.
+            metrics (RequestMetrics): Where to record each request, none if not set.
+            cache (ResponseCache): Where to cache the form and dataset metadata, none if not set.
+
+        Returns:
+            (OdkCentralSession): An instance of this object
+        """
+        self.url = url or os.getenv("ODK_CENTRAL_URL", default=None)
+        self.user = user or os.getenv("ODK_CENTRAL_USER", default=None)
+        self.passwd = passwd or os.getenv("ODK_CENTRAL_PASSWD", default=None)
+        self.base = f"{self.url}/v1/"
+        self.connector_options = {
+            "limit": limit,
+            "limit_per_host": limit_per_host,
+            "keepalive_timeout": keepalive_timeout,
+            "ttl_dns_cache": ttl_dns_cache,
+        }
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.retry = retry or RetryPolicy()
+        self.metrics = metrics
+        self.cache = cache
+        self.session = None
+        self.expires = None
+        self.lock = Lock()
+        self.refresher = None
+
+    async def __aenter__(self):
+        """Open the session in an async context manager."""
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Close the session in an async context manager."""
+        await self.close()
+
+    async def open(self):
+        """Open the connection pool, and authenticate to ODK Central."""
+        if self.session:
+            return
+        connector = aiohttp.TCPConnector(**self.connector_options)
+        self.session = RetrySession(
+            aiohttp.ClientSession(connector=connector, raise_for_status=True),
+            self.retry,
+            metrics=self.metrics,
+            cache=self.cache,
+        )
+        await self.authenticate()
+        self.refresher = create_task(self.keepAlive())
+
+    async def close(self):
+        """Close all the connections to ODK Central."""
+        if self.refresher:
+            self.refresher.cancel()
+            self.refresher = None
+        if self.session:
+            await self.session.close()
+            self.session = None
+        self.expires = None
+
+    async def authenticate(self):
+        """Get a new bearer token from ODK Central.
+
+        If this is the first login and it fails, the session is closed.
+        If refreshing the token fails, the session and the current token
+        are kept for the other requests using them.
+        """
+        refreshing = self.expires is not None
+        try:
+            async with self.session.post(f"{self.base}sessions", json={"email": self.user, "password": self.passwd}) as response:
+                token_json = await response.json()
+        except aiohttp.ClientConnectorError as request_error:
+            if not refreshing:
+                await self.close()
+            raise ConnectionError("Failed to connect to Central. Is the URL valid?") from request_error
+        except aiohttp.ClientResponseError as response_error:
+            if not refreshing:
+                await self.close()
+            if response_error.status == 401:
+                raise ConnectionError("ODK credentials are invalid, or may have changed. Please update them.") from response_error
+            raise response_error
+
+        self.session.headers.update({"Authorization": f"Bearer {token_json['token']}"})
+        # Tokens expire after 24 hours by default
+        expires = token_json.get("expiresAt")
+        if expires:
+            self.expires = datetime.fromisoformat(expires.replace("Z", "+00:00"))
+        else:
+            self.expires = datetime.now(timezone.utc) + timedelta(hours=24)
+        log.debug(f"Authenticated to ODK Central, token expires at {self.expires}")
+
+    async def refreshToken(self) -> bool:
+        """Get a new bearer token, if the current one expires soon.
+
+        If the refresh fails while the current token is still valid, the
+        current token is kept, so the refresh can be tried again later.
+
+        Returns:
+            (bool): False if the refresh failed and the current token was kept.
+        """
+        async with self.lock:
+            if not self.session:
+                await self.open()
+            elif datetime.now(timezone.utc) >= self.expires - self.refresh_margin:
+                log.info("Refreshing ODK Central session token")
+                try:
+                    await self.authenticate()
+                except (ConnectionError, aiohttp.ClientError, TimeoutError) as e:
+                    if datetime.now(timezone.utc) >= self.expires:
+                        raise
+                    log.error(f"Failed to refresh ODK Central session token, keeping the current one: {e}")
+                    return False
+        return True
+
+    async def keepAlive(self):
+        """Refresh the token in the background, before it expires.
+
+        After a failed refresh, it's tried again with an exponential backoff.
+        """
+        failures = 0
+        while True:
+            if failures:
+                wait = self.retry.delay(failures)
+            else:
+                wait = max((self.expires - self.refresh_margin - datetime.now(timezone.utc)).total_seconds(), 60)
+            await sleep(wait)
+            try:
+                failures = 0 if await self.refreshToken() else failures + 1
+            except (ConnectionError, aiohttp.ClientError, TimeoutError) as e:
+                failures += 1
+                log.error(f"Failed to refresh ODK Central session token: {e}")
+
+
 class OdkCentral(object):
     """Helper methods for ODK Central API."""
 
+    # When to retry a failed request, shared by all instances.
+    # Set to RetryPolicy(retries=0) to disable retries.
+    retry = RetryPolicy()
+    # Set to a RequestMetrics to record every request
+    metrics: Optional[RequestMetrics] = None
+    # Set to a ResponseCache to cache the form and dataset metadata
+    cache: Optional[ResponseCache] = None
+
     def __init__(
         self,
         url: Optional[str] = None,
         user: Optional[str] = None,
         passwd: Optional[str] = None,
+        session: Optional[OdkCentralSession] = None,
     ):
         """A Class for accessing an ODK Central server via it's REST API.
 
@@ -50,11 +515,15 @@ class OdkCentral(object):
             url (str): The URL of the ODK Central
             user (str): The user's account name on ODK Central
             passwd (str):  The user's account password on ODK Central
-            session (str): Pass in an existing session for reuse.
+            session (OdkCentralSession): Pass in an existing session for reuse.
+                The url, user and passwd are then taken from the session.
 
         Returns:
             (OdkCentral): An instance of this class
         """
+        self.shared = session
+        if session:
+            url, user, passwd = session.url, session.user, session.passwd
         if not url:
             url = os.getenv("ODK_CENTRAL_URL", default=None)
         self.url = url
@@ -73,6 +542,7 @@ class OdkCentral(object):
         # Base URL for the REST API
         self.version = "v1"
         self.base = f"{self.url}/{self.version}/"
+        self.session = None
 
     def __enter__(self):
         """Sync context manager not allowed."""
@@ -84,15 +554,30 @@ class OdkCentral(object):
 
     async def __aenter__(self):
         """Async object instantiation."""
+        if self.shared:
+            # Reuse the pooled connections, only logging in if required
+            await self.shared.refreshToken()
+            self.session = self.shared.session
+            return self
+
         # Header enables persistent connection, creates a cookie for this session
-        self.session = aiohttp.ClientSession(
-            raise_for_status=True,
+        self.session = RetrySession(
+            aiohttp.ClientSession(
+                raise_for_status=True,
+            ),
+            self.retry,
+            metrics=self.metrics,
+            cache=self.cache,
         )
         await self.authenticate()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         """Async object close."""
+        if self.shared:
+            # The shared session stays open for other requests
+            self.session = None
+            return
         if self.session:
             await self.session.close()
 
@@ -111,6 +596,81 @@ class OdkCentral(object):
                 raise ConnectionError("ODK credentials are invalid, or may have changed. Please update them.") from response_error
             raise response_error
 
+    def client(self, cls: type["OdkCentral"]) -> "OdkCentral":
+        """Create another client, which uses this client's open session.
+
+        The new client isn't used as a context manager, so it neither
+        logs in again nor closes the session, which stays owned by this client.
+
+        Args:
+            cls (type): The client class, such as OdkForm.
+
+        Returns:
+            (OdkCentral): The new client, ready to use.
+        """
+        client = cls(self.url, self.user, self.passwd, session=self.shared)
+        client.session = self.session
+        return client
+
+    async def iterOData(
+        self,
+        url: str,
+        params: Optional[dict] = None,
+        buffer: int = 2,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[dict]:
+        """Iterate over every row of an OData endpoint, page by page.
+
+        The next page is requested while the current one is consumed,
+        following the '@odata.nextLink' returned by ODK Central.
+        At most 'buffer' pages are held in memory at any time.
+
+        Args:
+            url (str): The OData endpoint, e.g. .../datasets/features.svc/Entities
+            params (dict): The OData URL params for the first page,
+                such as $top, $select and $filter.
+            buffer (int): The maximum number of pages to fetch ahead.
+            limit (int): Stop after this many rows, default all.
+
+        Returns:
+            AsyncIterator[dict]: Each row in the 'value' of every page.
+        """
+        if limit is not None and limit <= 0:
+            return
+        pages = Queue(maxsize=buffer)
+
+        async def fetch():
+            """Fetch each page in turn, until there is no next link."""
+            next_url, next_params = url, params
+            try:
+                while next_url:
+                    async with self.session.get(next_url, params=next_params, ssl=self.verify) as response:
+                        page = await response.json()
+                    await pages.put(page.get("value", []))
+                    # The next link already includes all the params
+                    next_url, next_params = page.get("@odata.nextLink"), None
+                await pages.put(None)
+            except CancelledError:
+                raise
+            except Exception as e:
+                await pages.put(e)
+
+        producer = create_task(fetch())
+        count = 0
+        try:
+            while (page := await pages.get()) is not None:
+                if isinstance(page, Exception):
+                    msg = f"Failed to get OData page from {url}: {page}"
+                    log.error(msg)
+                    raise aiohttp.ClientError(msg) from page
+                for row in page:
+                    yield row
+                    count += 1
+                    if count == limit:
+                        return
+        finally:
+            producer.cancel()
+
 
 class OdkProject(OdkCentral):
     """Class to manipulate a project on an ODK Central server."""
@@ -120,16 +680,18 @@ class OdkProject(OdkCentral):
         url: Optional[str] = None,
         user: Optional[str] = None,
         passwd: Optional[str] = None,
+        session: Optional["OdkCentralSession"] = None,
     ):
         """Args:
             url (str): The URL of the ODK Central
             user (str): The user's account name on ODK Central
             passwd (str):  The user's account password on ODK Central.
+            session (OdkCentralSession): Pass in an existing session for reuse.
 
         Returns:
             (OdkProject): An instance of this object
         """
-        super().__init__(url, user, passwd)
+        super().__init__(url, user, passwd, session)
 
     async def listForms(self, projectId: int, metadata: bool = False):
         """Fetch a list of forms in a project on an ODK Central server.
@@ -153,35 +715,132 @@ class OdkProject(OdkCentral):
             log.error(msg)
             raise aiohttp.ClientError(msg) from e
 
-    async def getAllProjectSubmissions(self, projectId: int, xforms: list = None, filters: dict = None):
+    async def getAllProjectSubmissions(
+        self,
+        projectId: int,
+        xforms: list = None,
+        filters: Optional[dict | ODataQuery] = None,
+        concurrency: int = 4,
+    ):
         """Fetch a list of submissions in a project on an ODK Central server.
 
+        The rows are from listSubmissions, so have the instanceId,
+        submitterId and review state, not the submission data. The
+        submissions list can't be filtered, so for any filters the IDs
+        of the matching submissions are first fetched from the OData
+        endpoint. All the submissions are held in memory, to get the
+        data of large projects use exportSubmissions instead.
+
         Args:
             projectId (int): The ID of the project on ODK Central
             xforms (list): The list of XForms to get the submissions of
+            filters (dict, ODataQuery): The OData query, or URL params such as $filter
+            concurrency (int): The maximum number of forms fetched in parallel.
 
         Returns:
             (json): All of the submissions for all of the XForm in a project
         """
-        # TODO this function needs more testing!
-
         log.info(f"Getting all submissions for ODK project ({projectId}) forms ({xforms})")
-        submission_data = []
-
-        async with OdkForm(self.url, self.user, self.passwd) as odk_form:
-            submission_tasks = [odk_form.listSubmissions(projectId, xform, filters) for xform in xforms or []]
-
-            submissions = await gather(*submission_tasks, return_exceptions=True)
+        limit = Semaphore(concurrency)
+        if isinstance(filters, ODataQuery):
+            filters = filters.params()
+        if filters:
+            # Only the IDs are needed to pick the matching rows
+            filters = {**filters, "$select": "__id"}
+        odk_form = self.client(OdkForm)
+
+        async def fetch(xform: str) -> list[dict]:
+            """Get the list of matching submissions for a form."""
+            async with limit:
+                rows = await odk_form.listSubmissions(projectId, xform)
+                if not filters:
+                    return rows
+                ids = {row["__id"] async for row in odk_form.iterSubmissions(projectId, xform, filters)}
+                return [row for row in rows if row["instanceId"] in ids]
+
+        submissions = await gather(*(fetch(xform) for xform in xforms or []), return_exceptions=True)
 
+        submission_data = []
         for submission in submissions:
             if isinstance(submission, Exception):
                 log.error(f"Failed to get submissions: {submission}")
                 continue
-            log.debug(f"There are {len(submission['value'])} submissions")
-            submission_data.extend(submission["value"])
+            log.debug(f"There are {len(submission)} submissions")
+            submission_data.extend(submission)
 
         return submission_data
 
+    async def exportSubmissions(
+        self,
+        projectId: int,
+        outfile: str | Path,
+        xforms: Optional[list[str]] = None,
+        format: Optional[str] = None,
+        filters: Optional[dict | ODataQuery] = None,
+        concurrency: int = 4,
+        page_size: int = 1000,
+    ) -> dict:
+        """Export the submissions of many forms to a single file.
+
+        Up to 'concurrency' forms are downloaded in parallel, and each
+        page is written out as it arrives, see SubmissionExport. If a form
+        fails, the error is recorded and the other forms carry on. Any
+        pages of a failed form written before the error are kept.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            outfile (str, Path): The file to write the submissions to.
+            xforms (list[str]): The XForms to export, default all in the project.
+            format (str): One of ndjson, geojsonseq or sqlite,
+                default is from the file extension.
+            filters (dict, ODataQuery): The OData query, or URL params such as $filter
+            concurrency (int): The maximum number of forms fetched in parallel.
+            page_size (int): The number of submissions per request.
+
+        Returns:
+            dict: The 'exported' submission count per XForm, plus
+                the 'failed' XForms mapped to the error message.
+        """
+        export = SubmissionExport(outfile, format)
+        if xforms is None:
+            xforms = [form["xmlFormId"] for form in await self.listForms(projectId)]
+        log.info(f"Exporting submissions for ODK project ({projectId}) forms ({xforms}) to {outfile}")
+
+        result = {"exported": {}, "failed": {}}
+        limit = Semaphore(concurrency)
+
+        async def export_form(odk_form: OdkForm, xform: str):
+            """Write the submissions for a form, a page at a time."""
+            count = 0
+            rows = []
+            async with limit:
+                try:
+                    async for row in odk_form.iterSubmissions(projectId, xform, filters, page_size):
+                        rows.append(row)
+                        if len(rows) >= page_size:
+                            export.write(xform, rows)
+                            count += len(rows)
+                            rows = []
+                    export.write(xform, rows)
+                    count += len(rows)
+                except aiohttp.ClientError as e:
+                    log.error(f"Couldn't export submissions for form ({xform}): {e}")
+                    result["failed"][xform] = str(e)
+                    return
+            result["exported"][xform] = count
+
+        try:
+            odk_form = self.client(OdkForm)
+            await gather(*(export_form(odk_form, xform) for xform in xforms))
+        finally:
+            export.close()
+
+        log.info(
+            f"Exported ({sum(result['exported'].values())}) submissions from "
+            f"({len(result['exported'])}) forms, failed ({len(result['failed'])}) forms"
+        )
+        return result
+
 
 class OdkForm(OdkCentral):
     """Class to manipulate a Form on an ODK Central server."""
@@ -191,16 +850,21 @@ class OdkForm(OdkCentral):
         url: Optional[str] = None,
         user: Optional[str] = None,
         passwd: Optional[str] = None,
+        session: Optional["OdkCentralSession"] = None,
     ) -> None:
         """Args:
             url (str): The URL of the ODK Central
             user (str): The user's account name on ODK Central
             passwd (str):  The user's account password on ODK Central.
+            session (OdkCentralSession): Pass in an existing session for reuse.
 
         Returns:
             (OdkForm): An instance of this object.
         """
-        super().__init__(url, user, passwd)
+        super().__init__(url, user, passwd, session)
+        # The XForm XML and the form it was uploaded to, set by createForm
+        self.xml = None
+        self.xform = None
 
     # NOTE this does not work and has been abandoned for now
     # Probably best to use pyodk instead
@@ -287,6 +951,147 @@ class OdkForm(OdkCentral):
             log.error(msg)
             raise aiohttp.ClientError(msg) from e
 
+    async def iterSubmissions(
+        self,
+        projectId: int,
+        xform: str,
+        filters: Optional[dict | ODataQuery] = None,
+        page_size: int = 1000,
+        buffer: int = 2,
+    ) -> AsyncIterator[dict]:
+        """Iterate over the submissions for a form, paginating automatically.
+
+        This uses the OData endpoint, so the groups are nested and
+        geopoints are returned as GeoJSON geometries. As for
+        OdkCentral.listSubmissions, any $top in the filters limits the
+        number of submissions returned, otherwise all the matching
+        submissions are returned.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            xform (str): The XForm to get the submissions of.
+            filters (dict, ODataQuery): The OData query, or URL params such as $filter
+            page_size (int): The number of submissions per request, separate from any $top.
+            buffer (int): The maximum number of pages to fetch ahead.
+
+        Returns:
+            AsyncIterator[dict]: Each submission.
+        """
+        url = f"{self.base}projects/{projectId}/forms/{xform}.svc/Submissions"
+        if isinstance(filters, ODataQuery):
+            filters = filters.params()
+        params, limit = pageParams(filters, page_size)
+
+        async for submission in self.iterOData(url, params, buffer, limit):
+            yield submission
+
+    async def getSubmissionCount(
+        self,
+        projectId: int,
+        xform: str,
+        query: Optional[ODataQuery] = None,
+    ) -> int:
+        """Count the submissions for a form, without downloading them.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            xform (str): The XForm to count the submissions of.
+            query (ODataQuery): Only count the matching submissions.
+
+        Returns:
+            int: The number of submissions.
+        """
+        url = f"{self.base}projects/{projectId}/forms/{xform}.svc/Submissions"
+        params = {**(query.params() if query else {}), "$top": "0", "$count": "true"}
+        try:
+            async with self.session.get(url, params=params, ssl=self.verify) as response:
+                return (await response.json())["@odata.count"]
+        except aiohttp.ClientError as e:
+            msg = f"Failed to count submissions for form ({xform}): {e}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg) from e
+
+    async def updateReviewState(
+        self,
+        projectId: int,
+        xform: str,
+        instanceId: str,
+        reviewState: str,
+    ) -> dict:
+        """Set the review state of a submission.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            xform (str): The XForm the submission is for.
+            instanceId (str): The instance ID of the submission.
+            reviewState (str): One of hasIssues, edited, approved or rejected.
+
+        Returns:
+            dict: The updated submission metadata.
+        """
+        url = f"{self.base}projects/{projectId}/forms/{xform}/submissions/{instanceId}"
+        try:
+            # Setting the same state twice has the same result, so it's safe to retry
+            async with self.session.patch(url, ssl=self.verify, json={"reviewState": reviewState}, idempotent=True) as response:
+                return await response.json()
+        except aiohttp.ClientError as e:
+            msg = f"Failed to update review state of submission ({instanceId}): {e}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg) from e
+
+    async def updateReviewStates(
+        self,
+        projectId: int,
+        xform: str,
+        reviews: dict[str, str],
+        concurrency: int = 10,
+        submissions: Optional[list[dict]] = None,
+    ) -> list[dict]:
+        """Set the review state of many submissions in parallel.
+
+        Failed requests are retried as per the RetryPolicy, and a failure
+        only affects that submission.
+
+        If the submissions are already loaded, for example from
+        iterSubmissions, pass them in to have '__system/reviewState'
+        updated in place for each success, rather than fetching them again.
+
+        Example, approving two submissions and rejecting a third:
+
+        results = await odk_form.updateReviewStates(projectId, xform, {
+            "uuid:e83db2b4-5e82-4e61-bc32-04750e511aff": "approved",
+            "uuid:71fff014-7518-429b-b97c-1332149efe7a": "approved",
+            "uuid:523699d0-66ec-4cfc-a76b-4617c01c6b92": "rejected",
+        })
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            xform (str): The XForm the submissions are for.
+            reviews (dict[str, str]): The new review state for each instance ID.
+            concurrency (int): The maximum number of parallel requests.
+            submissions (list[dict]): OData submissions to update in place.
+
+        Returns:
+            list[dict]: The outcome for each review, in the same order.
+                Format: {"instanceId": str, "success": bool, "submission": dict, "error": str}
+        """
+        limit = Semaphore(concurrency)
+        loaded = {submission.get("__id"): submission for submission in submissions or []}
+
+        async def review(instanceId: str, reviewState: str) -> dict:
+            """Update a single submission."""
+            async with limit:
+                try:
+                    submission = await self.updateReviewState(projectId, xform, instanceId, reviewState)
+                except (aiohttp.ClientError, TimeoutError) as e:
+                    return {"instanceId": instanceId, "success": False, "error": str(e)}
+            if instanceId in loaded:
+                loaded[instanceId].setdefault("__system", {})["reviewState"] = submission.get("reviewState", reviewState)
+            return {"instanceId": instanceId, "success": True, "submission": submission}
+
+        log.info(f"Updating the review state of ({len(reviews)}) submissions for form ({xform})")
+        return await gather(*(review(instanceId, reviewState) for instanceId, reviewState in reviews.items()))
+
     async def listSubmissionAttachments(self, projectId: int, xform: str, submissionUuid: str):
         """Fetch a list of attachments listed for upload on a given submission.
 
@@ -356,6 +1161,528 @@ class OdkForm(OdkCentral):
 
         return {filename: url for filename, url in urls if url is not None}
 
+    async def downloadSubmissionAttachments(
+        self,
+        projectId: int,
+        xform: str,
+        submissionUuids: list[str],
+        outdir: str | Path,
+        concurrency: int = 10,
+        chunk_size: int = 65536,
+    ) -> dict:
+        """Download all the attachments for many submissions to disk.
+
+        Each attachment is streamed to disk in chunks, so memory use does
+        not depend on the file size. Files are written to
+        outdir/submissionUuid/filename, any attachment name that isn't a
+        plain filename is reported as failed rather than written.
+
+        Completed files are recorded in outdir/manifest.jsonl, so if the
+        download is interrupted, calling this again will skip the files
+        that were already downloaded.
+
+        If ODK Central is configured with S3 storage, the redirect to the
+        pre-signed S3 URL is followed without sending the Central credentials.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            xform (str): The XForm to get the attachments of.
+            submissionUuids (list[str]): The UUIDs of the submissions.
+            outdir (str, Path): The directory to write the attachments to.
+            concurrency (int): The maximum number of parallel requests.
+            chunk_size (int): The size of each chunk written to disk.
+
+        Returns:
+            dict: The 'downloaded' and 'skipped' file paths, plus
+                the 'failed' files mapped to the error message.
+        """
+        outdir = Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        manifest_path = outdir / "manifest.jsonl"
+        completed = set()
+        if manifest_path.exists():
+            with open(manifest_path, "r") as manifest:
+                for line in manifest:
+                    if line.strip():
+                        completed.add(json.loads(line)["path"])
+
+        result = {"downloaded": [], "skipped": [], "failed": {}}
+        limit = Semaphore(concurrency)
+
+        async def list_attachments(submissionUuid: str) -> list[tuple[str, str]]:
+            """Get the names of the uploaded attachments for a submission."""
+            async with limit:
+                try:
+                    attachments = await self.listSubmissionAttachments(projectId, xform, submissionUuid)
+                except aiohttp.ClientError as e:
+                    result["failed"][submissionUuid] = str(e)
+                    return []
+            found = list()
+            for item in attachments:
+                if not item.get("exists"):
+                    continue
+                # The names come from the server, so must not escape outdir
+                filename = os.path.basename(item["name"])
+                if os.path.isabs(item["name"]) or ".." in Path(item["name"]).parts or filename in ("", "."):
+                    log.error(f"Not downloading the attachment {item['name']!r} of {submissionUuid}, it isn't a plain filename")
+                    result["failed"][f"{submissionUuid}/{item['name']}"] = "Invalid attachment name"
+                    continue
+                found.append((submissionUuid, filename))
+            return found
+
+        async def stream_to_disk(response: aiohttp.ClientResponse, filespec: Path):
+            """Write the response body to disk, chunk by chunk, without blocking the event loop."""
+            partial = filespec.with_name(f"{filespec.name}.part")
+            outfile = await to_thread(open, partial, "wb")
+            try:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    await to_thread(outfile.write, chunk)
+            finally:
+                await to_thread(outfile.close)
+            await to_thread(partial.replace, filespec)
+
+        def record(key: str, filespec: Path):
+            """Add a completed file to the manifest."""
+            with open(manifest_path, "a") as manifest:
+                manifest.write(json.dumps({"path": key, "size": filespec.stat().st_size}) + "\n")
+
+        async def download(s3_session: RetrySession, submissionUuid: str, filename: str):
+            """Download a single attachment, following any redirect to S3."""
+            key = f"{submissionUuid}/{filename}"
+            filespec = outdir / submissionUuid / filename
+            if key in completed and filespec.exists():
+                result["skipped"].append(str(filespec))
+                return
+            await to_thread(filespec.parent.mkdir, exist_ok=True)
+
+            url = f"{self.base}projects/{projectId}/forms/{xform}/submissions/{submissionUuid}/attachments/{filename}"
+            async with limit:
+                try:
+                    async with self.session.get(url, ssl=self.verify, allow_redirects=False) as response:
+                        if response.status in (301, 302, 303, 307, 308):
+                            s3_url = response.headers.get("Location")
+                        else:
+                            s3_url = None
+                            await stream_to_disk(response, filespec)
+                    if s3_url:
+                        async with s3_session.get(s3_url, ssl=self.verify) as response:
+                            await stream_to_disk(response, filespec)
+                except aiohttp.ClientError as e:
+                    log.error(f"Couldn't download {key} from Central: {e}")
+                    result["failed"][key] = str(e)
+                    return
+
+            await to_thread(record, key, filespec)
+            result["downloaded"].append(str(filespec))
+
+        listed = await gather(*(list_attachments(submissionUuid) for submissionUuid in submissionUuids))
+        attachments = [item for items in listed for item in items]
+        log.info(f"Downloading ({len(attachments)}) attachments for ODK project ({projectId}) form ({xform})")
+
+        # The S3 pre-signed URLs must not receive the Central auth header
+        async with aiohttp.ClientSession(raise_for_status=True) as s3_client:
+            s3_session = RetrySession(s3_client, self.retry, metrics=self.metrics)
+            await gather(*(download(s3_session, submissionUuid, filename) for submissionUuid, filename in attachments))
+
+        log.info(
+            f"Downloaded ({len(result['downloaded'])}) skipped ({len(result['skipped'])}) "
+            f"failed ({len(result['failed'])}) attachments for form ({xform})"
+        )
+        return result
+
+    async def createForm(
+        self,
+        projectId: int,
+        data: Union[str, Path, BytesIO, bytes],
+        form_name: Optional[str] = None,
+        publish: bool = False,
+    ) -> str:
+        """Create a new form on an ODK Central server.
+
+        - If no form_name is passed, a new form is created, named from the
+            id attribute of the XForm instance.
+        - If form_name is passed, a new draft of the existing form is created.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            data (str, Path, BytesIO, bytes): The XForm file path, or the XML.
+            form_name (str): The existing form to create a draft of.
+            publish (bool): If the new form or draft should be published.
+
+        Returns:
+            (str): The form name (xmlFormId).
+        """
+        self.xform = None
+        if isinstance(data, BytesIO):
+            self.xml = data.getvalue()
+        elif isinstance(data, bytes):
+            self.xml = data
+        else:
+            self.xml = Path(data).read_bytes()
+        headers = {"Content-Type": "application/xml"}
+
+        if form_name:
+            log.debug(f"Creating draft from template form: {form_name}")
+            url = f"{self.base}projects/{projectId}/forms/{form_name}/draft"
+            params = {"ignoreWarnings": "true"}
+        else:
+            log.debug("Creating new form, with name determined from form_id field")
+            url = f"{self.base}projects/{projectId}/forms"
+            params = {"ignoreWarnings": "true", "publish": "true" if publish else "false"}
+
+        try:
+            async with self.session.post(url, ssl=self.verify, params=params, data=self.xml, headers=headers) as response:
+                json_data = await response.json()
+        except aiohttp.ClientResponseError as e:
+            if e.status != 409 or form_name:
+                msg = f"Couldn't create form on Central: {e}"
+                log.error(msg)
+                raise aiohttp.ClientError(msg) from e
+            # The form already exists, so use it
+            instance = ElementTree.fromstring(self.xml).find(".//{http://www.w3.org/2002/xforms}instance")
+            xmlFormId = instance[0].get("id")
+            log.warning(f"Form ({xmlFormId}) already exists in ODK project ({projectId})")
+            self.xform = xmlFormId
+            return xmlFormId
+        except aiohttp.ClientError as e:
+            msg = f"Couldn't create form on Central: {e}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg) from e
+
+        if form_name:
+            log.debug(f"Created draft XForm on ODK server: ({form_name})")
+            self.xform = form_name
+            if publish:
+                await self.publishForm(projectId, form_name)
+            return form_name
+
+        xmlFormId = json_data.get("xmlFormId")
+        log.info(f"Created XForm on ODK server: ({xmlFormId})")
+        self.xform = xmlFormId
+        return xmlFormId
+
+    async def publishForm(
+        self,
+        projectId: int,
+        xform: str,
+        version: Optional[str] = None,
+    ) -> int:
+        """Publish the draft of a form.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            xform (str): The XForm to publish on ODK Central
+            version (str): The new version of the form, the time if not set.
+
+        Returns:
+            (int): The status code from ODK Central
+        """
+        if not version:
+            version = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        url = f"{self.base}projects/{projectId}/forms/{xform}/draft/publish"
+        try:
+            async with self.session.post(url, ssl=self.verify, params={"version": version}) as response:
+                log.info(f"Published {xform} on Central.")
+                return response.status
+        except aiohttp.ClientError as e:
+            msg = f"Couldn't publish {xform} on Central: {e}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg) from e
+
+    async def uploadMedia(
+        self,
+        projectId: int,
+        xform: str,
+        data: Union[str, Path, BytesIO, bytes],
+        filename: Optional[str] = None,
+        publish: Optional[bool] = None,
+    ) -> list[str]:
+        """Upload an attachment to a form, see uploadMediaFiles.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            xform (str): The XForm to upload the attachment to.
+            data (str, Path, BytesIO, bytes): The file path, or the file contents.
+            filename (str): The attachment name, required unless data is a path.
+            publish (bool): If the draft should be published after the upload.
+                By default the form is only published if it was already.
+
+        Returns:
+            (list[str]): The uploaded filename.
+        """
+        if not filename:
+            if not isinstance(data, (str, Path)):
+                raise ValueError("A filename is required to upload media from memory")
+            filename = Path(data).name
+        return await self.uploadMediaFiles(projectId, xform, {filename: data}, publish=publish)
+
+    async def uploadMediaFiles(
+        self,
+        projectId: int,
+        xform: str,
+        files: Union[list[Union[str, Path]], dict[str, Union[str, Path, BytesIO, bytes]]],
+        concurrency: int = 4,
+        publish: Optional[bool] = None,
+    ) -> list[str]:
+        """Upload many attachments to a form in parallel.
+
+        If the form is published, a single draft is created first, and then
+        published again once all the attachments are uploaded. Files are
+        streamed from disk, so large GeoJSON or CSV files aren't read into
+        memory, and are opened again if the upload is retried.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            xform (str): The XForm to upload the attachments to.
+            files (list, dict): The file paths, or a dict of the attachment
+                name to the file path or contents.
+            concurrency (int): The maximum number of parallel uploads.
+            publish (bool): If the draft should be published after the upload.
+                By default the form is only published if it was already.
+
+        Returns:
+            (list[str]): The uploaded filenames.
+        """
+        if not isinstance(files, dict):
+            files = {Path(filespec).name: filespec for filespec in files}
+        url = f"{self.base}projects/{projectId}/forms/{xform}"
+
+        try:
+            async with self.session.get(url, ssl=self.verify) as response:
+                published = (await response.json()).get("publishedAt") is not None
+            if self.xml and self.xform == xform:
+                expected = getMediaFilenames(self.xml)
+            else:
+                attachments_url = f"{url}/attachments" if published else f"{url}/draft/attachments"
+                async with self.session.get(attachments_url, ssl=self.verify) as response:
+                    expected = [item["name"] for item in await response.json()]
+
+            unknown = [filename for filename in files if filename not in expected]
+            if unknown:
+                raise ValueError(f"Filenames ({unknown}) are not present in XForm media: {list(expected)}")
+
+            if published:
+                # Copies the published form and attachments to a new draft
+                log.debug(f"Updating form ({xform}) to draft")
+                async with self.session.post(f"{url}/draft", ssl=self.verify, params={"ignoreWarnings": "true"}) as response:
+                    await response.read()
+        except aiohttp.ClientError as e:
+            msg = f"Couldn't prepare form ({xform}) for media upload: {e}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg) from e
+
+        limit = Semaphore(concurrency)
+
+        async def upload(filename: str, data: Union[str, Path, BytesIO, bytes]):
+            """Upload a single attachment to the draft."""
+            attachment_url = f"{url}/draft/attachments/{filename}"
+            headers = {"Content-Type": mimetypes.guess_type(filename)[0] or "application/octet-stream"}
+            if isinstance(data, (str, Path)):
+                # aiohttp streams the file in chunks, opened for each attempt
+                media = partial(open, data, "rb")
+            else:
+                media = data.getvalue() if isinstance(data, BytesIO) else data
+            async with limit:
+                # Replacing an attachment is safe to retry
+                async with self.session.post(
+                    attachment_url, ssl=self.verify, data=media, headers=headers, idempotent=True
+                ) as response:
+                    await response.read()
+            log.debug(f"Uploaded {filename} to Central")
+
+        log.info(f"Uploading ({len(files)}) media files for ODK project ({projectId}) form ({xform})")
+        results = await gather(*(upload(filename, data) for filename, data in files.items()), return_exceptions=True)
+        failed = {filename: result for filename, result in zip(files, results, strict=True) if isinstance(result, Exception)}
+        if failed:
+            errors = ", ".join(f"{filename}: {error}" for filename, error in failed.items())
+            msg = f"Couldn't upload media to Central: {errors}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg)
+
+        if publish or (publish is None and published):
+            await self.publishForm(projectId, xform)
+        return list(files)
+
+
+class OdkAppUser(OdkCentral):
+    """Class to manipulate app-users on an ODK Central server."""
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        user: Optional[str] = None,
+        passwd: Optional[str] = None,
+        session: Optional["OdkCentralSession"] = None,
+    ) -> None:
+        """A Class for managing app-users on an ODK Central server.
+
+        Args:
+            url (str): The URL of the ODK Central
+            user (str): The user's account name on ODK Central
+            passwd (str):  The user's account password on ODK Central.
+            session (OdkCentralSession): Pass in an existing session for reuse.
+
+        Returns:
+            (OdkAppUser): An instance of this object.
+        """
+        super().__init__(url, user, passwd, session)
+
+    async def create(
+        self,
+        projectId: int,
+        name: str,
+    ) -> dict:
+        """Create a new app-user in a project.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            name (str): The display name of the app-user
+
+        Returns:
+            (dict): The app-user, including the token for the QR code.
+        """
+        url = f"{self.base}projects/{projectId}/app-users"
+        try:
+            async with self.session.post(url, ssl=self.verify, json={"displayName": name}) as response:
+                return await response.json()
+        except aiohttp.ClientError as e:
+            msg = f"Failed to create app-user ({name}): {e}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg) from e
+
+    async def grantAccess(
+        self,
+        projectId: int,
+        xform: str,
+        actorId: int,
+        roleId: int = 2,
+    ) -> bool:
+        """Assign a role on a form to an app-user.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            xform (str): The XForm to grant access to.
+            actorId (int): The ID of the app-user.
+            roleId (int): The role ID, 2 being the app-user role.
+
+        Returns:
+            (bool): Whether access was granted.
+        """
+        url = f"{self.base}projects/{projectId}/forms/{xform}/assignments/{roleId}/{actorId}"
+        try:
+            async with self.session.post(url, ssl=self.verify) as response:
+                return (await response.json()).get("success", False)
+        except aiohttp.ClientError as e:
+            msg = f"Failed to grant access to form ({xform}) for app-user ({actorId}): {e}"
+            log.error(msg)
+            raise aiohttp.ClientError(msg) from e
+
+    async def createAppUsers(
+        self,
+        projectId: int,
+        users: list[AppUserIn],
+        concurrency: int = 10,
+    ) -> list[dict]:
+        """Create many app-users in parallel, and assign each one to forms.
+
+        Example users:
+        [
+            {"name": "Task 1", "forms": ["buildings"]},
+            {"name": "Task 2", "forms": ["buildings", "roads"], "roleId": 2},
+        ]
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            users (list[AppUserIn]): The app-users to create.
+            concurrency (int): The maximum number of parallel requests.
+
+        Returns:
+            list[dict]: The outcome for each app-user, in the same order.
+                Format: {"name": str, "success": bool, "appuser": dict, "error": str}
+        """
+        limit = Semaphore(concurrency)
+
+        async def provision(item: AppUserIn) -> dict:
+            """Create a single app-user, then assign the forms."""
+            name = item["name"]
+            try:
+                async with limit:
+                    appuser = await self.create(projectId, name)
+                for xform in item.get("forms", []):
+                    async with limit:
+                        await self.grantAccess(projectId, xform, appuser["id"], item.get("roleId", 2))
+            except aiohttp.ClientError as e:
+                return {"name": name, "success": False, "error": str(e)}
+            return {"name": name, "success": True, "appuser": appuser}
+
+        log.info(f"Creating ({len(users)}) app-users for ODK project ({projectId})")
+        return await gather(*(provision(item) for item in users))
+
+    async def createQRCodes(
+        self,
+        projectId: int,
+        project_name: str,
+        appusers: list[dict],
+        outfile: Union[str, Path],
+        basemap: str = "osm",
+        osm_username: str = "svchotosm",
+        processes: Optional[int] = None,
+        scale: int = 5,
+    ) -> Path:
+        """Render the QR codes for many app-users into a ZIP of PNG images.
+
+        The images are rendered in a pool of processes, as that is CPU bound.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central
+            project_name (str): The name of the project to set in ODK Collect.
+            appusers (list[dict]): The app-users from Central, with a
+                'displayName' and 'token'. An optional 'upstream_task_id' is
+                added to the settings too.
+            outfile (str, Path): The ZIP file to write.
+            basemap (str): Default basemap to use on Collect.
+            osm_username (str): The OSM username to attribute to the mapping.
+            processes (int): The number of processes, the CPU count if not set.
+            scale (int): The size of each module of the QR code, in pixels.
+
+        Returns:
+            (Path): The ZIP file, with a {displayName}.png for each app-user.
+        """
+        outfile = Path(outfile)
+        settings = [
+            getQRSettings(
+                self.base,
+                projectId,
+                project_name,
+                appuser["token"],
+                basemap,
+                osm_username,
+                appuser.get("upstream_task_id", ""),
+            )
+            for appuser in appusers
+        ]
+
+        filenames = []
+        for appuser in appusers:
+            filename = f"{str(appuser['displayName']).replace('/', '_')}.png"
+            if filename in filenames:
+                filename = f"{filename[:-4]}_{appuser.get('id')}.png"
+            filenames.append(filename)
+
+        def write():
+            """Write the images to the ZIP file, in order, as they are rendered."""
+            workers = processes or os.cpu_count() or 1
+            chunksize = max(1, len(settings) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as pool, ZipFile(outfile, "w") as archive:
+                images = pool.map(renderQRCode, settings, repeat(scale), chunksize=chunksize)
+                for filename, image in zip(filenames, images, strict=True):
+                    # PNG is already compressed
+                    archive.writestr(filename, image, compress_type=ZIP_STORED)
+
+        log.info(f"Generating ({len(appusers)}) QR codes for ODK project ({projectId}) in {outfile}")
+        await to_thread(write)
+        return outfile
+
 
 class OdkDataset(OdkCentral):
     """Class to manipulate a Entity on an ODK Central server."""
@@ -365,16 +1692,18 @@ class OdkDataset(OdkCentral):
         url: Optional[str] = None,
         user: Optional[str] = None,
         passwd: Optional[str] = None,
+        session: Optional["OdkCentralSession"] = None,
     ) -> None:
         """Args:
             url (str): The URL of the ODK Central
             user (str): The user's account name on ODK Central
             passwd (str):  The user's account password on ODK Central.
+            session (OdkCentralSession): Pass in an existing session for reuse.
 
         Returns:
             (OdkDataset): An instance of this object.
         """
-        super().__init__(url, user, passwd)
+        super().__init__(url, user, passwd, session)
 
     async def listDatasets(
         self,
@@ -701,20 +2030,38 @@ class OdkDataset(OdkCentral):
         projectId: int,
         datasetName: str,
         entities: list[EntityIn],
+        chunk_size: int = 5000,
+        max_chunk_bytes: int = 10485760,
+        concurrency: int = 4,
+        raise_on_error: bool = True,
     ) -> dict:
         """Bulk create Entities in a project dataset (entity list).
 
+        The entities are split into chunks, limited by both the number of
+        entities and the size of the JSON payload, and the chunks are
+        uploaded in parallel.
+
+        Each entity is given a UUID before upload, so a chunk can safely be
+        retried if the server is temporarily unavailable, and can never
+        create duplicate entities. A 409 conflict is only taken as already
+        created when the chunk was retried.
+
         Args:
             projectId (int): The ID of the project on ODK Central.
             datasetName (int): The name of a dataset, specific to a project.
             entities (list[EntityIn]): A list of Entities to insert.
                 Format: {"label": "John Doe", "data": {"firstName": "John", "age": "22"}}
+            chunk_size (int): The maximum number of entities per request.
+            max_chunk_bytes (int): The maximum JSON payload size per request.
+            concurrency (int): The maximum number of parallel requests.
+            raise_on_error (bool): Raise an error if any chunk failed.
+                If false, the failed entity ranges are in the result instead,
+                so they can be uploaded again.
 
         Returns:
-            # list: A list of Entity detail JSONs.
-            #     The 'uuid' field includes the unique entity identifier.
-            dict: {'success': true}
-                When creating bulk entities ODK Central return this for now.
+            dict: {'success': bool, 'created': int, 'failed': list}
+                Each failed chunk is {'start': int, 'end': int, 'error': str},
+                being the slice of the entities list that was not created.
         """
         # Validation
         if not isinstance(entities, list):
@@ -722,17 +2069,61 @@ class OdkDataset(OdkCentral):
 
         log.info(f"Bulk uploading ({len(entities)}) Entities for ODK project ({projectId}) dataset ({datasetName})")
         url = f"{self.base}projects/{projectId}/datasets/{datasetName}/entities"
-        payload = {"entities": entities, "source": {"name": "features.csv"}}
 
-        try:
-            async with self.session.post(url, ssl=self.verify, json=payload) as response:
-                response.raise_for_status()
-                log.info(f"Successfully created entities for ODK project ({projectId}) in dataset ({datasetName})")
-                return await response.json()
-        except aiohttp.ClientError as e:
-            msg = f"Failed to create Entities: {e}"
+        # Serialise each entity once, and use the size to split the chunks
+        chunks = []
+        parts = []
+        size = 0
+        first = 0
+        for index, entity in enumerate(entities):
+            part = json.dumps({"uuid": str(uuid4()), **entity}).encode("utf-8")
+            if parts and (len(parts) >= chunk_size or size + len(part) > max_chunk_bytes):
+                chunks.append((first, index, parts))
+                parts = []
+                size = 0
+                first = index
+            parts.append(part)
+            size += len(part) + 1
+        if parts:
+            chunks.append((first, len(entities), parts))
+
+        limit = Semaphore(concurrency)
+        headers = {"Content-Type": "application/json"}
+
+        async def upload(start: int, end: int, parts: list[bytes]) -> Optional[dict]:
+            """Upload a chunk of entities, returning the failure if any."""
+            payload = b'{"entities":[' + b",".join(parts) + b'],"source":{"name":"features.csv"}}'
+            async with limit:
+                request = self.session.post(url, ssl=self.verify, data=payload, headers=headers, idempotent=True)
+                try:
+                    async with request as response:
+                        await response.read()
+                except aiohttp.ClientResponseError as e:
+                    # The UUIDs are new, so a conflict on a retry means the
+                    # response to an earlier attempt was lost. On the first
+                    # attempt it's a real conflict, so the chunk failed.
+                    if e.status != 409 or not request.state["retries"]:
+                        return {"start": start, "end": end, "error": str(e)}
+                    log.debug(f"Entities ({start}-{end}) were already created in dataset ({datasetName})")
+                except (aiohttp.ClientError, TimeoutError) as e:
+                    return {"start": start, "end": end, "error": str(e)}
+            log.debug(f"Created entities ({start}-{end}) in dataset ({datasetName})")
+            return None
+
+        results = await gather(*(upload(start, end, parts) for start, end, parts in chunks))
+        failed = [result for result in results if result]
+        created = len(entities) - sum(item["end"] - item["start"] for item in failed)
+
+        if failed:
+            ranges = ", ".join(f"({item['start']}-{item['end']}) {item['error']}" for item in failed)
+            msg = f"Failed to create Entities: {ranges}"
             log.error(msg)
-            raise aiohttp.ClientError(msg) from e
+            if raise_on_error:
+                raise aiohttp.ClientError(msg)
+        else:
+            log.info(f"Successfully created entities for ODK project ({projectId}) in dataset ({datasetName})")
+
+        return {"success": not failed, "created": created, "failed": failed}
 
     async def updateEntity(
         self,
@@ -861,6 +2252,114 @@ class OdkDataset(OdkCentral):
             log.error(msg)
             raise aiohttp.ClientError(msg) from e
 
+    async def updateEntities(
+        self,
+        projectId: int,
+        datasetName: str,
+        updates: list[EntityUpdate],
+        concurrency: int = 10,
+        retries: int = 3,
+    ) -> list[dict]:
+        """Update many existing Entities in a project dataset in parallel.
+
+        Each update is a PATCH as per updateEntity. If a 'baseVersion' is
+        included, the update is only applied to that version of the Entity.
+        When the Entity was modified in the meantime (HTTP 409), the current
+        version is fetched and the update applied to it instead.
+
+        Example updates:
+        [
+            {"uuid": "71fff014-7518-429b-b97c-1332149efe7a", "data": {"status": "0"}},
+            {"uuid": "523699d0-66ec-4cfc-a76b-4617c01c6b92", "data": {"status": "0"}, "baseVersion": 4},
+        ]
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            datasetName (int): The name of a dataset, specific to a project.
+            updates (list[EntityUpdate]): The Entity updates to apply.
+            concurrency (int): The maximum number of parallel requests.
+            retries (int): The number of times to retry a version conflict,
+                per Entity.
+
+        Returns:
+            list[dict]: The outcome for each update, in the same order.
+                Format: {"uuid": str, "success": bool, "entity": dict, "error": str}
+        """
+        limit = Semaphore(concurrency)
+
+        async def update(item: EntityUpdate) -> dict:
+            """Update a single Entity, retrying conflicts."""
+            entityUuid = item.get("uuid")
+            json_data = {key: item[key] for key in ("label", "data") if item.get(key)}
+            if not entityUuid or not json_data:
+                return {"uuid": entityUuid, "success": False, "error": "A 'uuid' and either 'label' or 'data' are required"}
+
+            url = f"{self.base}projects/{projectId}/datasets/{datasetName}/entities/{entityUuid}"
+            baseVersion = item.get("baseVersion")
+            async with limit:
+                for attempt in range(retries + 1):
+                    params = {"force": "true"} if baseVersion is None else {"baseVersion": baseVersion}
+                    try:
+                        async with self.session.patch(
+                            url, ssl=self.verify, params=params, json=json_data, idempotent=True
+                        ) as response:
+                            return {"uuid": entityUuid, "success": True, "entity": await response.json()}
+                    except aiohttp.ClientError as e:
+                        error = e
+                    except TimeoutError as e:
+                        error = e
+                    if attempt == retries or not isinstance(error, aiohttp.ClientResponseError) or error.status != 409:
+                        break
+                    current = await self.getEntity(projectId, datasetName, entityUuid)
+                    if not current:
+                        break
+                    baseVersion = current["currentVersion"]["version"]
+                    log.debug(f"Version conflict for Entity ({entityUuid}), retrying on version {baseVersion}")
+            log.error(f"Failed to update Entity ({entityUuid}): {error}")
+            return {"uuid": entityUuid, "success": False, "error": str(error)}
+
+        log.info(f"Bulk updating ({len(updates)}) Entities for ODK project ({projectId}) dataset ({datasetName})")
+        return await gather(*(update(item) for item in updates))
+
+    async def deleteEntities(
+        self,
+        projectId: int,
+        datasetName: str,
+        entityUuids: list[str],
+        concurrency: int = 10,
+    ) -> list[dict]:
+        """Delete many Entities in a project dataset in parallel.
+
+        Only performs a soft deletion, so the Entities are actually archived.
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            datasetName (int): The name of a dataset, specific to a project.
+            entityUuids (list[str]): Unique itentifiers of the entities.
+            concurrency (int): The maximum number of parallel requests.
+
+        Returns:
+            list[dict]: The outcome for each deletion, in the same order.
+                Format: {"uuid": str, "success": bool, "error": str}
+        """
+        limit = Semaphore(concurrency)
+
+        async def delete(entityUuid: str) -> dict:
+            """Delete a single Entity."""
+            url = f"{self.base}projects/{projectId}/datasets/{datasetName}/entities/{entityUuid}"
+            async with limit:
+                try:
+                    async with self.session.delete(url, ssl=self.verify) as response:
+                        success = (await response.json()).get("success", False)
+                        return {"uuid": entityUuid, "success": success}
+                except (aiohttp.ClientError, TimeoutError) as e:
+                    error = e
+            log.error(f"Failed to delete Entity ({entityUuid}): {error}")
+            return {"uuid": entityUuid, "success": False, "error": str(error)}
+
+        log.info(f"Bulk deleting ({len(entityUuids)}) Entities for ODK project ({projectId}) dataset ({datasetName})")
+        return await gather(*(delete(entityUuid) for entityUuid in entityUuids))
+
     async def getEntityCount(
         self,
         projectId: int,
@@ -895,7 +2394,7 @@ class OdkDataset(OdkCentral):
         self,
         projectId: int,
         datasetName: str,
-        url_params: Optional[str] = None,
+        url_params: Optional[str | ODataQuery] = None,
         include_metadata: Optional[bool] = False,
     ) -> dict | list:
         """Get a lightweight JSON of the entity data fields in a dataset.
@@ -965,8 +2464,8 @@ class OdkDataset(OdkCentral):
         Args:
             projectId (int): The ID of the project on ODK Central.
             datasetName (int): The name of a dataset, specific to a project.
-            url_params (str): Any supported OData URL params, such as 'filter'
-                or 'select'. The ? is not required.
+            url_params (str, ODataQuery): Any supported OData URL params, such as
+                'filter' or 'select'. The ? is not required.
             include_metadata (bool): Include additional metadata.
                 If true, returns a dict, if false, returns a list of Entities.
                 If $top is included in url_params, this is enabled by default to get
@@ -977,6 +2476,7 @@ class OdkDataset(OdkCentral):
         """
         url = f"{self.base}projects/{projectId}/datasets/{datasetName}.svc/Entities"
         if url_params:
+            url_params = str(url_params)
             url += f"?{url_params}"
             if "$top" in url_params:
                 # Force enable metadata, as required for pagination
@@ -992,3 +2492,124 @@ class OdkDataset(OdkCentral):
             msg = f"Failed to get Entity data for ODK project ({projectId}): {e}"
             log.error(msg)
             raise aiohttp.ClientError(msg) from e
+
+    async def iterEntityData(
+        self,
+        projectId: int,
+        datasetName: str,
+        select: Optional[list[str]] = None,
+        filter: Optional[str] = None,
+        page_size: int = 1000,
+        buffer: int = 2,
+        query: Optional[ODataQuery] = None,
+    ) -> AsyncIterator[dict]:
+        """Iterate over the entity data in a dataset, paginating automatically.
+
+        Only the selected properties are returned by ODK Central, so for
+        example a map only requiring the geometry and status can use:
+
+        async for entity in odk_dataset.iterEntityData(
+            projectId, "features", select=["__id", "geometry", "status"]
+        ):
+            ...
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            datasetName (int): The name of a dataset, specific to a project.
+            select (list[str]): The properties to include, default all.
+            filter (str): An OData filter expression, such as
+                "__system/updatedAt gt 2024-03-24T07:12:55.871Z"
+            page_size (int): The number of entities per request.
+            buffer (int): The maximum number of pages to fetch ahead.
+            query (ODataQuery): Any other OData params, such as $orderby.
+                The select and filter are added to it. Any $top limits
+                the number of entities returned.
+
+        Returns:
+            AsyncIterator[dict]: Each entity, in the format of getEntityData.
+        """
+        url = f"{self.base}projects/{projectId}/datasets/{datasetName}.svc/Entities"
+        params, limit = pageParams(query.params() if query else None, page_size)
+        if query:
+            if filter and "$filter" in params:
+                filter = f"({params['$filter']}) and ({filter})"
+            if select and "$select" in params:
+                select = [*params["$select"].split(","), *select]
+        if select:
+            params["$select"] = ",".join(select)
+        if filter:
+            params["$filter"] = filter
+
+        async for entity in self.iterOData(url, params, buffer, limit):
+            yield entity
+
+    async def syncEntities(
+        self,
+        projectId: int,
+        datasetName: str,
+        cache: EntityCache,
+        select: Optional[list[str]] = None,
+    ) -> dict:
+        """Update a cache of Entities with only the changes since the last sync.
+
+        The first sync downloads every Entity. After that, only Entities
+        created or updated since the latest '__system/updatedAt' seen are
+        requested, plus any Entities deleted since the latest
+        '__system/deletedAt' seen, so the cost of polling depends on the
+        activity rather than the dataset size. Both are filtered by ODK
+        Central, which must support filtering on '__system/deletedAt'.
+
+        Example, polling for task status changes:
+
+        cache = EntityCache()
+        async with OdkDataset(...) as odk_dataset:
+            changes = await odk_dataset.syncEntities(projectId, "features", cache)
+            status = cache.get(uuid)["status"]
+
+        Args:
+            projectId (int): The ID of the project on ODK Central.
+            datasetName (int): The name of a dataset, specific to a project.
+            cache (EntityCache): The Entity state from the previous sync.
+            select (list[str]): The properties to include, default all.
+                The '__id' and '__system' fields are always included.
+
+        Returns:
+            dict: The UUIDs of the 'updated' and 'deleted' Entities.
+        """
+        if select:
+            select = list(dict.fromkeys(["__id", "__system", *select]))
+        filter = None
+        if cache.lastUpdated:
+            # NOTE ge rather than gt, in case of updates in the same millisecond
+            filter = f"__system/updatedAt ge {cache.lastUpdated} or __system/createdAt ge {cache.lastUpdated}"
+
+        lastUpdated = cache.lastUpdated
+        updated = []
+        async for entity in self.iterEntityData(projectId, datasetName, select=select, filter=filter):
+            system = entity.get("__system", {})
+            changed = max(system.get("createdAt") or "", system.get("updatedAt") or "")
+            if not lastUpdated or changed > lastUpdated:
+                lastUpdated = changed
+            previous = cache.get(entity["__id"])
+            if previous and previous.get("__system", {}).get("version") == system.get("version"):
+                continue
+            updated.append(entity)
+
+        # Deleted Entities are only returned when filtering on deletedAt
+        filter = "__system/deletedAt ne null"
+        if cache.lastDeleted:
+            filter = f"__system/deletedAt ge {cache.lastDeleted}"
+        lastDeleted = cache.lastDeleted
+        deleted = []
+        async for entity in self.iterEntityData(projectId, datasetName, select=["__id", "__system"], filter=filter):
+            deletedAt = entity.get("__system", {}).get("deletedAt")
+            if not deletedAt:
+                continue
+            if not lastDeleted or deletedAt > lastDeleted:
+                lastDeleted = deletedAt
+            if entity["__id"] in cache:
+                deleted.append(entity["__id"])
+
+        cache.update(updated, deleted, lastUpdated, lastDeleted)
+        log.debug(f"Synced dataset ({datasetName}): {len(updated)} updated, {len(deleted)} deleted")
+        return {"updated": [entity["__id"] for entity in updated], "deleted": deleted}
@@ -22,6 +22,8 @@ import argparse
 import logging
 import re
 import sys
+import timeit
+from typing import Iterable, Iterator
 
 import pandas as pd
 
@@ -89,12 +91,62 @@ class Convert(YamlFile):
                         tag = list(entry.keys())[0]
                         vals[tag] = entry[tag]
                 self.convert[key] = vals
-        self.ignore = self.yaml.yaml["ignore"]
-        self.private = self.yaml.yaml["private"]
+        self.ignore = frozenset(self.yaml.yaml["ignore"])
+        self.private = frozenset(self.yaml.yaml["private"])
         if "multiple" in self.yaml.yaml:
             self.multiple = self.yaml.yaml["multiple"]
         else:
             self.multiple = list()
+        self.compile()
+
+    def compile(self):
+        """Precompute the lookup tables used to convert each tag and value.
+
+        Every entry in the convert section is split once here, rather
+        than on every call to convertTag, convertValue or convertMultiple.
+        Call this again after modifying self.convert.
+        """
+        # The OSM tag for each converted ODK tag
+        self.tags = dict()
+        # The OSM tag & value pairs for each ODK value, or None if only the tag is converted
+        self.values = dict()
+        # The OSM tag & value pair for each select_multiple choice, if any
+        self.choices = dict()
+        for key, value in self.convert.items():
+            if type(value) is dict:
+                self.tags[key] = key.lower()
+                self.values[key] = {choice: self.splitValue(key, newval) for choice, newval in value.items()}
+                self.choices[key] = None
+            else:
+                tmp = value.split("=")
+                self.tags[key] = tmp[0].lower()
+                self.values[key] = None
+                self.choices[key] = (tmp[0], tmp[1]) if value.find("=") > 0 else None
+
+    @staticmethod
+    def splitValue(
+        tag: str,
+        value: str | bool,
+    ) -> tuple:
+        """Split a value from the convert section into OSM tags.
+
+        Args:
+            tag (str): The tag the value is for
+            value (str, bool): The value, like "leisure=firepit,amenity=bbq"
+
+        Returns:
+            (tuple): The (tag, value) pairs
+        """
+        if type(value) is bool:
+            return ((tag, "yes" if value else "no"),)
+        pairs = list()
+        for item in value.split(","):
+            tmp = item.split("=")
+            if len(tmp) == 1:
+                pairs.append((tag, value))
+            else:
+                pairs.append((tmp[0], tmp[1]))
+        return tuple(pairs)
 
     def privateData(
         self,
@@ -189,26 +241,19 @@ class Convert(YamlFile):
         Returns:
             (list): The converted values
         """
-        all = list()
-
+        low = tag.lower()
         # If it's not in any conversion data, pass it through unchanged.
-        if tag.lower() in self.ignore:
+        if low in self.ignore:
             # logging.debug(f"FIXME: Ignoring {tag}")
             return None
-        low = tag.lower()
         if value is None:
             return low
 
-        if low not in self.convert and low not in self.ignore and low not in self.private:
+        if low not in self.convert and low not in self.private:
             return {tag: value}
 
-        newtag = tag.lower()
-        newval = value
         # If the tag is in the config file, convert it.
-        if self.convertData(newtag):
-            newtag = self.convertTag(newtag)
-            # if newtag != tag:
-            #    logging.debug(f"Converted Tag for entry {tag} to {newtag}")
+        newtag = self.tags.get(low, low)
 
         # Truncate the elevation, as it's really long
         if newtag == "ele":
@@ -217,15 +262,8 @@ class Convert(YamlFile):
         # logging.debug("Converted Value for entry '%s' to '%s'" % (value, newval))
         # there can be multiple new tag/value pairs for some values from ODK
         if type(newval) == str:
-            all.append({newtag: newval})
-        elif type(newval) == list:
-            for entry in newval:
-                if type(entry) == str:
-                    all.append({newtag: newval})
-                elif type(entry) == dict:
-                    for k, v in entry.items():
-                        all.append({k: v})
-        return all
+            return [{newtag: newval}]
+        return newval
 
     def convertValue(
         self,
@@ -241,35 +279,20 @@ class Convert(YamlFile):
         Returns:
             (list): The converted values
         """
-        all = list()
-
-        vals = self.getValues(tag)
         # There is no conversion data for this tag
-        if vals is None:
+        if tag not in self.values:
             return value
 
-        if type(vals) is dict:
-            if value not in vals:
-                all.append({tag: value})
-                return all
-            if type(vals[value]) is bool:
-                entry = dict()
-                if vals[value]:
-                    entry[tag] = "yes"
-                else:
-                    entry[tag] = "no"
-                all.append(entry)
-                return all
-            for item in vals[value].split(","):
-                entry = dict()
-                tmp = item.split("=")
-                if len(tmp) == 1:
-                    entry[tag] = vals[value]
-                else:
-                    entry[tmp[0]] = tmp[1]
-                    logging.debug("\tValue %s converted value to %s" % (value, entry))
-                all.append(entry)
-        return all
+        vals = self.values[tag]
+        # Only the tag is converted, not the value
+        if vals is None:
+            return list()
+
+        pairs = vals.get(value)
+        if pairs is None:
+            return [{tag: value}]
+        # New dicts every time, as the callers modify them
+        return [{k: v} for k, v in pairs]
 
     def convertTag(
         self,
@@ -284,24 +307,7 @@ class Convert(YamlFile):
             (str): The new tag
         """
         low = tag.lower()
-        if low in self.convert:
-            newtag = self.convert[low]
-            if type(newtag) is str:
-                # logging.debug("\tTag '%s' converted tag to '%s'" % (tag, newtag))
-                tmp = newtag.split("=")
-                if len(tmp) > 1:
-                    newtag = tmp[0]
-            elif type(newtag) is list:
-                logging.error("FIXME: list()")
-                # epdb.st()
-                return low, value
-            elif type(newtag) is dict:
-                # logging.error("FIXME: dict()")
-                return low
-            return newtag.lower()
-        else:
-            logging.debug(f"Not in convert!: {low}")
-            return low
+        return self.tags.get(low, low)
 
     def convertMultiple(
         self,
@@ -318,16 +324,16 @@ class Convert(YamlFile):
         tags = dict()
         for tag in value.split(" "):
             low = tag.lower()
-            if self.convertData(low):
-                newtag = self.convert[low]
-                if newtag.find("=") > 0:
-                    tmp = newtag.split("=")
-                    if tmp[0] in tags:
-                        tags[tmp[0]] = f"{tags[tmp[0]]};{tmp[1]}"
+            if low in self.choices:
+                choice = self.choices[low]
+                if choice:
+                    key, val = choice
+                    if key in tags:
+                        tags[key] = f"{tags[key]};{val}"
                     else:
-                        tags.update({tmp[0]: tmp[1]})
+                        tags[key] = val
             else:
-                tags.update({low: "yes"})
+                tags[low] = "yes"
         # logging.debug(f"\tConverted multiple to {tags}")
         return tags
 
@@ -442,17 +448,33 @@ class Convert(YamlFile):
                         priv[key] = value
                     else:
                         tags[key] = value
-            feature["attrs"] = attrs
-            if len(tags) > 0:
-                # logging.debug(f"TAGS: {tags}")
-                feature["tags"] = tags
-            if len(refs) > 1:
-                feature["refs"] = refs
-            if len(priv) > 0:
-                feature["private"] = priv
+
+        feature["attrs"] = attrs
+        if len(tags) > 0:
+            # logging.debug(f"TAGS: {tags}")
+            feature["tags"] = tags
+        if len(refs) > 1:
+            feature["refs"] = refs
+        if len(priv) > 0:
+            feature["private"] = priv
 
         return feature
 
+    def createEntries(
+        self,
+        entries: Iterable[dict],
+    ) -> Iterator[dict]:
+        """Create the feature data structure for each entry, as it is read.
+
+        Args:
+            entries (Iterable[dict]): The feature data, such as from iterCSV
+
+        Returns:
+            (Iterator[dict]): The OSM data structure for each entry
+        """
+        for entry in entries:
+            yield self.createEntry(entry)
+
     def dump(self):
         """Dump internal data structures, for debugging purposes only."""
         print("YAML file: %s" % self.filespec)
@@ -483,9 +505,9 @@ def main():
     parser.add_argument(
         "-i",
         "--infile",
-        required=True,
         help="The CSV input file",
     )
+    parser.add_argument("-b", "--benchmark", type=int, help="Time this many conversions of every tag and value")
     args = parser.parse_args()
 
     # if verbose, dump to the terminal.
@@ -500,6 +522,20 @@ def main():
     # convert = Convert(args.xform)
     convert = Convert("xforms.yaml")
     print("-----")
+
+    if args.benchmark:
+        entries = [("altitude", "123.4567891"), ("unknown", "value")]
+        for tag, values in convert.convert.items():
+            if type(values) is dict:
+                entries.extend((tag, value) for value in values)
+            else:
+                entries.append((tag, "yes"))
+        choices = " ".join(list(convert.convert.keys())[:20])
+        seconds = timeit.timeit(lambda: [convert.convertEntry(tag, value) for tag, value in entries], number=args.benchmark)
+        print(f"convertEntry: {seconds / args.benchmark / len(entries) * 1e6:.3f}us per call")
+        seconds = timeit.timeit(lambda: convert.convertMultiple(choices), number=args.benchmark)
+        print(f"convertMultiple: {seconds / args.benchmark * 1e6:.3f}us per call")
+        return
     # tag = convert.convertTag("waterpoint_seasonal")
     # entry = convert.convertEntry("waterpoint_seasonal")
     # print("YY: %r" % entry)
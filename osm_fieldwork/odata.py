@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+
+# Copyright (c) Humanitarian OpenStreetMap Team
+#
+# This file is part of OSM-Fieldwork.
+#
+#     OSM-Fieldwork is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     OSM-Fieldwork is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with OSM-Fieldwork.  If not, see <https:#www.gnu.org/licenses/>.
+#
+"""Build the OData URL params for the submission and entity endpoints.
+
+ODK Central filters, selects and pages the OData endpoints on the
+server, so only the rows required are downloaded. For example, today's
+approved submissions, with only the fields a map needs:
+
+query = (
+    ODataQuery()
+    .submittedOn(date.today())
+    .reviewState("approved")
+    .select("__id", "task_id", "xlocation")
+    .orderBy("__system/submissionDate", descending=True)
+)
+submissions = odk_form.listSubmissions(projectId, xform, query)
+
+Which fields can be filtered depends on the Central version, see
+https://docs.getodk.org/central-api-odata-endpoints/#data-document
+"""
+
+import logging
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Optional
+from urllib.parse import quote, urlencode
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+OPERATORS = ("eq", "ne", "gt", "ge", "lt", "le")
+REVIEW_STATES = ("received", "hasIssues", "edited", "approved", "rejected")
+
+
+def literal(value: Any) -> str:
+    """Format a Python value as an OData literal.
+
+    Args:
+        value (Any): A str, int, float, bool, date, datetime or None.
+
+    Returns:
+        (str): The OData literal, with strings quoted and escaped.
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, datetime):
+        if value.tzinfo:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return f"{value.isoformat(timespec='milliseconds')}Z"
+    if isinstance(value, date):
+        return value.isoformat()
+    escaped = str(value).replace("'", "''")
+    return f"'{escaped}'"
+
+
+class ODataQuery(object):
+    """A $filter, $select, $orderby, $top, $skip and $count query.
+
+    Each method returns the query, so calls can be chained. All the
+    filter expressions are combined with 'and', each in parentheses so
+    a raw expression using 'or' keeps its meaning.
+    """
+
+    def __init__(self):
+        """Create an empty query.
+
+        Returns:
+            (ODataQuery): An empty query, which returns everything.
+        """
+        self.filters = list()
+        self.fields = list()
+        self.order = list()
+        self.limit = None
+        self.offset = None
+        self.counted = False
+
+    def filter(
+        self,
+        expression: str,
+    ) -> "ODataQuery":
+        """Add a raw filter expression.
+
+        Args:
+            expression (str): An OData expression, such as
+                "__system/updatedAt gt 2024-03-24T07:12:55.871Z"
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        self.filters.append(expression)
+        return self
+
+    def where(
+        self,
+        field: str,
+        op: str,
+        value: Any,
+    ) -> "ODataQuery":
+        """Compare a field to a value.
+
+        Args:
+            field (str): The field, with groups separated by /
+            op (str): One of eq, ne, gt, ge, lt or le.
+            value (Any): The value, formatted by literal()
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        if op not in OPERATORS:
+            raise ValueError(f"Unsupported OData operator '{op}', use one of {', '.join(OPERATORS)}")
+        return self.filter(f"{field} {op} {literal(value)}")
+
+    def anyOf(
+        self,
+        field: str,
+        values: list,
+    ) -> "ODataQuery":
+        """Match a field against any of several values.
+
+        Args:
+            field (str): The field, with groups separated by /
+            values (list): The values to match.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        if not values:
+            raise ValueError(f"No values to match {field} against")
+        return self.filter(" or ".join(f"{field} eq {literal(value)}" for value in values))
+
+    def between(
+        self,
+        field: str,
+        start: Optional[date | datetime] = None,
+        end: Optional[date | datetime] = None,
+    ) -> "ODataQuery":
+        """Limit a timestamp field to start <= field < end.
+
+        Args:
+            field (str): The timestamp field.
+            start (date, datetime): The earliest time, if any.
+            end (date, datetime): The time to stop before, if any.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        if start is not None:
+            self.where(field, "ge", start)
+        if end is not None:
+            self.where(field, "lt", end)
+        return self
+
+    def submittedBetween(
+        self,
+        start: Optional[date | datetime] = None,
+        end: Optional[date | datetime] = None,
+    ) -> "ODataQuery":
+        """Limit the submissions to those received in a time range.
+
+        Args:
+            start (date, datetime): The earliest submission time, if any.
+            end (date, datetime): The time to stop before, if any.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        return self.between("__system/submissionDate", start, end)
+
+    def submittedOn(
+        self,
+        day: date,
+    ) -> "ODataQuery":
+        """Limit the submissions to those received on a day, in UTC.
+
+        Args:
+            day (date): The day.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        start = datetime.combine(day, time.min)
+        return self.submittedBetween(start, start + timedelta(days=1))
+
+    def reviewState(
+        self,
+        *states: Optional[str],
+    ) -> "ODataQuery":
+        """Limit the submissions to the given review states.
+
+        Submissions that were never reviewed have no review state, so
+        'received' is matched as null.
+
+        Args:
+            states (str): Any of received, hasIssues, edited, approved or rejected.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        for state in states:
+            if state not in REVIEW_STATES and state is not None:
+                raise ValueError(f"Unknown review state '{state}', use one of {', '.join(REVIEW_STATES)}")
+        return self.anyOf("__system/reviewState", [None if state == "received" else state for state in states])
+
+    def submitterId(
+        self,
+        *ids: int,
+    ) -> "ODataQuery":
+        """Limit the submissions to those by the given users or app-users.
+
+        Args:
+            ids (int): The actor IDs of the submitters.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        return self.anyOf("__system/submitterId", list(ids))
+
+    def createdBetween(
+        self,
+        start: Optional[date | datetime] = None,
+        end: Optional[date | datetime] = None,
+    ) -> "ODataQuery":
+        """Limit the entities to those created in a time range.
+
+        Args:
+            start (date, datetime): The earliest creation time, if any.
+            end (date, datetime): The time to stop before, if any.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        return self.between("__system/createdAt", start, end)
+
+    def updatedSince(
+        self,
+        start: date | datetime,
+    ) -> "ODataQuery":
+        """Limit the submissions or entities to those changed since a time.
+
+        Args:
+            start (date, datetime): The earliest update time.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        return self.where("__system/updatedAt", "ge", start)
+
+    def creatorId(
+        self,
+        *ids: int,
+    ) -> "ODataQuery":
+        """Limit the entities to those created by the given users.
+
+        Args:
+            ids (int): The actor IDs of the creators.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        return self.anyOf("__system/creatorId", list(ids))
+
+    def select(
+        self,
+        *fields: str,
+    ) -> "ODataQuery":
+        """Only return these fields.
+
+        Args:
+            fields (str): The fields, with groups separated by /
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        self.fields.extend(field for field in fields if field not in self.fields)
+        return self
+
+    def orderBy(
+        self,
+        field: str,
+        descending: bool = False,
+    ) -> "ODataQuery":
+        """Sort the rows by a field, after any previous sort field.
+
+        Args:
+            field (str): The field to sort on.
+            descending (bool): Sort in descending order.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        self.order.append(f"{field} desc" if descending else field)
+        return self
+
+    def top(
+        self,
+        limit: int,
+    ) -> "ODataQuery":
+        """Return at most this many rows in total.
+
+        In both clients this limits the rows returned. The async
+        iterators still request them in pages of their page_size.
+
+        Args:
+            limit (int): The number of rows.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        self.limit = limit
+        return self
+
+    def skip(
+        self,
+        offset: int,
+    ) -> "ODataQuery":
+        """Skip this many rows.
+
+        Args:
+            offset (int): The number of rows.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        self.offset = offset
+        return self
+
+    def count(
+        self,
+        counted: bool = True,
+    ) -> "ODataQuery":
+        """Include the total number of matching rows as '@odata.count'.
+
+        Args:
+            counted (bool): Whether to include the count.
+
+        Returns:
+            (ODataQuery): This query.
+        """
+        self.counted = counted
+        return self
+
+    def params(self) -> dict[str, str]:
+        """Get the query as URL params.
+
+        Returns:
+            (dict): The OData URL params, such as '$filter'.
+        """
+        params = dict()
+        if self.filters:
+            if len(self.filters) == 1:
+                params["$filter"] = self.filters[0]
+            else:
+                params["$filter"] = " and ".join(f"({clause})" for clause in self.filters)
+        if self.fields:
+            params["$select"] = ",".join(self.fields)
+        if self.order:
+            params["$orderby"] = ",".join(self.order)
+        if self.limit is not None:
+            params["$top"] = str(self.limit)
+        if self.offset is not None:
+            params["$skip"] = str(self.offset)
+        if self.counted:
+            params["$count"] = "true"
+        return params
+
+    def __str__(self) -> str:
+        """The query as a URL query string, without the leading ?."""
+        return urlencode(self.params(), quote_via=quote, safe="$,/'()")
@@ -18,11 +18,13 @@
 #
 
 import argparse
-import glob
 import logging
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
 from pathlib import Path
+from typing import Iterator, Optional
 
 from osm_fieldwork.parsers import ODKParsers
 from osm_fieldwork.support import OutSupport
@@ -30,6 +32,100 @@ from osm_fieldwork.support import OutSupport
 # Instantiate logger
 log = logging.getLogger(__name__)
 
+# The parser for each worker process, see initParser
+instance_parser = None
+
+
+def findInstances(
+    pattern: str,
+) -> list[str]:
+    """Find the XML instance files in the directories matching a wildcard.
+
+    ODK Collect stores each instance in its own directory, along with
+    any photos, so only the .xml file in each directory is returned.
+
+    Args:
+        pattern (str): The instance directories, like "instances/buildings*"
+
+    Returns:
+        (list[str]): The instance files, sorted by directory name
+    """
+    top, _, wildcard = pattern.rpartition("/")
+    xmlfiles = list()
+    with os.scandir(top or ".") as directories:
+        for directory in directories:
+            if not directory.is_dir() or not fnmatch(directory.name, wildcard):
+                continue
+            with os.scandir(directory.path) as files:
+                for file in files:
+                    if file.name.endswith(".xml") and file.is_file():
+                        xmlfiles.append(file.path)
+                        break
+    xmlfiles.sort()
+    return xmlfiles
+
+
+def initParser(
+    yaml: Optional[str] = None,
+    xlsfile: Optional[str] = None,
+):
+    """Load the config once for each worker process.
+
+    Args:
+        yaml (str): Alternate YAML file
+        xlsfile (str): Source XLSFile
+    """
+    global instance_parser
+    instance_parser = ODKParsers(yaml)
+    instance_parser.parseXLS(xlsfile)
+
+
+def parseInstance(
+    filespec: str,
+) -> dict:
+    """Convert an XML instance file to an OSM feature, in a worker process.
+
+    Args:
+        filespec (str): The XML instance file
+
+    Returns:
+        (dict): The OSM data structure for the instance
+    """
+    return instance_parser.createEntry(instance_parser.XMLparser(filespec)[0])
+
+
+def parseInstances(
+    xmlfiles: list[str],
+    yaml: Optional[str] = None,
+    xlsfile: Optional[str] = None,
+    processes: Optional[int] = None,
+    chunksize: int = 64,
+) -> Iterator[dict]:
+    """Convert many XML instance files in parallel.
+
+    The files are parsed in chunks by a pool of processes, and the
+    features are returned in the same order as the files.
+
+    Args:
+        xmlfiles (list[str]): The XML instance files
+        yaml (str): Alternate YAML file
+        xlsfile (str): Source XLSFile
+        processes (int): The number of processes, default the number of CPUs.
+            With 1, the files are parsed in this process.
+        chunksize (int): The number of files sent to a process at a time
+
+    Returns:
+        (Iterator[dict]): The OSM data structure for each instance
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        initParser(yaml, xlsfile)
+        yield from map(parseInstance, xmlfiles)
+        return
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=initParser, initargs=(yaml, xlsfile)) as pool:
+        yield from pool.map(parseInstance, xmlfiles, chunksize=chunksize)
+
 
 def main():
     """This is a program that reads in the ODK Instance file, which is in XML,
@@ -40,6 +136,13 @@ def main():
     parser.add_argument("-y", "--yaml", help="Alternate YAML file")
     parser.add_argument("-x", "--xlsfile", help="Source XLSFile")
     parser.add_argument("-i", "--infile", required=True, help="The input file")
+    parser.add_argument("-p", "--processes", type=int, help="Number of processes for XML instance files")
+    parser.add_argument("-c", "--columnar", action="store_true", help="Convert CSV files a column at a time using pandas")
+    parser.add_argument(
+        "-g", "--geojson", default="geojson", choices=["geojson", "geojsonseq", "ndjson"], help="The GeoJSON output format"
+    )
+    parser.add_argument("-f", "--format", default="osm", choices=["osm", "pbf"], help="The OSM output format, OSM XML or PBF")
+    parser.add_argument("--geoparquet", action="store_true", help="Also write a GeoParquet file, which needs pyarrow")
     # parser.add_argument("-o","--outfile", default='tmp.csv', help='The output file for JOSM')
     args = parser.parse_args()
 
@@ -58,18 +161,13 @@ def main():
     out = OutSupport()
     xmlfiles = list()
     data = list()
+    # The CSV and JSON features are converted and written one at a time
     # It's a wildcard, used for XML instance files
     if args.infile.find("*") >= 0:
         log.debug(f"Parsing multiple ODK XML files {args.infile}")
         toplevel = Path(args.infile[:-1])
-        for dirs in glob.glob(args.infile):
-            xml = os.listdir(dirs)
-            full = os.path.join(dirs, xml[0])
-            xmlfiles.append(full)
-        for infile in xmlfiles:
-            tmp = odk.XMLparser(infile)
-            entry = odk.createEntry(tmp[0])
-            data.append(entry)
+        xmlfiles = findInstances(args.infile)
+        data = parseInstances(xmlfiles, args.yaml, args.xlsfile, args.processes)
     elif toplevel.suffix == ".xml":
         # It's an instance file from ODK Collect
         log.debug(f"Parsing ODK XML files {args.infile}")
@@ -78,19 +176,21 @@ def main():
         xmlfiles.append(full + ".xml")
         tmp = odk.XMLparser(args.infile)
         # odki = ODKInstance(filespec=args.infile, yaml=args.yaml)
-        entry = odk.createEntry(tmp)
+        entry = odk.createEntry(tmp[0])
         data.append(entry)
     elif toplevel.suffix == ".csv":
         log.debug(f"Parsing csv files {args.infile}")
-        for entry in odk.CSVparser(args.infile):
-            data.append(odk.createEntry(entry))
+        if args.columnar:
+            frames = odk.iterCSVFrames(args.infile)
+            data = odk.createEntries(row for frame in frames for row in odk.iterFrameRows(frame))
+        else:
+            data = odk.createEntries(odk.iterCSV(args.infile))
     elif toplevel.suffix == ".json":
         log.debug(f"Parsing json files {args.infile}")
-        for entry in odk.JSONparser(args.infile):
-            data.append(odk.createEntry(entry))
+        data = odk.createEntries(odk.iterJSON(args.infile))
 
     # Write the data
-    out.WriteData(toplevel.stem, data)
+    out.WriteData(toplevel.stem, data, geojson=args.geojson, osm=args.format, geoparquet=args.geoparquet)
 
 
 if __name__ == "__main__":
@@ -18,18 +18,96 @@
 
 import argparse
 import logging
-import os
+import re
 import sys
+import time
 from datetime import datetime
+from itertools import islice
 from sys import argv
+from typing import Any, Iterable
+from xml.etree import ElementTree
 
-import xmltodict
-
-from osm_fieldwork.convert import Convert, escape
+from osm_fieldwork.convert import Convert
 
 # Instantiate logger
 log = logging.getLogger(__name__)
 
+# The characters to escape in the values of the single quoted XML attributes
+XML_SPECIAL = re.compile("[&<>'\"\n\r\t]")
+XML_ESCAPES = {
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    "'": "&apos;",
+    '"': "&quot;",
+    "\n": "&#10;",
+    "\r": "&#13;",
+    "\t": "&#9;",
+}
+# The size of the output buffer, so features are written in large blocks
+WRITE_BUFFER = 1048576
+
+
+def xmlEscape(
+    value: Any,
+) -> str:
+    """Escape a value for use in an XML attribute.
+
+    Args:
+        value (Any): The value, converted to a string first
+
+    Returns:
+        (str): The escaped string
+    """
+    value = str(value)
+    # Most values don't need escaping, so check before replacing anything
+    if XML_SPECIAL.search(value) is None:
+        return value
+    return XML_SPECIAL.sub(lambda match: XML_ESCAPES[match.group()], value)
+
+
+def xmlAttributes(
+    attrs: dict,
+) -> str:
+    """Format the attributes of an OSM XML element.
+
+    Args:
+        attrs (dict): The attribute names and values
+
+    Returns:
+        (str): The attributes, with single quoted values
+    """
+    values = [str(value) for value in attrs.values()]
+    # Search all the values at once, as most don't need escaping
+    if XML_SPECIAL.search("".join(values)) is not None:
+        values = [xmlEscape(value) for value in values]
+    return " ".join([f"{ref}='{value}'" for ref, value in zip(attrs, values, strict=True)])
+
+
+def xmlTags(
+    tags: list[tuple[str, str]],
+) -> list[str]:
+    """Format the tag elements of an OSM XML node or way.
+
+    Args:
+        tags (list): The key and value of each tag
+
+    Returns:
+        (list): The tag elements
+    """
+    if XML_SPECIAL.search("".join([key + value for key, value in tags])) is not None:
+        tags = [(xmlEscape(key), xmlEscape(value)) for key, value in tags]
+    return [f"    <tag k='{key}' v='{value}'/>" for key, value in tags]
+
+
+def timestamp() -> str:
+    """Get the current time in the format used by OSM XML.
+
+    Returns:
+        (str): The timestamp
+    """
+    return datetime.now().strftime("%Y-%m-%dT%TZ")
+
 
 class OsmFile(object):
     """OSM File output."""
@@ -61,7 +139,7 @@ class OsmFile(object):
         # Open the OSM output file
         self.file = None
         if filespec is not None:
-            self.file = open(filespec, "w")
+            self.file = open(filespec, "w", buffering=WRITE_BUFFER)
             # self.file = open(filespec + ".osm", 'w')
             logging.info("Opened output file: " + filespec)
         self.header()
@@ -77,7 +155,7 @@ class OsmFile(object):
         self.start = -1
         # path = xlsforms_path.replace("xlsforms", "")
         self.convert = Convert()
-        self.data = list()
+        self.data = dict()
 
     def __del__(self):
         """Close the OSM XML file automatically."""
@@ -122,22 +200,50 @@ class OsmFile(object):
         else:
             self.file.write("%s\n" % data)
 
+    def writeFeatures(
+        self,
+        features: Iterable[dict],
+        modified: bool = False,
+    ) -> int:
+        """Write a batch of nodes and ways to the OSM XML file.
+
+        The features in a batch share the same timestamp, and are
+        written with a single call.
+
+        Args:
+            features (Iterable[dict]): The nodes, and ways with refs
+            modified (bool): Are these modified features ?
+
+        Returns:
+            (int): The number of features written
+        """
+        now = timestamp()
+        out = [
+            self.createWay(feature, modified, now) if "refs" in feature else self.createNode(feature, modified, now)
+            for feature in features
+        ]
+        if out:
+            self.file.write("\n".join(out))
+            self.file.write("\n")
+        return len(out)
+
     def createWay(
         self,
         way: dict,
         modified: bool = False,
+        now: str = None,
     ):
         """This creates a string that is the OSM representation of a node.
 
         Args:
             way (dict): The input way data structure
             modified (bool): Is this a modified feature ?
+            now (str): The timestamp, instead of the current time
 
         Returns:
             (str): The OSM XML entry
         """
         attrs = dict()
-        osm = ""
 
         # Add default attributes
         if modified:
@@ -155,7 +261,7 @@ class OsmFile(object):
             attrs["version"] = 1
         else:
             attrs["version"] = way["attrs"]["version"]
-        attrs["timestamp"] = datetime.now().strftime("%Y-%m-%dT%TZ")
+        attrs["timestamp"] = now or timestamp()
         # If the resulting file is publicly accessible without authentication, The GDPR applies
         # and the identifying fields should not be included
         if "uid" in way["attrs"]:
@@ -194,30 +300,20 @@ class OsmFile(object):
         #     loop += 1
 
         # Processs atrributes
-        line = ""
-        for ref, value in attrs.items():
-            line += "%s=%r " % (ref, str(value))
-        osm += "  <way " + line + ">"
+        osm = [f"  <way {xmlAttributes(attrs)} >"]
 
         if "refs" in way:
-            for ref in way["refs"]:
-                osm += '\n    <nd ref="%s"/>' % ref
+            osm.extend([f'    <nd ref="{ref}"/>' for ref in way["refs"]])
         if "tags" in way:
-            for key, value in way["tags"].items():
-                if value is None:
-                    continue
-                if key == "track":
-                    continue
-                if key not in attrs:
-                    newkey = escape(key)
-                    newval = escape(str(value))
-                    osm += f"\n    <tag k='{newkey}' v='{newval}'/>"
+            tags = [
+                (key, str(value)) for key, value in way["tags"].items() if value is not None and key != "track" and key not in attrs
+            ]
+            osm.extend(xmlTags(tags))
             if modified:
-                osm += '\n    <tag k="note" v="Do not upload this without validation!"/>'
-            osm += "\n"
-        osm += "  </way>\n"
+                osm.append('    <tag k="note" v="Do not upload this without validation!"/>')
+        osm.append("  </way>\n")
 
-        return osm
+        return "\n".join(osm)
 
     def featureToNode(
         self,
@@ -251,12 +347,14 @@ class OsmFile(object):
         self,
         node: dict,
         modified: bool = False,
+        now: str = None,
     ):
         """This creates a string that is the OSM representation of a node.
 
         Args:
             node (dict): The input node data structure
             modified (bool): Is this a modified feature ?
+            now (str): The timestamp, instead of the current time
 
         Returns:
             (str): The OSM XML entry
@@ -277,7 +375,7 @@ class OsmFile(object):
             attrs["version"] = int(node["attrs"]["version"]) + 1
         attrs["lat"] = node["attrs"]["lat"]
         attrs["lon"] = node["attrs"]["lon"]
-        attrs["timestamp"] = datetime.now().strftime("%Y-%m-%dT%TZ")
+        attrs["timestamp"] = now or timestamp()
         # If the resulting file is publicly accessible without authentication, THE GDPR applies
         # and the identifying fields should not be included
         if "uid" in node["attrs"]:
@@ -286,26 +384,14 @@ class OsmFile(object):
             attrs["user"] = node["attrs"]["user"]
 
         # Processs atrributes
-        line = ""
-        osm = ""
-        for ref, value in attrs.items():
-            line += "%s=%r " % (ref, str(value))
-        osm += "  <node " + line
+        line = xmlAttributes(attrs)
 
         if "tags" in node:
-            osm += ">"
-            for key, value in node["tags"].items():
-                if not value:
-                    continue
-                if key not in attrs:
-                    newkey = escape(key)
-                    newval = escape(str(value))
-                    osm += f"\n    <tag k='{newkey}' v='{newval}'/>"
-            osm += "\n  </node>\n"
-        else:
-            osm += "/>"
+            tags = [(key, str(value)) for key, value in node["tags"].items() if value and key not in attrs]
+            osm = [f"  <node {line} >", *xmlTags(tags), "  </node>\n"]
+            return "\n".join(osm)
 
-        return osm
+        return f"  <node {line} />"
 
     def createTag(
         self,
@@ -342,69 +428,61 @@ class OsmFile(object):
     ):
         """Read a OSM XML file generated by osm_fieldwork.
 
+        The file is parsed one element at a time, and each element is
+        cleared once it's been read, so large files can be loaded.
+
         Args:
             osmfile (str): The OSM XML file to load
 
         Returns:
-            (list): The entries in the OSM XML file
+            (dict): The nodes and ways in the OSM XML file, indexed by
+                the element type and ID, as nodes and ways can share an ID
         """
-        size = os.path.getsize(osmfile)
-        with open(osmfile, "r") as file:
-            xml = file.read(size)
-            doc = xmltodict.parse(xml)
-            if "osm" not in doc:
-                logging.warning("No data in this instance")
-                return False
-            data = doc["osm"]
-            if "node" not in data:
-                logging.warning("No nodes in this instance")
-                return False
-
-        for node in data["node"]:
-            attrs = {
-                "id": int(node["@id"]),
-                "lat": node["@lat"][:10],
-                "lon": node["@lon"][:10],
-            }
-            if "@timestamp" in node:
-                attrs["timestamp"] = node["@timestamp"]
-
-            tags = dict()
-            if "tag" in node:
-                for tag in node["tag"]:
-                    if type(tag) == dict:
-                        tags[tag["@k"]] = tag["@v"].strip()
-                        # continue
-                    else:
-                        tags[node["tag"]["@k"]] = node["tag"]["@v"].strip()
-                    # continue
-            node = {"attrs": attrs, "tags": tags}
-            self.data.append(node)
-
-        for way in data["way"]:
-            attrs = {
-                "id": int(way["@id"]),
-            }
-            refs = list()
-            if len(way["nd"]) > 0:
-                for ref in way["nd"]:
-                    refs.append(int(ref["@ref"]))
-
-            if "@timestamp" in node:
-                attrs["timestamp"] = node["@timestamp"]
-
-            tags = dict()
-            if "tag" in way:
-                for tag in way["tag"]:
-                    if type(tag) == dict:
-                        tags[tag["@k"]] = tag["@v"].strip()
-                        # continue
-                    else:
-                        if len(node["tags"]) > 0:
-                            tags[node["tags"]["@k"]] = node["tags"]["@v"].strip()
-                    # continue
-            way = {"attrs": attrs, "refs": refs, "tags": tags}
-            self.data.append(way)
+        self.data = dict()
+        root = None
+        nodes = 0
+        try:
+            for event, element in ElementTree.iterparse(osmfile, events=("start", "end")):
+                if root is None:
+                    root = element
+                    if root.tag != "osm":
+                        break
+                    continue
+                if event != "end" or element.tag not in ("node", "way"):
+                    continue
+                tags = dict()
+                refs = list()
+                for child in element:
+                    if child.tag == "tag":
+                        tags[child.get("k")] = child.get("v", "").strip()
+                    elif child.tag == "nd":
+                        refs.append(int(child.get("ref")))
+                attrs = {"id": int(element.get("id"))}
+                if element.tag == "node":
+                    attrs["lat"] = element.get("lat")[:10]
+                    attrs["lon"] = element.get("lon")[:10]
+                    feature = {"attrs": attrs, "tags": tags}
+                    nodes += 1
+                else:
+                    feature = {"attrs": attrs, "refs": refs, "tags": tags}
+                if "timestamp" in element.attrib:
+                    attrs["timestamp"] = element.get("timestamp")
+                key = (element.tag, attrs["id"])
+                if key in self.data:
+                    log.warning(f"Duplicate {element.tag} ID {attrs['id']} in {osmfile}")
+                self.data[key] = feature
+                # Only the current element is kept in memory
+                root.clear()
+        except ElementTree.ParseError as e:
+            log.error(f"Couldn't parse {osmfile}: {e}")
+            return False
+
+        if root is None or root.tag != "osm":
+            logging.warning("No data in this instance")
+            return False
+        if nodes == 0:
+            logging.warning("No nodes in this instance")
+            return False
 
         return self.data
 
@@ -418,27 +496,30 @@ class OsmFile(object):
 
     def getFeature(
         self,
+        osmtype: str,
         id: int,
     ):
         """Get the data for a feature from the loaded OSM data file.
 
         Args:
+            osmtype (str): The element type, node or way
             id (int): The ID to retrieve the feasture of
 
         Returns:
-            (dict): The feature for this ID or None
+            (dict): The feature for this type and ID or None
         """
-        return self.data[id]
+        return self.data.get((osmtype, id))
 
     def getFields(self):
-        """Extract all the tags used in this file."""
-        fields = list()
+        """Extract all the tags used in this file.
+
+        Returns:
+            (list): The tag keys, in the order they were first used
+        """
+        fields = dict()
         for _id, item in self.data.items():
-            keys = list(item["tags"].keys())
-            for key in keys:
-                if key not in fields:
-                    fields.append(key)
-        # print(fields)
+            fields.update(dict.fromkeys(item["tags"]))
+        return list(fields)
 
 
 if __name__ == "__main__":
@@ -447,6 +528,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="This program conflates ODK data with existing features from OSM.")
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
     parser.add_argument("-o", "--osmfile", required=True, help="OSM XML file created by Osm-Fieldwork")
+    parser.add_argument("-b", "--benchmark", type=int, help="Time writing this many nodes to the OSM XML file")
     args = parser.parse_args()
 
     # This program needs options to actually do anything
@@ -463,6 +545,23 @@ if __name__ == "__main__":
             stream=sys.stdout,
         )
 
+    if args.benchmark:
+        osm = OsmFile(args.osmfile)
+        nodes = (
+            {
+                "attrs": {"lat": f"38.{index:07d}", "lon": f"-106.{index:07d}", "uid": "17", "user": "rob"},
+                "tags": {"amenity": "restaurant", "name": f"Tomichi Creek Trading Post #{index}", "cuisine": "burger"},
+            }
+            for index in range(args.benchmark)
+        )
+        start = time.perf_counter()
+        while osm.writeFeatures(islice(nodes, 1000)):
+            pass
+        osm.footer()
+        seconds = time.perf_counter() - start
+        print(f"Wrote {args.benchmark} nodes in {seconds:.2f}s, {args.benchmark / seconds:.0f} nodes per second")
+        quit()
+
     osm = OsmFile()
     osm.loadFile(args.osmfile)
     osm.dump()
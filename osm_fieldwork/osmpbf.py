@@ -0,0 +1,376 @@
+#!/usr/bin/python3
+
+# Copyright (c) Humanitarian OpenStreetMap Team
+#
+# This file is part of OSM-Fieldwork.
+#
+#     OSM-Fieldwork is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     OSM-Fieldwork is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with OSM-Fieldwork.  If not, see <https:#www.gnu.org/licenses/>.
+#
+"""Write the converted features as an OSM PBF file.
+
+OSM PBF is much smaller and faster to load than OSM XML, and is read
+by JOSM (with the pbf plugin), osmium and most OSM tools. Only a few
+simple protobuf messages are needed, so they are encoded here rather
+than adding a protobuf dependency. See
+https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+import logging
+import struct
+import zlib
+from datetime import datetime, timezone
+from typing import Callable, Iterable
+
+from osm_fieldwork.osmfile import timestamp
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# The most entities the format allows in one block
+BLOCK_SIZE = 8000
+# Coordinates are stored in units of 100 nanodegrees, the default granularity
+COORDINATE_SCALE = 10000000
+# The attributes written by OsmFile, which aren't also written as tags
+OSM_ATTRS = frozenset(("action", "id", "version", "lat", "lon", "timestamp", "uid", "user"))
+# The varints for the small numbers, which are most of them
+SMALL_VARINTS = [bytes((value,)) for value in range(128)]
+
+
+def varint(
+    value: int,
+) -> bytes:
+    """Encode an unsigned or int64 value as a protobuf varint.
+
+    Args:
+        value (int): The value, negative values are encoded in 64 bits
+
+    Returns:
+        (bytes): The varint
+    """
+    if 0 <= value < 128:
+        return SMALL_VARINTS[value]
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(
+    value: int,
+) -> int:
+    """Map a signed value to an unsigned one for a sint field.
+
+    Args:
+        value (int): The signed value
+
+    Returns:
+        (int): The zigzag encoded value
+    """
+    return (value << 1) ^ (value >> 63)
+
+
+def lengthDelimited(
+    number: int,
+    data: bytes,
+) -> bytes:
+    """Encode a bytes, string or embedded message field.
+
+    Args:
+        number (int): The field number
+        data (bytes): The encoded value
+
+    Returns:
+        (bytes): The field
+    """
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+def integer(
+    number: int,
+    value: int,
+) -> bytes:
+    """Encode an int32, int64 or uint field.
+
+    Args:
+        number (int): The field number
+        value (int): The value
+
+    Returns:
+        (bytes): The field
+    """
+    return varint(number << 3) + varint(value)
+
+
+def packed(
+    number: int,
+    values: Iterable[int],
+) -> bytes:
+    """Encode a packed repeated int field.
+
+    Args:
+        number (int): The field number
+        values (Iterable[int]): The values, already zigzag encoded for sint fields
+
+    Returns:
+        (bytes): The field
+    """
+    return lengthDelimited(number, b"".join([varint(value) for value in values]))
+
+
+def deltas(
+    values: list[int],
+) -> list[int]:
+    """Delta and zigzag encode a list of values, for a packed sint field.
+
+    Args:
+        values (list[int]): The values
+
+    Returns:
+        (list[int]): The encoded differences
+    """
+    previous = 0
+    encoded = list()
+    for value in values:
+        encoded.append(zigzag(value - previous))
+        previous = value
+    return encoded
+
+
+class OsmPbfFile(object):
+    """OSM PBF file output, with the same writeFeatures() as OsmFile."""
+
+    def __init__(
+        self,
+        filespec: str,
+        compression: int = 6,
+    ):
+        """Open the file and write the header block.
+
+        Args:
+            filespec (str): The output file
+            compression (int): The zlib compression level of each block
+
+        Returns:
+            (OsmPbfFile): An instance of this object
+        """
+        self.file = open(filespec, "wb")
+        self.compression = compression
+        # The IDs for new features, the same as OsmFile
+        self.start = -1
+        header = b"".join(
+            [
+                lengthDelimited(4, b"OsmSchema-V0.6"),
+                lengthDelimited(4, b"DenseNodes"),
+                lengthDelimited(16, b"osm-fieldwork"),
+            ]
+        )
+        self.writeBlob("OSMHeader", header)
+        logging.info("Opened output file: " + filespec)
+
+    def __del__(self):
+        """Close the OSM PBF file automatically."""
+        self.footer()
+
+    def footer(self):
+        """Close the OSM PBF file, which has no footer."""
+        if getattr(self, "file", None) is not None:
+            self.file.close()
+        self.file = None
+
+    def writeBlob(
+        self,
+        kind: str,
+        data: bytes,
+    ):
+        """Compress a block and write it with its header.
+
+        Args:
+            kind (str): OSMHeader or OSMData
+            data (bytes): The encoded HeaderBlock or PrimitiveBlock
+        """
+        blob = integer(2, len(data)) + lengthDelimited(3, zlib.compress(data, self.compression))
+        header = lengthDelimited(1, kind.encode()) + integer(3, len(blob))
+        self.file.write(struct.pack(">I", len(header)))
+        self.file.write(header)
+        self.file.write(blob)
+
+    def writeFeatures(
+        self,
+        features: Iterable[dict],
+        modified: bool = False,
+    ) -> int:
+        """Write a batch of nodes and ways to the OSM PBF file.
+
+        The features in a batch share the same timestamp. PBF has no
+        action attribute, so modified is ignored.
+
+        Args:
+            features (Iterable[dict]): The nodes, and ways with refs
+            modified (bool): Are these modified features ?
+
+        Returns:
+            (int): The number of features written
+        """
+        features = list(features)
+        for index in range(0, len(features), BLOCK_SIZE):
+            self.writeBlob("OSMData", self.encodeBlock(features[index : index + BLOCK_SIZE]))
+        return len(features)
+
+    def encodeBlock(
+        self,
+        features: list[dict],
+    ) -> bytes:
+        """Encode nodes and ways as a PrimitiveBlock.
+
+        Args:
+            features (list[dict]): The nodes, and ways with refs
+
+        Returns:
+            (bytes): The encoded PrimitiveBlock
+        """
+        now = timestamp()
+        seconds = int(datetime.strptime(now, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp())
+        # The string table, the first entry is always empty
+        strings = {"": 0}
+
+        def sid(value: str) -> int:
+            index = strings.get(value)
+            if index is None:
+                index = strings[value] = len(strings)
+            return index
+
+        ids = list()
+        lats = list()
+        lons = list()
+        keys_vals = list()
+        versions = list()
+        uids = list()
+        users = list()
+        ways = list()
+        for feature in features:
+            attrs = feature["attrs"]
+            user = sid(str(attrs["user"])) if "user" in attrs else 0
+            uid = int(attrs["uid"]) if str(attrs.get("uid", "")).isdigit() else 0
+            if "refs" in feature:
+                way = self.encodeWay(feature, sid, seconds, uid, user)
+                ways.append(lengthDelimited(3, way))
+                continue
+            try:
+                lat = round(float(attrs["lat"]) * COORDINATE_SCALE)
+                lon = round(float(attrs["lon"]) * COORDINATE_SCALE)
+            except (KeyError, ValueError):
+                log.warning("Bad location data in entry! %r", attrs)
+                continue
+            if "id" in attrs:
+                ids.append(int(attrs["id"]))
+            else:
+                ids.append(self.start)
+                self.start -= 1
+            versions.append(1 if "version" not in attrs else int(attrs["version"]) + 1)
+            lats.append(lat)
+            lons.append(lon)
+            uids.append(uid)
+            users.append(user)
+            for key, value in feature.get("tags", dict()).items():
+                if not value or key in OSM_ATTRS:
+                    continue
+                keys_vals.append(sid(key))
+                keys_vals.append(sid(str(value)))
+            keys_vals.append(0)
+
+        groups = list()
+        if ids:
+            info = b"".join(
+                [
+                    packed(1, versions),
+                    packed(2, deltas([seconds] * len(ids))),
+                    packed(3, [0] * len(ids)),
+                    packed(4, deltas(uids)),
+                    packed(5, deltas(users)),
+                ]
+            )
+            dense = b"".join(
+                [
+                    packed(1, deltas(ids)),
+                    lengthDelimited(5, info),
+                    packed(8, deltas(lats)),
+                    packed(9, deltas(lons)),
+                    packed(10, keys_vals),
+                ]
+            )
+            groups.append(lengthDelimited(2, lengthDelimited(2, dense)))
+        if ways:
+            groups.append(lengthDelimited(2, b"".join(ways)))
+
+        table = b"".join([lengthDelimited(1, value.encode()) for value in strings])
+        return lengthDelimited(1, table) + b"".join(groups)
+
+    def encodeWay(
+        self,
+        way: dict,
+        sid: Callable[[str], int],
+        seconds: int,
+        uid: int,
+        user: int,
+    ) -> bytes:
+        """Encode a way, with the same attributes and tags as OsmFile.createWay().
+
+        Args:
+            way (dict): The way, with the node IDs in refs
+            sid (callable): Get the string table index of a string
+            seconds (int): The timestamp of the batch
+            uid (int): The user ID
+            user (int): The string table index of the user name
+
+        Returns:
+            (bytes): The encoded Way
+        """
+        attrs = way["attrs"]
+        if "osm_way_id" in attrs:
+            osm_id = int(attrs["osm_way_id"])
+        elif "osm_id" in attrs:
+            osm_id = int(attrs["osm_id"])
+        elif "id" in attrs:
+            osm_id = int(attrs["id"])
+        else:
+            osm_id = self.start
+            self.start -= 1
+        keys = list()
+        vals = list()
+        for key, value in way.get("tags", dict()).items():
+            if value is None or key == "track" or key in OSM_ATTRS:
+                continue
+            keys.append(sid(key))
+            vals.append(sid(str(value)))
+        info = b"".join(
+            [
+                integer(1, int(attrs.get("version", 1))),
+                integer(2, seconds),
+                integer(3, 0),
+                integer(4, uid),
+                integer(5, user),
+            ]
+        )
+        return b"".join(
+            [
+                integer(1, osm_id),
+                packed(2, keys),
+                packed(3, vals),
+                lengthDelimited(4, info),
+                packed(8, deltas([int(ref) for ref in way.get("refs", list())])),
+            ]
+        )
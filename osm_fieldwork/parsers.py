@@ -21,20 +21,110 @@
 import csv
 import json
 import logging
-import os
 import re
+from io import BytesIO, StringIO
 from pathlib import Path
+from typing import IO, Any, Iterable, Iterator
+from xml.etree import ElementTree
 
-import flatdict
-import xmltodict
+import pandas as pd
 
 from osm_fieldwork.convert import Convert
-from osm_fieldwork.support import basename
+from osm_fieldwork.support import FieldPlan
 from osm_fieldwork.xlsforms import xlsforms_path
 
 # Instantiate logger
 log = logging.getLogger(__name__)
 
+# The start of the list of rows in an OData or GeoJSON file
+ROWS_START = re.compile(r'"(value|features)"\s*:\s*\[')
+# Files with one JSON row per line
+NDJSON_SUFFIXES = (".ndjson", ".jsonl", ".geojsons", ".geojsonl", ".geojsonseq")
+# A GPS location from ODK Collect, "lat lon altitude accuracy"
+GPS_VALUE = re.compile("[0-9.]* [0-9.-]* [0-9.]* [0-9.]*")
+
+
+def flatten(
+    data: dict,
+) -> Iterator[tuple[str, Any]]:
+    """Flatten the groups in a row, keyed by the last part of the path.
+
+    This gives the same keys and values as flatdict.FlatDict(data),
+    but without creating the full path for each key.
+
+    Args:
+        data (dict): The row, with any nested groups
+
+    Returns:
+        (Iterator[tuple]): Each key and value
+    """
+    for key, value in data.items():
+        if isinstance(value, dict) and value:
+            yield from flatten(value)
+        else:
+            yield key[key.rfind(":") + 1 :], value
+
+
+def iterJSONRows(
+    file: IO[str],
+    chunk_size: int = 1048576,
+) -> Iterator[Any]:
+    """Read the rows of a JSON file one at a time.
+
+    The rows are the 'value' list of an OData file from ODK Central,
+    the 'features' of a GeoJSON file, or a top level list. Only the
+    current row, plus a chunk of the file, is held in memory.
+
+    Args:
+        file (IO[str]): The open JSON file
+        chunk_size (int): The number of characters to read at a time
+
+    Returns:
+        (Iterator[Any]): Each row
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size)
+    eof = len(buffer) < chunk_size
+
+    start = buffer.lstrip()
+    if start.startswith("["):
+        pos = len(buffer) - len(start) + 1
+    else:
+        # Read until the start of the rows is found
+        match = ROWS_START.search(buffer)
+        while not match and not eof:
+            more = file.read(chunk_size)
+            eof = len(more) < chunk_size
+            buffer += more
+            match = ROWS_START.search(buffer)
+        if not match:
+            # Not a list of rows, so treat the whole thing as one row
+            yield json.loads(buffer)
+            return
+        pos = match.end()
+
+    while True:
+        # Skip to the start of the next row
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            row, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = len(buffer)
+        if end == len(buffer) and not eof:
+            # The row may continue in the next chunk
+            more = file.read(chunk_size)
+            eof = len(more) < chunk_size
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+        yield row
+        pos = end
+
 
 class ODKParsers(Convert):
     """A class to parse the CSV files from ODK Central."""
@@ -74,65 +164,204 @@ class ODKParsers(Convert):
         Returns:
             (list): The list of features with tags
         """
-        all_tags = list()
+        return list(self.iterCSV(filespec, data))
+
+    def iterCSV(
+        self,
+        filespec: str,
+        data: str = None,
+    ) -> Iterator[dict]:
+        """Parse the CSV file from ODK Central one row at a time.
+
+        Unlike CSVparser, only the current row is held in memory, so
+        large exports can be converted and written as they are read.
+
+        Args:
+            filespec (str): The file to parse.
+            data (str): Or the data to parse.
+
+        Returns:
+            (Iterator[dict]): The tags for each feature
+        """
         if not data:
-            f = open(filespec, newline="")
-            reader = csv.DictReader(f, delimiter=",")
+            with open(filespec, newline="") as f:
+                yield from self.iterCSVRows(csv.DictReader(f, delimiter=","))
         else:
-            reader = csv.DictReader(data, delimiter=",")
+            yield from self.iterCSVRows(csv.DictReader(data, delimiter=","))
+
+    def iterCSVRows(
+        self,
+        reader: csv.DictReader,
+    ) -> Iterator[dict]:
+        """Convert each row of a CSV file.
+
+        Args:
+            reader (csv.DictReader): The CSV rows.
+
+        Returns:
+            (Iterator[dict]): The tags for each feature
+        """
+        # The header is only resolved once for the whole file
+        plan = FieldPlan(self, lower=True).plan(reader.fieldnames or ())
         for row in reader:
             tags = dict()
-            # log.info(f"ROW: {row}")
-            for keyword, value in row.items():
-                if keyword is None or value is None:
-                    continue
-                if len(value) == 0:
-                    continue
-                base = basename(keyword).lower()
+            for keyword, base, kind in plan:
+                value = row[keyword]
                 # There's many extraneous fields in the input file which we don't need.
-                if base is None or base in self.ignore or value is None:
+                if not value:
                     continue
+                if kind == FieldPlan.MULTIPLE:
+                    tags.update(self.convertMultiple(value))
+                    continue
+                if kind == FieldPlan.PASS:
+                    items = {base: value}
                 else:
-                    # log.info(f"ITEM: {keyword} = {value}")
-                    if base in self.types:
-                        if self.types[base] == "select_multiple":
-                            vals = self.convertMultiple(value)
-                            if len(vals) > 0:
-                                tags.update(vals)
-                            continue
-                    # When using geopoint warmup, once the display changes to the map
-
-                    # location, there is not always a value if the accuracy is way
-                    # off. In this case use the warmup value, which is where we are
-                    # hopefully standing anyway.
-                    if base == "latitude" and len(value) == 0:
-                        if "warmup-Latitude" in row:
-                            value = row["warmup-Latitude"]
-                            if base == "longitude" and len(value) == 0:
-                                value = row["warmup-Longitude"]
                     items = self.convertEntry(base, value)
-                    # log.info(f"ROW: {base} {value}")
-                    if len(items) > 0:
-                        if base in self.saved:
-                            if str(value) == "nan" or len(value) == 0:
-                                # log.debug(f"FIXME: {base} {value}")
-                                val = self.saved[base]
-                                if val and len(value) == 0:
-                                    log.warning(f'Using last saved value for "{base}"! Now "{val}"')
-                                    value = val
-                            else:
-                                self.saved[base] = value
-                                log.debug(f'Updating last saved value for "{base}" with "{value}"')
-                        # Handle nested dict in list
-                        if isinstance(items, list):
-                            items = items[0]
-                        for k, v in items.items():
-                            tags[k] = v
-                    else:
-                        tags[base] = value
-            # log.debug(f"\tFIXME1: {tags}")
-            all_tags.append(tags)
-        return all_tags
+                if len(items) > 0:
+                    if base in self.saved:
+                        self.saved[base] = value
+                        log.debug(f'Updating last saved value for "{base}" with "{value}"')
+                    # Handle nested dict in list
+                    if isinstance(items, list):
+                        items = items[0]
+                    tags.update(items)
+                else:
+                    tags[base] = value
+            yield tags
+
+    def iterCSVFrames(
+        self,
+        filespec: str,
+        data: str = None,
+        chunksize: int = 50000,
+    ) -> Iterator[pd.DataFrame]:
+        """Parse the CSV file from ODK Central a block of rows at a time.
+
+        Each block is converted a column at a time by convertFrame(),
+        which gives the same tags as iterCSV() but is much faster for
+        large exports.
+
+        Args:
+            filespec (str): The file to parse.
+            data (str): Or the data to parse.
+            chunksize (int): The number of rows in each block.
+
+        Returns:
+            (Iterator[pd.DataFrame]): The tags, one column per OSM tag
+        """
+        source = StringIO(data) if data else filespec
+        # Keep every value as a string, and empty cells as ""
+        with pd.read_csv(source, dtype=object, keep_default_na=False, chunksize=chunksize) as reader:
+            for frame in reader:
+                yield self.convertFrame(frame)
+
+    def convertFrame(
+        self,
+        frame: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """Convert a DataFrame of CSV rows, a column at a time.
+
+        Each distinct value in a column is only converted once, then
+        mapped onto the column. A later column overwrites the tags of
+        an earlier one, the same as iterCSVRows().
+
+        Args:
+            frame (pd.DataFrame): The rows, one column per CSV field
+
+        Returns:
+            (pd.DataFrame): The tags, one column per OSM tag, with NaN where a row has no value
+        """
+        columns = dict()
+
+        def assign(key: str, values: pd.Series):
+            if key in columns:
+                values = values.combine_first(columns[key])
+            columns[key] = values
+
+        for keyword, base, kind in FieldPlan(self, lower=True).plan(frame.columns):
+            values = frame[keyword]
+            values = values[values.notna() & (values != "")]
+            if values.empty:
+                continue
+            if kind == FieldPlan.MULTIPLE:
+                for key, tags in self.convertChoices(values).items():
+                    assign(key, tags.dropna())
+                continue
+            if base in self.saved:
+                self.saved[base] = values.iloc[-1]
+            if kind == FieldPlan.PASS:
+                assign(base, values)
+                continue
+            # Convert each distinct value once
+            converted = dict()
+            for value in values.unique():
+                items = self.convertEntry(base, value)
+                if len(items) == 0:
+                    items = {base: value}
+                elif isinstance(items, list):
+                    items = items[0]
+                for key, val in items.items():
+                    converted.setdefault(key, dict())[value] = val
+            for key, mapping in converted.items():
+                assign(key, values.map(mapping).dropna())
+
+        return pd.DataFrame(columns, index=frame.index, dtype=object)
+
+    def convertChoices(
+        self,
+        values: pd.Series,
+    ) -> pd.DataFrame:
+        """Convert the answers to a select_multiple question, like convertMultiple().
+
+        Args:
+            values (pd.Series): The space separated choices for each row
+
+        Returns:
+            (pd.DataFrame): The tags, one column per OSM tag
+        """
+        choices = values.str.split(" ").explode().str.lower()
+        pairs = dict()
+        for choice in choices.unique():
+            if choice in self.choices:
+                pairs[choice] = self.choices[choice]
+            else:
+                pairs[choice] = (choice, "yes")
+        choices = choices[choices.map(pairs).notna()]
+        tags = pd.DataFrame(
+            {
+                "row": choices.index,
+                "key": choices.map(lambda choice: pairs[choice][0]).to_numpy(),
+                "value": choices.map(lambda choice: pairs[choice][1]).to_numpy(),
+                "mapped": choices.map(lambda choice: choice in self.choices).to_numpy(),
+            },
+        )
+        # Choices that aren't in the config file are only tagged once, the rest are joined
+        tags = tags[tags["mapped"] | ~tags.duplicated(["row", "key"])]
+        # Only join the few rows with more than one value for a tag
+        repeated = tags.duplicated(["row", "key"], keep=False)
+        joined = pd.concat(
+            [
+                tags[~repeated].set_index(["row", "key"])["value"],
+                tags[repeated].groupby(["row", "key"], sort=False)["value"].agg(";".join),
+            ]
+        )
+        return joined.unstack("key")
+
+    def iterFrameRows(
+        self,
+        frame: pd.DataFrame,
+    ) -> Iterator[dict]:
+        """Get the tags for each row of a converted DataFrame.
+
+        Args:
+            frame (pd.DataFrame): The tags from convertFrame()
+
+        Returns:
+            (Iterator[dict]): The tags for each feature, like iterCSV()
+        """
+        keys = list(frame.columns)
+        for row in frame.itertuples(index=False, name=None):
+            yield {key: value for key, value in zip(keys, row, strict=True) if isinstance(value, str)}
 
     def JSONparser(
         self,
@@ -149,49 +378,78 @@ class ODKParsers(Convert):
         Returns:
             (list): A list of all the features in the input file
         """
+        return list(self.iterJSON(filespec, data))
+
+    def iterJSON(
+        self,
+        filespec: str = None,
+        data: str = None,
+    ) -> Iterator[dict]:
+        """Parse the JSON file from ODK Central one feature at a time.
+
+        The file is read incrementally, so only the current row is held
+        in memory. Besides a JSON file from Central, or a GeoJSON file,
+        this also reads files with one row per line, like those written
+        by OdkProject.exportSubmissions (.ndjson, .jsonl or .geojsons).
+
+        Args:
+            filespec (str): The JSON or GeoJson input file to convert
+            data (str): The data to convert
+
+        Returns:
+            (Iterator[dict]): The tags for each feature in the input file
+        """
         log.debug(f"Parsing JSON file {filespec}")
-        total = list()
         if not data:
-            file = open(filespec, "r")
             infile = Path(filespec)
-            if infile.suffix == ".geojson":
-                reader = geojson.load(file)
-            elif infile.suffix == ".json":
-                reader = json.load(file)
-            else:
+            if infile.suffix not in (".geojson", ".json", *NDJSON_SUFFIXES):
                 log.error("Need to specify a JSON or GeoJson file!")
-                return total
-        elif isinstance(data, str):
-            reader = geojson.loads(data)
-        elif isinstance(data, list):
-            reader = data
+                return
+            with open(filespec, "r") as file:
+                if infile.suffix in NDJSON_SUFFIXES:
+                    # GeoJSON sequences may start each row with a record separator
+                    rows = (json.loads(line.lstrip("\x1e")) for line in file if line.strip("\x1e \t\r\n"))
+                else:
+                    rows = iterJSONRows(file)
+                yield from self.iterJSONRows(rows)
+            return
 
+        if isinstance(data, str):
+            data = json.loads(data)
         # JSON files from Central use value as the keyword, whereas
         # GeoJSON uses features for the same thing.
-        if "value" in reader:
-            data = reader["value"]
-        elif "features" in reader:
-            data = reader["features"]
-        else:
-            data = reader
-        for row in data:
+        if "value" in data:
+            data = data["value"]
+        elif "features" in data:
+            data = data["features"]
+        yield from self.iterJSONRows(data)
+
+    def iterJSONRows(
+        self,
+        rows: Iterable[dict],
+    ) -> Iterator[dict]:
+        """Convert each row of a JSON file.
+
+        Args:
+            rows (Iterable[dict]): The rows, with any nested groups
+
+        Returns:
+            (Iterator[dict]): The tags for each feature
+        """
+        fields = FieldPlan(self, split=False)
+        for row in rows:
             # log.debug(f"ROW: {row}\n")
             tags = dict()
-            if "properties" in row:
-                row["properties"]  # A GeoJson formatted file
-            else:
-                pass  # A JOSM file from ODK Central
-
-            # flatten all the groups into a sodk2geojson.pyingle data structure
-            flattened = flatdict.FlatDict(row)
-            # log.debug(f"FLAT: {flattened}\n")
-            for k, v in flattened.items():
-                last = k.rfind(":") + 1
-                key = k[last:]
+
+            # flatten all the groups into a single data structure
+            for key, v in flatten(row):
+                if v is None:
+                    continue
+                kind = fields.resolve(key)[1]
+                if kind == FieldPlan.IGNORE:
+                    continue
                 # a JSON file from ODK Central always uses coordinates as
                 # the keyword
-                if key is None or key in self.ignore or v is None:
-                    continue
                 # log.debug(f"Processing tag {key} = {v}")
                 if key == "coordinates":
                     if isinstance(v, list):
@@ -201,15 +459,12 @@ class ODKParsers(Convert):
                         # tags["geometry"] = poi
                     continue
 
-                if key in self.types:
-                    if self.types[key] == "select_multiple":
-                        # log.debug(f"Found key '{self.types[key]}'")
-                        if v is None:
-                            continue
-                        vals = self.convertMultiple(v)
-                        if len(vals) > 0:
-                            tags.update(vals)
-                        continue
+                if kind == FieldPlan.MULTIPLE:
+                    tags.update(self.convertMultiple(v))
+                    continue
+                if kind == FieldPlan.PASS:
+                    tags[key] = v
+                    continue
                 items = self.convertEntry(key, v)
                 if items is None or len(items) == 0:
                     continue
@@ -224,10 +479,9 @@ class ODKParsers(Convert):
                     tags.update(items)
             # log.debug(f"TAGS: {tags}")
             if len(tags) > 0:
-                total.append(tags)
+                yield tags
 
         # log.debug(f"Finished parsing JSON file {filespec}")
-        return total
 
     def XMLparser(
         self,
@@ -246,56 +500,51 @@ class ODKParsers(Convert):
             (list): All the entries in the OSM XML Instance file
         """
         row = dict()
+        tags = dict()
         if filespec:
             logging.info("Processing instance file: %s" % filespec)
-            file = open(filespec, "rb")
-            # Instances are small, read the whole file
-            xml = file.read(os.path.getsize(filespec))
-        elif data:
-            xml = data
-        doc = xmltodict.parse(xml)
-
-        json.dumps(doc)
-        tags = dict()
-        data = doc["data"]
-        flattened = flatdict.FlatDict(data)
-        # total = list()
-        # log.debug(f"FLAT: {flattened}")
-        pat = re.compile("[0-9.]* [0-9.-]* [0-9.]* [0-9.]*")
-        for key, value in flattened.items():
-            if key[0] == "@" or value is None:
+            source = filespec
+        else:
+            source = BytesIO(data.encode() if isinstance(data, str) else data)
+
+        # The names of the enclosing groups, after the root element
+        path = list()
+        fields = FieldPlan(self)
+        for event, element in ElementTree.iterparse(source, events=("start", "end")):
+            # Drop any namespace, as xmltodict kept only the prefix
+            name = element.tag.rpartition("}")[2]
+            if event == "start":
+                path.append(name)
+                continue
+            path.pop()
+            if len(element) > 0 or not path:
+                # Only the fields have values, not the groups
+                continue
+            value = element.text.strip() if element.text else None
+            if not value:
                 continue
             # Get the last element deliminated by a dash
             # for CSV & JSON, or a colon for ODK XML.
-            base = basename(key)
-            log.debug(f"FLAT: {base} = {value}")
-            if base in self.ignore:
+            base, kind = fields.resolve(":".join([*path[1:], name]))
+            if kind == FieldPlan.IGNORE:
                 continue
-            if re.search(pat, value):
+            if GPS_VALUE.search(value):
                 gps = value.split(" ")
                 row["lat"] = gps[0]
                 row["lon"] = gps[1]
                 continue
 
-            if base in self.types:
-                if self.types[base] == "select_multiple":
-                    # log.debug(f"Found key '{self.types[base]}'")
-                    vals = self.convertMultiple(value)
-                    if len(vals) > 0:
-                        tags.update(vals)
+            if kind == FieldPlan.MULTIPLE:
+                tags.update(self.convertMultiple(value))
+            elif base in self.types:
+                item = self.convertEntry(base, value)
+                if item is None or len(item) == 0:
                     continue
-                else:
-                    item = self.convertEntry(base, value)
-                    if item is None or len(item) == 0:
-                        continue
-                    if len(tags) == 0:
-                        tags = item[0]
-                    else:
-                        if type(item) == list:
-                            # log.debug(f"list Item {item}")
-                            tags.update(item[0])
-                        elif type(item) == dict:
-                            # log.debug(f"dict Item {item}")
-                            tags.update(item)
+                if type(item) == list:
+                    # log.debug(f"list Item {item}")
+                    tags.update(item[0])
+                elif type(item) == dict:
+                    # log.debug(f"dict Item {item}")
+                    tags.update(item)
         row.update(tags)
         return [row]
@@ -18,23 +18,44 @@
 #     along with OSM-Fieldwork.  If not, see <https:#www.gnu.org/licenses/>.
 #
 
+import json
 import logging
-from datetime import datetime
+import struct
+from functools import lru_cache
 from pathlib import Path
+from typing import Iterable, Optional
 
-from geojson import Feature, FeatureCollection, Point, dump
-
-from osm_fieldwork.osmfile import OsmFile
+from osm_fieldwork.convert import Convert
+from osm_fieldwork.osmfile import OsmFile, timestamp
+from osm_fieldwork.osmpbf import OsmPbfFile
 
 # Instantiate logger
 log = logging.getLogger(__name__)
 
-
+# The GeoJSON output formats, by file suffix
+GEOJSON_FORMATS = {
+    ".geojson": "geojson",
+    ".json": "geojson",
+    ".geojsons": "geojsonseq",
+    ".geojsonl": "geojsonseq",
+    ".geojsonseq": "geojsonseq",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+# The file suffix for each GeoJSON output format
+GEOJSON_SUFFIXES = {"geojson": ".geojson", "geojsonseq": ".geojsons", "ndjson": ".ndjson"}
+# The file suffix for each OSM output format
+OSM_SUFFIXES = {"osm": ".osm", "pbf": ".osm.pbf"}
+
+
+@lru_cache(maxsize=4096)
 def basename(
     line: str,
 ) -> str:
     """Extract the basename of a path after the last -.
 
+    There are only a few distinct paths in a file, so the results are cached.
+
     Args:
         line (str): The path from the json file entry
 
@@ -42,18 +63,102 @@ def basename(
         (str): The last node of the path
     """
     if line.find("-") > 0:
-        tmp = line.split("-")
-        if len(tmp) > 0:
-            return tmp[len(tmp) - 1]
+        return line.rpartition("-")[2]
     elif line.find(":") > 0:
-        tmp = line.split(":")
-        if len(tmp) > 0:
-            return tmp[len(tmp) - 1]
+        return line.rpartition(":")[2]
     else:
-        # return tmp[len(tmp) - 1]
         return line
 
 
+class FieldPlan(object):
+    """How each field of a file is converted, resolved once per field.
+
+    A file has many rows, but only a few distinct column names or
+    paths, so the basename and the conversion of each one is looked
+    up the first time it's seen, instead of for every row.
+    """
+
+    # The kinds of field
+    IGNORE = 0
+    MULTIPLE = 1
+    PASS = 2
+    CONVERT = 3
+
+    def __init__(
+        self,
+        convert: Convert,
+        split: bool = True,
+        lower: bool = False,
+    ):
+        """Start with no fields resolved.
+
+        Args:
+            convert (Convert): The conversion data, and the types from the XLSForm
+            split (bool): Whether to use the basename of the field
+            lower (bool): Whether to lower case the basename
+
+        Returns:
+            (FieldPlan): An empty plan
+        """
+        self.convert = convert
+        self.split = split
+        self.lower = lower
+        self.fields = dict()
+
+    def resolve(
+        self,
+        key: str,
+    ) -> tuple[str, int]:
+        """Get the basename and kind of a field.
+
+        Args:
+            key (str): The column name or path of the field
+
+        Returns:
+            (tuple): The basename, and IGNORE, MULTIPLE, PASS or CONVERT
+        """
+        field = self.fields.get(key)
+        if field is not None:
+            return field
+        base = basename(key) if self.split else key
+        if self.lower:
+            base = base.lower()
+        low = base.lower()
+        convert = self.convert
+        if base in convert.ignore:
+            kind = self.IGNORE
+        elif convert.types.get(base) == "select_multiple":
+            kind = self.MULTIPLE
+        elif low not in convert.ignore and low not in convert.convert and low not in convert.private:
+            # convertEntry() would return it unchanged
+            kind = self.PASS
+        else:
+            kind = self.CONVERT
+        field = self.fields[key] = (base, kind)
+        return field
+
+    def plan(
+        self,
+        keys: Iterable[str],
+    ) -> list[tuple[str, str, int]]:
+        """Resolve all the fields of a file, such as the CSV header.
+
+        Args:
+            keys (Iterable[str]): The column names, in order
+
+        Returns:
+            (list): The column name, basename and kind of each field that isn't ignored
+        """
+        plan = list()
+        for key in dict.fromkeys(keys):
+            if key is None:
+                continue
+            base, kind = self.resolve(key)
+            if kind != self.IGNORE:
+                plan.append((key, base, kind))
+        return plan
+
+
 class OutSupport(object):
     def __init__(
         self,
@@ -61,12 +166,14 @@ class OutSupport(object):
     ):
         self.osm = None
         self.filespec = filespec
-        self.features = list()
+        self.json = None
+        self.geojson = None
+        self.count = 0
         if filespec:
             path = Path(filespec)
             if path.suffix == ".osm":
                 self.createOSM(filespec)
-            elif path.suffix == ".geojson":
+            elif path.suffix in GEOJSON_FORMATS:
                 self.createGeoJson(filespec)
             else:
                 log.error(f"{filespec} is not a valid file!")
@@ -77,15 +184,19 @@ class OutSupport(object):
     ) -> bool:
         """Create an OSM XML output files.
 
+        A file ending in .pbf is written as OSM PBF instead.
+
         Args:
             filespec (str): The output file name
         """
+        if filespec is None:
+            filespec = self.filespec
         if filespec is not None:
-            log.debug("Creating OSM XML file: %s" % filespec)
-            self.osm = OsmFile(filespec)
-        elif self.filespec is not None:
-            log.debug("Creating OSM XML file: %s" % self.filespec)
-            self.osm = OsmFile(self.filespec)
+            log.debug("Creating OSM file: %s" % filespec)
+            if Path(filespec).suffix == ".pbf":
+                self.osm = OsmPbfFile(filespec)
+            else:
+                self.osm = OsmFile(filespec)
 
         return True
 
@@ -98,7 +209,6 @@ class OutSupport(object):
         Args:
             feature (dict): The OSM feature to write to
         """
-        out = ""
         if "tags" in feature:
             if "id" in feature["tags"]:
                 feature["id"] = feature["tags"]["id"]
@@ -106,33 +216,93 @@ class OutSupport(object):
             return True
         if "lat" not in feature["attrs"] or "lon" not in feature["attrs"]:
             return None
-        if "refs" not in feature:
-            out += self.osm.createNode(feature)
-        else:
-            out += self.osm.createWay(feature)
-        self.osm.write(out)
+        self.osm.writeFeatures([feature])
 
         return True
 
+    def writeOSMBatch(
+        self,
+        features: list[dict],
+    ) -> int:
+        """Write a batch of features to an OSM XML output file.
+
+        This skips the same features as writeOSM(), but the batch is
+        written in one go, with a single timestamp.
+
+        Args:
+            features (list[dict]): The OSM features to write
+
+        Returns:
+            (int): The number of features written
+        """
+        batch = list()
+        for feature in features:
+            if "tags" not in feature:
+                continue
+            if "id" in feature["tags"]:
+                feature["id"] = feature["tags"]["id"]
+            if "lat" not in feature["attrs"] or "lon" not in feature["attrs"]:
+                continue
+            batch.append(feature)
+        return self.osm.writeFeatures(batch)
+
     def finishOSM(self):
         """Write the OSM XML file footer and close it."""
-        # This is now handled by a destructor in the OsmFile class
-        # self.osm.footer()
+        self.osm.footer()
 
     def createGeoJson(
         self,
         filespec: str = "tmp.geojson",
+        format: str = None,
     ) -> bool:
         """Create a GeoJson output file.
 
+        The features are written as they arrive, so nothing is held in
+        memory. The file is either a FeatureCollection, a GeoJSON text
+        sequence (RFC 8142) or newline delimited GeoJSON features.
+
         Args:
             filespec (str): The output file name
+            format (str): One of geojson, geojsonseq or ndjson,
+                or from the file suffix if not given
         """
+        if format is None:
+            format = GEOJSON_FORMATS.get(Path(filespec).suffix.lower(), "geojson")
+        if format not in GEOJSON_SUFFIXES:
+            raise ValueError(f"Unsupported GeoJSON format {format}, use one of {', '.join(GEOJSON_SUFFIXES)}")
         log.debug("Creating GeoJson file: %s" % filespec)
-        self.json = open(filespec, "w")
+        self.json = open(filespec, "w", buffering=1048576)
+        self.geojson = format
+        self.count = 0
+        if format == "geojson":
+            self.json.write('{"type": "FeatureCollection", "features": [')
 
         return True
 
+    def pointFeature(
+        self,
+        feature: dict,
+    ) -> Optional[tuple[float, float, dict]]:
+        """Get the location and properties of a feature, for the GeoJson and GeoParquet files.
+
+        Args:
+            feature (dict): The OSM feature
+
+        Returns:
+            (tuple): The lon, lat and properties, or None if it has no location
+        """
+        if "lat" not in feature["attrs"] or "lon" not in feature["attrs"]:
+            return None
+        lat = str(feature["attrs"]["lat"])
+        lon = str(feature["attrs"]["lon"])
+        if len(lon) == 0 or len(lat) == 0:
+            log.warning("Bad location data in entry! %r", feature["attrs"])
+            return None
+        props = feature.get("tags", dict())
+        if "private" in feature:
+            props = {**props, **feature["private"]}
+        return float(lon), float(lat), props
+
     def writeGeoJson(
         self,
         feature: dict,
@@ -142,58 +312,148 @@ class OutSupport(object):
         Args:
             feature (dict): The OSM feature to write to
         """
-        # These get written later when finishing , since we have to create a FeatureCollection
-        if "lat" not in feature["attrs"] or "lon" not in feature["attrs"]:
+        point = self.pointFeature(feature)
+        if point is None:
             return None
-        self.features.append(feature)
+        lon, lat, props = point
+        # The same as a geojson Feature, which rounds to 6 decimal places
+        poi = {"type": "Point", "coordinates": [round(lon, 6), round(lat, 6)]}
+        text = json.dumps({"type": "Feature", "geometry": poi, "properties": props})
+        if self.geojson == "geojsonseq":
+            self.json.write(f"\x1e{text}\n")
+        elif self.geojson == "ndjson":
+            self.json.write(f"{text}\n")
+        elif self.count == 0:
+            self.json.write(text)
+        else:
+            self.json.write(f", {text}")
+        self.count += 1
 
         return True
 
     def finishGeoJson(self):
-        """Write the GeoJson FeatureCollection to the output file and close it."""
-        features = list()
-        for item in self.features:
-            if len(item["attrs"]["lon"]) == 0 or len(item["attrs"]["lat"]) == 0:
-                log.warning("Bad location data in entry! %r", item["attrs"])
-                continue
-            poi = Point((float(item["attrs"]["lon"]), float(item["attrs"]["lat"])))
-            if "private" in item:
-                props = {**item["tags"], **item["private"]}
-            else:
-                props = item["tags"]
-            features.append(Feature(geometry=poi, properties=props))
-        collection = FeatureCollection(features)
-        dump(collection, self.json)
+        """Finish the GeoJson FeatureCollection in the output file and close it."""
+        if self.geojson == "geojson":
+            self.json.write("]}")
+        self.json.close()
+
+    def createGeoParquet(
+        self,
+        filespec: str,
+        batch_size: int = 10000,
+    ) -> bool:
+        """Create a GeoParquet output file.
+
+        This needs pyarrow, which is optional. The properties of each
+        feature are written as a map, as the tags vary between features.
+
+        Args:
+            filespec (str): The output file name
+            batch_size (int): The number of features in each row group
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Writing GeoParquet needs pyarrow, install it with 'pip install pyarrow'") from e
+
+        log.debug("Creating GeoParquet file: %s" % filespec)
+        geo = {
+            "version": "1.1.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"]}},
+        }
+        schema = pa.schema(
+            [("geometry", pa.binary()), ("properties", pa.map_(pa.string(), pa.string()))],
+            metadata={"geo": json.dumps(geo)},
+        )
+        self.parquet = pq.ParquetWriter(filespec, schema)
+        self.parquet_batch = batch_size
+        self.geometries = list()
+        self.properties = list()
+
+        return True
+
+    def writeGeoParquet(
+        self,
+        feature: dict,
+    ) -> bool:
+        """Add a feature to a GeoParquet output file.
+
+        Args:
+            feature (dict): The OSM feature to write to
+        """
+        point = self.pointFeature(feature)
+        if point is None:
+            return None
+        lon, lat, props = point
+        # A little endian WKB point
+        self.geometries.append(struct.pack("<BIdd", 1, 1, lon, lat))
+        self.properties.append([(key, None if value is None else str(value)) for key, value in props.items()])
+        if len(self.geometries) >= self.parquet_batch:
+            self.flushGeoParquet()
+
+        return True
+
+    def flushGeoParquet(self):
+        """Write the buffered features as a row group."""
+        import pyarrow as pa
+
+        if self.geometries:
+            data = {"geometry": self.geometries, "properties": self.properties}
+            self.parquet.write_table(pa.Table.from_pydict(data, schema=self.parquet.schema))
+        self.geometries = list()
+        self.properties = list()
+
+    def finishGeoParquet(self):
+        """Write the last features to the GeoParquet file and close it."""
+        self.flushGeoParquet()
+        self.parquet.close()
 
     def WriteData(
         self,
         base: str,
-        data: dict(),
+        data: Iterable[dict],
+        batch_size: int = 1000,
+        geojson: str = "geojson",
+        osm: str = "osm",
+        geoparquet: bool = False,
     ) -> bool:
         """Write the data to the output files.
 
+        Each feature is written as it is read, so data can be a generator,
+        such as from Convert.createEntries.
+
         Args:
             base (str): The base of the input file name
-            data (dict): The data to write
+            data (Iterable[dict]): The features to write
+            batch_size (int): The number of features in each OSM XML write
+            geojson (str): The GeoJSON format, one of geojson, geojsonseq or ndjson
+            osm (str): The OSM format, osm for OSM XML or pbf
+            geoparquet (bool): Also write a GeoParquet file, which needs pyarrow
 
         Returns:
             (bool): Whether the data got written
         """
-        osmoutfile = f"{base}.osm"
+        osmoutfile = f"{base}{OSM_SUFFIXES[osm]}"
         self.createOSM(osmoutfile)
 
-        jsonoutfile = f"{base}.geojson"
-        self.createGeoJson(jsonoutfile)
+        jsonoutfile = f"{base}{GEOJSON_SUFFIXES[geojson]}"
+        self.createGeoJson(jsonoutfile, geojson)
+
+        if geoparquet:
+            self.createGeoParquet(f"{base}.parquet")
 
         nodeid = -1000
+        batch = list()
         for feature in data:
             if len(feature) == 0:
                 continue
             if "refs" in feature:
                 # it's a way
                 refs = list()
+                now = timestamp()
                 for ref in feature["refs"]:
-                    now = datetime.now().strftime("%Y-%m-%dT%TZ")
                     if len(ref) == 0:
                         continue
                     coords = ref.split(" ")
@@ -201,8 +461,10 @@ class OutSupport(object):
                         "attrs": {"id": nodeid, "version": 1, "timestamp": now, "lat": coords[0], "lon": coords[1]},
                         "tags": dict(),
                     }
-                    self.writeOSM(node)
+                    batch.append(node)
                     self.writeGeoJson(node)
+                    if geoparquet:
+                        self.writeGeoParquet(node)
                     refs.append(nodeid)
                     nodeid -= 1
                 feature["refs"] = refs
@@ -212,11 +474,21 @@ class OutSupport(object):
                     # Sometimes bad entries, usually from debugging XForm design, sneak in
                     log.warning("Bad record! %r" % feature)
                     continue
-            self.writeOSM(feature)
+                self.writeGeoJson(feature)
+                if geoparquet:
+                    self.writeGeoParquet(feature)
+            batch.append(feature)
+            if len(batch) >= batch_size:
+                self.writeOSMBatch(batch)
+                batch = list()
+        self.writeOSMBatch(batch)
 
         self.finishOSM()
         log.info("Wrote OSM XML file: %r" % osmoutfile)
         self.finishGeoJson()
         log.info("Wrote GeoJson file: %r" % jsonoutfile)
+        if geoparquet:
+            self.finishGeoParquet()
+            log.info("Wrote GeoParquet file: %r" % f"{base}.parquet")
 
         return True
@@ -0,0 +1,1368 @@
+#!/usr/bin/python3
+
+# Copyright (c) Humanitarian OpenStreetMap Team
+#
+# This file is part of OSM-Fieldwork.
+#
+#     OSM-Fieldwork is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     OSM-Fieldwork is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with OSM-Fieldwork.  If not, see <https:#www.gnu.org/licenses/>.
+#
+"""Retries, timeouts, a circuit breaker and metrics for the ODK Central clients.
+
+Both OdkCentral.py and OdkCentralAsync.py send every request through
+this module, so a temporary error from Central (a 502 from nginx while
+it restarts, or a 429 when rate limited) doesn't abort a long running
+operation. When an endpoint keeps failing, its circuit breaker opens,
+and requests to it fail immediately rather than adding to the load.
+
+Optionally, each request can be recorded by RequestMetrics, to find
+the slow endpoints, and metadata that rarely changes can be cached by
+a ResponseCache.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+from multidict import CIMultiDict, CIMultiDictProxy
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, NewConnectionError
+from yarl import URL
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError, aiohttp.ClientConnectionError):
+    """Raised instead of sending a request while the circuit breaker is open.
+
+    This is a connection error for both requests and aiohttp, so the
+    existing error handling in both clients applies to it.
+    """
+
+
+class RetryPolicy(object):
+    """When and how often to retry a request to ODK Central."""
+
+    def __init__(
+        self,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        backoff_max: float = 30,
+        retry_after_max: float = 120,
+        statuses: tuple[int, ...] = (429, 500, 502, 503, 504),
+        methods: tuple[str, ...] = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE"),
+        connect_timeout: float = 10,
+        timeout: float = 60,
+        timeouts: Optional[dict[str, float]] = None,
+    ):
+        """Configure the retries and timeouts.
+
+        Args:
+            retries (int): The maximum number of retries per request, 0 to disable.
+            backoff_factor (float): The base delay in seconds, doubled each retry.
+            backoff_max (float): The longest delay between retries.
+            retry_after_max (float): The longest Retry-After header to honour.
+            statuses (tuple): The HTTP status codes that are worth retrying.
+            methods (tuple): The idempotent methods, which are safe to send twice.
+            connect_timeout (float): Seconds to wait for a connection.
+            timeout (float): Seconds to wait for the server to send data,
+                60 by default.
+            timeouts (dict): A read timeout per endpoint, keyed by a regex
+                matched against the method and URL path, such as
+                'POST /v1/projects/1/forms'. The first match wins. By default
+                exports and OData requests get up to 600 seconds, and creating
+                a form or Entities in bulk gets 300 seconds.
+
+        Returns:
+            (RetryPolicy): An instance of this object
+        """
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        if timeouts is None:
+            # Exports are generated on the fly, so Central can be slow to respond
+            timeouts = {
+                r"/submissions\.csv(\.zip)?$": 600,
+                r"/entities\.csv$": 300,
+                r"\.svc/": 180,
+                # As are writes, which can't be retried after a timeout
+                r"^POST /.*/forms(/[^/]+/draft)?$": 300,
+                r"^POST /.*/datasets/[^/]+/entities$": 300,
+            }
+        self.timeouts = [(re.compile(pattern), seconds) for pattern, seconds in timeouts.items()]
+
+    def isIdempotent(
+        self,
+        method: str,
+        idempotent: Optional[bool] = None,
+    ) -> bool:
+        """Check if a request can safely be sent more than once.
+
+        Args:
+            method (str): The HTTP method.
+            idempotent (bool): Override the default for the method, for
+                example a POST with a client generated UUID.
+
+        Returns:
+            bool: If the request can be retried after it reached the server.
+        """
+        if idempotent is not None:
+            return idempotent
+        return method.upper() in self.methods
+
+    def shouldRetry(
+        self,
+        method: str,
+        status: int,
+        idempotent: Optional[bool] = None,
+    ) -> bool:
+        """Check if a response status is worth retrying.
+
+        A 429 or 503 means the server refused the request without processing
+        it, so those are retried for any method. Other errors are only
+        retried for idempotent requests.
+
+        Args:
+            method (str): The HTTP method.
+            status (int): The HTTP status code of the response.
+            idempotent (bool): Override the default for the method.
+
+        Returns:
+            bool: If the request should be sent again.
+        """
+        if status not in self.statuses:
+            return False
+        return status in (429, 503) or self.isIdempotent(method, idempotent)
+
+    def delay(
+        self,
+        attempt: int,
+        retry_after: Optional[str] = None,
+    ) -> float:
+        """Get the time to wait before a retry.
+
+        Uses an exponential backoff with full jitter, so many clients
+        retrying at once don't all hit the server at the same time.
+
+        Args:
+            attempt (int): The number of retries made so far, from 0.
+            retry_after (str): The Retry-After header of the response, if any.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        wait = random.uniform(0, min(self.backoff_max, self.backoff_factor * (2**attempt)))
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    seconds = 0
+            wait = max(wait, min(seconds, self.retry_after_max))
+        return wait
+
+    def timeoutFor(
+        self,
+        url: str,
+        method: str = "GET",
+    ) -> float:
+        """Get the read timeout for an endpoint.
+
+        Args:
+            url (str): The URL of the request.
+            method (str): The HTTP method.
+
+        Returns:
+            float: Seconds to wait for the server to send data.
+        """
+        endpoint = f"{method.upper()} {urlparse(str(url)).path}"
+        for pattern, seconds in self.timeouts:
+            if pattern.search(endpoint):
+                return seconds
+        return self.timeout
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to an endpoint that keeps failing.
+
+    Each failure is a request that still failed after all its retries.
+    After a number of consecutive failures the circuit opens, and all
+    requests fail immediately. After a cool down period a single trial
+    request is let through. If it succeeds the circuit closes again,
+    otherwise it stays open for another cool down period.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+    ):
+        """Start with the circuit closed.
+
+        Args:
+            failure_threshold (int): Consecutive failures before opening.
+            reset_timeout (float): Seconds to stay open before a trial request.
+
+        Returns:
+            (CircuitBreaker): An instance of this object
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0.0
+        # The sync client is used from threads
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """The current state of the circuit."""
+        if self.failures < self.failure_threshold:
+            return self.CLOSED
+        if time.monotonic() - self.opened < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before(self, url: str):
+        """Check a request can be sent.
+
+        Args:
+            url (str): The URL of the request, for the error message.
+
+        Raises:
+            CircuitOpenError: If the server is failing, and no trial
+                request is due.
+        """
+        with self.lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN:
+                # Other requests wait for another cool down period, which
+                # also allows a new trial if this one never completes
+                self.opened = time.monotonic()
+                log.info(f"Sending a trial request to {url}")
+                return
+        raise CircuitOpenError(f"Too many failed requests to ODK Central, not sending {url}")
+
+    def success(self):
+        """Record a successful request, which closes the circuit."""
+        with self.lock:
+            if self.failures >= self.failure_threshold:
+                log.info("ODK Central is responding again, closing the circuit")
+            self.failures = 0
+
+    def failure(self):
+        """Record a failed request, which may open the circuit."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.failures == self.failure_threshold:
+                    log.warning(f"{self.failures} failed requests to ODK Central, opening the circuit")
+                self.opened = time.monotonic()
+
+
+# One circuit breaker per server endpoint, shared by all the clients
+breakers: dict[str, CircuitBreaker] = {}
+breakers_lock = threading.Lock()
+
+
+def getCircuitBreaker(url: str) -> CircuitBreaker:
+    """Get the circuit breaker for an endpoint of an ODK Central server.
+
+    A broken endpoint, such as a failing export, doesn't stop the
+    requests to the rest of the server.
+
+    Args:
+        url (str): The URL of the request.
+
+    Returns:
+        (CircuitBreaker): The circuit breaker shared by all clients for the endpoint.
+    """
+    parsed = urlparse(str(url))
+    key = f"{parsed.scheme}://{parsed.netloc}{endpointName(url)}"
+    with breakers_lock:
+        if key not in breakers:
+            breakers[key] = CircuitBreaker()
+        return breakers[key]
+
+
+def wasSent(error: Exception) -> bool:
+    """Check if a failed request may have reached the server.
+
+    Args:
+        error (Exception): The connection error from requests or aiohttp.
+
+    Returns:
+        bool: False if the connection was never made, so the request
+            can be retried whatever the method.
+    """
+    if isinstance(error, (aiohttp.ClientConnectorError, requests.exceptions.ConnectTimeout)):
+        return False
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        return not isinstance(reason.reason, (NewConnectionError, ConnectTimeoutError))
+    return True
+
+
+# The path segments that are followed by an identifier
+ID_PARENTS = frozenset(
+    (
+        "projects",
+        "forms",
+        "versions",
+        "submissions",
+        "attachments",
+        "datasets",
+        "entities",
+        "properties",
+        "app-users",
+        "users",
+        "assignments",
+        "roles",
+        "public-links",
+        "sessions",
+    )
+)
+ID_PATTERN = re.compile(r"^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})$")
+
+
+def endpointName(url: str) -> str:
+    """Get the endpoint of a URL, without the identifiers or query.
+
+    Example:
+        /v1/projects/1/forms/buildings/submissions.csv.zip
+        becomes /v1/projects/{id}/forms/{id}/submissions.csv.zip
+
+    Args:
+        url (str): The URL of the request.
+
+    Returns:
+        str: The path with each identifier replaced by {id}.
+    """
+    parts = urlparse(str(url)).path.split("/")
+    for index, part in enumerate(parts):
+        if not part:
+            continue
+        if part.endswith(".svc"):
+            parts[index] = "{id}.svc"
+        elif (index and parts[index - 1] in ID_PARENTS) or ID_PATTERN.match(part):
+            parts[index] = "{id}"
+        elif "(" in part:
+            # OData keys, Submissions('uuid:...')
+            parts[index] = re.sub(r"\(.*\)", "({id})", part)
+    return "/".join(parts)
+
+
+class RequestMetrics(object):
+    """Request counts, latency, bytes, retries and status codes per endpoint.
+
+    Pass an instance to either client to record every request. The
+    results can be read with summary(), or exported with prometheus().
+    Each request is also passed to any callbacks, and if an OpenTelemetry
+    tracer is given, a span is created for each request.
+
+    Example:
+        metrics = RequestMetrics(callbacks=[print])
+        OdkCentral.metrics = metrics
+        ...
+        print(metrics.prometheus())
+    """
+
+    # The upper bounds of the latency histogram, in seconds
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(
+        self,
+        callbacks: Optional[list[Callable[[dict], Any]]] = None,
+        tracer=None,
+        buckets: Optional[tuple[float, ...]] = None,
+    ):
+        """Set where each request is reported.
+
+        Args:
+            callbacks (list): Functions called with a dict for each request.
+                Format: {"method", "url", "endpoint", "status", "elapsed",
+                "sent", "received", "retries", "error"}
+            tracer: An OpenTelemetry tracer, from trace.get_tracer(), or any
+                object with a compatible start_span() method.
+            buckets (tuple): The upper bounds of the latency histogram.
+
+        Returns:
+            (RequestMetrics): An instance of this object
+        """
+        self.callbacks = list(callbacks or [])
+        self.tracer = tracer
+        self.span_options = {}
+        if tracer:
+            try:
+                from opentelemetry.trace import SpanKind
+
+                self.span_options = {"kind": SpanKind.CLIENT}
+            except ImportError:
+                pass
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.endpoints = {}
+        # The sync client is used from threads
+        self.lock = threading.Lock()
+
+    def addCallback(self, callback: Callable[[dict], Any]):
+        """Call a function with the details of each request.
+
+        Args:
+            callback (Callable): Called with a dict for each request.
+        """
+        self.callbacks.append(callback)
+
+    def start(self, method: str, url: str):
+        """Start a trace span for a request, if tracing.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL of the request.
+
+        Returns:
+            The span, to be passed to record(), or None.
+        """
+        if not self.tracer:
+            return None
+        return self.tracer.start_span(
+            f"{method} {endpointName(url)}",
+            attributes={"http.request.method": method, "url.full": str(url)},
+            **self.span_options,
+        )
+
+    def record(
+        self,
+        method: str,
+        url: str,
+        status: Optional[int] = None,
+        elapsed: float = 0.0,
+        sent: int = 0,
+        received: int = 0,
+        retries: int = 0,
+        error: Optional[Exception] = None,
+        span=None,
+    ):
+        """Record a completed request, including any retries.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL of the request.
+            status (int): The HTTP status code, None if there was no response.
+            elapsed (float): Seconds from sending the request to reading the body.
+            sent (int): The size of the request body.
+            received (int): The size of the response body.
+            retries (int): The number of times the request was retried.
+            error (Exception): The error, if the request failed.
+            span: The span from start(), if tracing.
+        """
+        endpoint = endpointName(url)
+        with self.lock:
+            stats = self.endpoints.get((method, endpoint))
+            if not stats:
+                stats = {
+                    "count": 0,
+                    "errors": 0,
+                    "retries": 0,
+                    "sent": 0,
+                    "received": 0,
+                    "seconds": 0.0,
+                    "max": 0.0,
+                    "statuses": Counter(),
+                    "histogram": [0] * (len(self.buckets) + 1),
+                }
+                self.endpoints[(method, endpoint)] = stats
+            stats["count"] += 1
+            stats["errors"] += bool(error or (status and status >= 400))
+            stats["retries"] += retries
+            stats["sent"] += sent
+            stats["received"] += received
+            stats["seconds"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            stats["statuses"][str(status) if status else "error"] += 1
+            index = 0
+            while index < len(self.buckets) and elapsed > self.buckets[index]:
+                index += 1
+            stats["histogram"][index] += 1
+
+        if span:
+            if status:
+                span.set_attribute("http.response.status_code", status)
+            span.set_attribute("http.request.resend_count", retries)
+            if error:
+                span.record_exception(error)
+                span.set_attribute("error.type", type(error).__name__)
+            span.end()
+
+        event = {
+            "method": method,
+            "url": str(url),
+            "endpoint": endpoint,
+            "status": status,
+            "elapsed": elapsed,
+            "sent": sent,
+            "received": received,
+            "retries": retries,
+            "error": error,
+        }
+        for callback in self.callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                log.error(f"Request metrics callback failed: {e}")
+
+    def summary(self) -> list[dict]:
+        """Get the statistics for each endpoint, slowest first.
+
+        Returns:
+            list[dict]: The statistics, sorted by the total time spent.
+                Format: {"method", "endpoint", "count", "errors", "retries",
+                "sent", "received", "seconds", "mean", "max", "statuses"}
+        """
+        with self.lock:
+            result = [
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "retries": stats["retries"],
+                    "sent": stats["sent"],
+                    "received": stats["received"],
+                    "seconds": stats["seconds"],
+                    "mean": stats["seconds"] / stats["count"],
+                    "max": stats["max"],
+                    "statuses": dict(stats["statuses"]),
+                }
+                for (method, endpoint), stats in self.endpoints.items()
+            ]
+        return sorted(result, key=lambda item: item["seconds"], reverse=True)
+
+    def prometheus(self, prefix: str = "odk_central") -> str:
+        """Export the statistics in the Prometheus text format.
+
+        Args:
+            prefix (str): The prefix for the metric names.
+
+        Returns:
+            str: The metrics, to be served on a /metrics endpoint.
+        """
+
+        def labels(**values) -> str:
+            escaped = []
+            for key, value in values.items():
+                value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                escaped.append(f'{key}="{value}"')
+            return "{" + ",".join(escaped) + "}"
+
+        requests_total = [f"# TYPE {prefix}_requests_total counter"]
+        duration = [f"# TYPE {prefix}_request_duration_seconds histogram"]
+        retries = [f"# TYPE {prefix}_request_retries_total counter"]
+        sent = [f"# TYPE {prefix}_request_bytes_total counter"]
+        received = [f"# TYPE {prefix}_response_bytes_total counter"]
+        with self.lock:
+            for (method, endpoint), stats in sorted(self.endpoints.items()):
+                for status, count in sorted(stats["statuses"].items()):
+                    requests_total.append(
+                        f"{prefix}_requests_total{labels(method=method, endpoint=endpoint, status=status)} {count}"
+                    )
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), stats["histogram"], strict=True):
+                    cumulative += count
+                    duration.append(
+                        f"{prefix}_request_duration_seconds_bucket{labels(method=method, endpoint=endpoint, le=bound)} {cumulative}"
+                    )
+                name = labels(method=method, endpoint=endpoint)
+                duration.append(f"{prefix}_request_duration_seconds_sum{name} {stats['seconds']}")
+                duration.append(f"{prefix}_request_duration_seconds_count{name} {stats['count']}")
+                retries.append(f"{prefix}_request_retries_total{name} {stats['retries']}")
+                sent.append(f"{prefix}_request_bytes_total{name} {stats['sent']}")
+                received.append(f"{prefix}_response_bytes_total{name} {stats['received']}")
+        return "\n".join(requests_total + duration + retries + sent + received) + "\n"
+
+    def reset(self):
+        """Clear all the statistics."""
+        with self.lock:
+            self.endpoints = {}
+
+
+def bodySize(body) -> int:
+    """Get the size of a request body, if known without reading it.
+
+    Args:
+        body: The request body.
+
+    Returns:
+        int: The size in bytes, 0 if unknown.
+    """
+    if isinstance(body, bytes):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    return 0
+
+
+class RetryAdapter(HTTPAdapter):
+    """A requests transport adapter which retries and times out requests.
+
+    Mount it on a requests.Session, and every request sent with that
+    session follows the RetryPolicy.
+    """
+
+    def __init__(
+        self,
+        policy: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        **kwargs,
+    ):
+        """Set the retry policy and circuit breaker.
+
+        Args:
+            policy (RetryPolicy): When to retry, the defaults if not set.
+            breaker (CircuitBreaker): The circuit breaker for every request,
+                if not set one is shared per server endpoint.
+            kwargs: Passed on to requests.adapters.HTTPAdapter.
+
+        Returns:
+            (RetryAdapter): An instance of this object
+        """
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker
+        super().__init__(**kwargs)
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        """Send a request, retrying temporary failures."""
+        policy = self.policy
+        breaker = self.breaker or getCircuitBreaker(request.url)
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (policy.connect_timeout, policy.timeoutFor(request.url, request.method))
+        # A streamed upload can't be rewound
+        replayable = isinstance(request.body, (bytes, str, type(None)))
+
+        # The breaker counts the request once, after any retries
+        breaker.before(request.url)
+        attempt = 0
+        while True:
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= policy.retries or not replayable or (wasSent(e) and not policy.isIdempotent(request.method)):
+                    breaker.failure()
+                    e.retries = attempt
+                    raise
+                wait = policy.delay(attempt)
+                log.warning(f"{request.method} {request.url} failed ({e}), retrying in {wait:.1f}s")
+            else:
+                if attempt >= policy.retries or not replayable or not policy.shouldRetry(request.method, response.status_code):
+                    if response.status_code in policy.statuses:
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                    response.retries = attempt
+                    return response
+                wait = policy.delay(attempt, response.headers.get("Retry-After"))
+                log.warning(f"{request.method} {request.url} returned {response.status_code}, retrying in {wait:.1f}s")
+                response.close()
+            time.sleep(wait)
+            attempt += 1
+
+
+class MemoryCache(object):
+    """An in-memory cache backend, dropping the least recently used entries."""
+
+    def __init__(self, maxsize: int = 512):
+        """Create an empty in-memory cache.
+
+        Args:
+            maxsize (int): The maximum number of responses to keep.
+
+        Returns:
+            (MemoryCache): An instance of this object
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        """Get a cached response, if any."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: dict):
+        """Add or replace a cached response."""
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, keys: list[str]):
+        """Remove cached responses."""
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def keys(self) -> list[str]:
+        """Get the keys of all the cached responses."""
+        with self.lock:
+            return list(self.entries)
+
+
+class DiskCache(object):
+    """An sqlite cache backend, so cached responses are kept between runs."""
+
+    def __init__(self, dbname: str):
+        """Open the sqlite cache, creating it if required.
+
+        Args:
+            dbname (str): The filespec of the sqlite database.
+
+        Returns:
+            (DiskCache): An instance of this object
+        """
+        self.db = sqlite3.connect(dbname, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, entry TEXT, body BLOB)")
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        """Get a cached response, if any."""
+        with self.lock:
+            row = self.db.execute("SELECT entry, body FROM responses WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        entry = json.loads(row[0])
+        entry["body"] = row[1]
+        return entry
+
+    def set(self, key: str, entry: dict):
+        """Add or replace a cached response."""
+        metadata = json.dumps({name: value for name, value in entry.items() if name != "body"})
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, entry, body) VALUES (?, ?, ?)",
+                (key, metadata, sqlite3.Binary(entry["body"])),
+            )
+            self.db.commit()
+
+    def delete(self, keys: list[str]):
+        """Remove cached responses."""
+        with self.lock:
+            self.db.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+            self.db.commit()
+
+    def keys(self) -> list[str]:
+        """Get the keys of all the cached responses."""
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT key FROM responses")]
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+
+class ResponseCache(object):
+    """Cache the responses of the ODK Central endpoints that rarely change.
+
+    Only GET requests for the endpoints with a TTL are cached, and not
+    those with X-Extended-Metadata, as the submission counts in them
+    change with every submission. Until the TTL expires, the cached
+    response is used without contacting Central. After that, if Central
+    sent an ETag, the request is sent with If-None-Match, and the cached
+    response is reused if it's unchanged.
+
+    Any successful POST, PATCH, PUT or DELETE for the forms or datasets of
+    a project, such as publishing a form or uploading media, removes the
+    cached responses for them. Use invalidate() for any other changes,
+    such as those made outside of these clients.
+
+    As the responses depend on the permissions of the account, a cache
+    should only be used for one ODK Central account.
+    """
+
+    # Seconds to reuse a response for, keyed by a regex matched on the URL path
+    TTLS = {
+        r"/projects/\d+$": 300,
+        r"/projects/\d+/forms$": 300,
+        r"/projects/\d+/forms/[^/]+\.xml$": 3600,
+        r"/projects/\d+/forms/[^/]+$": 300,
+        r"/projects/\d+/forms/[^/]+/(draft/)?attachments$": 300,
+        r"/projects/\d+/forms/[^/]+/fields$": 3600,
+        r"/projects/\d+/datasets/?$": 300,
+    }
+
+    def __init__(
+        self,
+        backend=None,
+        ttls: Optional[dict[str, float]] = None,
+    ):
+        """Set what is cached, and for how long.
+
+        Args:
+            backend (MemoryCache, DiskCache): Where to keep the responses,
+                an in-memory LRU cache if not set.
+            ttls (dict): Seconds to reuse the response of each endpoint for,
+                keyed by a regex matched on the URL path. The first match wins.
+                A TTL of 0 always revalidates with the ETag.
+
+        Returns:
+            (ResponseCache): An instance of this object
+        """
+        self.backend = backend if backend is not None else MemoryCache()
+        self.ttls = [(re.compile(pattern), seconds) for pattern, seconds in (ttls or self.TTLS).items()]
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def ttlFor(self, url: str) -> Optional[float]:
+        """Get the TTL for an endpoint.
+
+        Args:
+            url (str): The URL of the request.
+
+        Returns:
+            float: The seconds to reuse a response, None if it's not cached.
+        """
+        path = urlparse(str(url)).path
+        for pattern, seconds in self.ttls:
+            if pattern.search(path):
+                return seconds
+        return None
+
+    def lookup(self, url: str, headers) -> tuple[Optional[str], Optional[dict]]:
+        """Find the cached response for a GET request.
+
+        Args:
+            url (str): The full URL of the request, including the query.
+            headers: The request headers.
+
+        Returns:
+            (str, dict): The cache key, None if not cacheable, and the
+                cached response if there is one.
+        """
+        # The extended metadata includes the submission counts, which
+        # change with every submission, so it's never cached
+        if self.ttlFor(url) is None or headers.get("X-Extended-Metadata"):
+            return None, None
+        key = str(url)
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        return key, entry
+
+    def isFresh(self, entry: dict) -> bool:
+        """Check if a cached response can be used without revalidation."""
+        if time.time() < entry["expires"]:
+            self.hits += 1
+            return True
+        return False
+
+    def store(
+        self,
+        key: str,
+        url: str,
+        status: int,
+        headers,
+        body: bytes,
+    ) -> dict:
+        """Add a response to the cache.
+
+        Args:
+            key (str): The key from lookup().
+            url (str): The URL of the request.
+            status (int): The HTTP status code.
+            headers: The response headers.
+            body (bytes): The decoded response body.
+
+        Returns:
+            dict: The cached response.
+        """
+        entry = {
+            "url": str(url),
+            "status": status,
+            # The body is stored decoded, so the encoding headers don't apply
+            "headers": {name: headers[name] for name in ("Content-Type", "ETag", "Last-Modified") if name in headers},
+            "etag": headers.get("ETag"),
+            "expires": time.time() + self.ttlFor(url),
+            "body": body,
+        }
+        self.backend.set(key, entry)
+        return entry
+
+    def refresh(self, key: str, entry: dict) -> dict:
+        """Reuse a cached response after Central replied 304 Not Modified."""
+        self.revalidated += 1
+        entry["expires"] = time.time() + self.ttlFor(entry["url"])
+        self.backend.set(key, entry)
+        return entry
+
+    def invalidate(self, prefix: str):
+        """Remove the cached responses for a URL, and any URLs below it.
+
+        Args:
+            prefix (str): The URL, for example f"{base}projects/1/forms/buildings"
+                removes the form details, XML, fields and attachments list.
+        """
+        prefix = prefix.rstrip("/")
+        keys = [key for key in self.backend.keys() if key == prefix or (key.startswith(prefix) and key[len(prefix)] in "/?.")]
+        if keys:
+            log.debug(f"Removing {len(keys)} cached responses for {prefix}")
+            self.backend.delete(keys)
+
+    def invalidateFor(self, url: str):
+        """Remove the cached responses changed by a successful update.
+
+        Args:
+            url (str): The URL of a POST, PATCH, PUT or DELETE request.
+        """
+        parsed = urlparse(str(url))
+        match = re.match(r"(.*/projects/\d+)(/[^/]+)?", parsed.path)
+        if not match:
+            return
+        if "/submissions" in parsed.path or "/entities" in parsed.path:
+            # Data, not metadata
+            return
+        project = f"{parsed.scheme}://{parsed.netloc}{match.group(1)}"
+        # The project details include the form and dataset counts
+        self.backend.delete([key for key in self.backend.keys() if key == project])
+        if match.group(2):
+            self.invalidate(project + match.group(2).split("?")[0])
+
+
+class CachedResponse(object):
+    """A response from the ResponseCache, with the same methods as aiohttp.ClientResponse."""
+
+    def __init__(self, entry: dict):
+        """Wrap a cached response.
+
+        Args:
+            entry (dict): The cached response.
+        """
+        self.entry = entry
+        self.status = entry["status"]
+        self.reason = "OK"
+        self.ok = True
+        self.url = URL(entry["url"])
+        self.headers = CIMultiDictProxy(CIMultiDict(entry["headers"]))
+        self.content_type = self.headers.get("Content-Type", "application/octet-stream").split(";")[0]
+        self.content_length = len(entry["body"])
+
+    async def read(self) -> bytes:
+        """Get the response body."""
+        return self.entry["body"]
+
+    async def text(self, encoding: Optional[str] = None, errors: str = "strict") -> str:
+        """Get the response body as text."""
+        return self.entry["body"].decode(encoding or "utf-8", errors)
+
+    async def json(self, *, loads=json.loads, **kwargs) -> Any:
+        """Get the response body as JSON."""
+        return loads(self.entry["body"].decode("utf-8"))
+
+    def raise_for_status(self):
+        """A cached response is never an error."""
+
+    def release(self):
+        """There is no connection to release."""
+
+
+class MeteredSession(requests.Session):
+    """A requests.Session with metrics and a response cache.
+
+    Each request is recorded in RequestMetrics, and cached responses
+    from a ResponseCache are reused.
+    """
+
+    def __init__(
+        self,
+        metrics: Optional[RequestMetrics] = None,
+        cache: Optional[ResponseCache] = None,
+    ):
+        """Set where each request is recorded and cached.
+
+        Args:
+            metrics (RequestMetrics): Where to record requests, none if not set.
+            cache (ResponseCache): Where to cache responses, none if not set.
+
+        Returns:
+            (MeteredSession): An instance of this object
+        """
+        super().__init__()
+        self.metrics = metrics
+        self.cache = cache
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        """Send a request, unless the response is cached."""
+        cache = self.cache
+        if not cache:
+            return self.record(request, **kwargs)
+
+        key = entry = None
+        if request.method == "GET" and not kwargs.get("stream"):
+            key, entry = cache.lookup(request.url, request.headers)
+            if entry and cache.isFresh(entry):
+                return self.cachedResponse(request, entry)
+            if entry and entry["etag"]:
+                request.headers["If-None-Match"] = entry["etag"]
+
+        response = self.record(request, **kwargs)
+        if key and entry and response.status_code == 304:
+            return self.cachedResponse(request, cache.refresh(key, entry))
+        if key and response.status_code == 200:
+            cache.store(key, request.url, response.status_code, response.headers, response.content)
+        elif request.method != "GET" and response.ok:
+            cache.invalidateFor(request.url)
+        return response
+
+    def cachedResponse(self, request: requests.PreparedRequest, entry: dict) -> requests.Response:
+        """Make a requests.Response from a cached response."""
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = entry["body"]
+        response.url = request.url
+        response.request = request
+        return response
+
+    def record(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        """Send a request, and record it once the body was read."""
+        metrics = self.metrics
+        if not metrics:
+            return super().send(request, **kwargs)
+
+        span = metrics.start(request.method, request.url)
+        sent = bodySize(request.body) or int(request.headers.get("Content-Length", 0))
+        started = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.record(
+                request.method,
+                request.url,
+                elapsed=time.monotonic() - started,
+                sent=sent,
+                retries=getattr(e, "retries", 0),
+                error=e,
+                span=span,
+            )
+            raise
+        if kwargs.get("stream"):
+            # The body is read later, so only the size is known
+            received = int(response.headers.get("Content-Length", 0))
+        else:
+            received = len(response.content)
+        metrics.record(
+            request.method,
+            request.url,
+            status=response.status_code,
+            elapsed=time.monotonic() - started,
+            sent=sent,
+            received=received,
+            retries=getattr(response, "retries", 0),
+            span=span,
+        )
+        return response
+
+
+class RequestContext(object):
+    """A pending aiohttp request, which can be awaited or used with 'async with'."""
+
+    def __init__(
+        self,
+        session: "RetrySession",
+        method: str,
+        url: str,
+        kwargs: dict,
+    ):
+        """Prepare the request, which is sent when awaited.
+
+        Args:
+            session (RetrySession): The session to send the request with.
+            method (str): The HTTP method.
+            url (str): The URL of the request.
+            kwargs (dict): Passed on to RetrySession.send.
+        """
+        self.session = session
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.response = None
+        self.state = {"retries": 0}
+        self.span = None
+        self.started = 0.0
+        self.cached = False
+
+    def __await__(self):
+        """Await the response."""
+        return self.fetch().__await__()
+
+    async def fetch(self) -> aiohttp.ClientResponse:
+        """Send the request, recording it before the body is read."""
+        response = await self.__aenter__()
+        self.finish()
+        return response
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        """Send the request in an async context manager."""
+        cache = self.session.cache
+        key = entry = None
+        if cache and self.method == "GET":
+            url = URL(self.url)
+            if self.kwargs.get("params"):
+                url = url.extend_query(self.kwargs["params"])
+            headers = CIMultiDict(self.session.headers)
+            headers.update(self.kwargs.get("headers") or {})
+            key, entry = cache.lookup(url, headers)
+            if entry and cache.isFresh(entry):
+                self.cached = True
+                self.response = CachedResponse(entry)
+                return self.response
+            if entry and entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+                self.kwargs["headers"] = headers
+
+        metrics = self.session.metrics
+        if metrics:
+            self.span = metrics.start(self.method, self.url)
+            self.started = time.monotonic()
+        try:
+            self.response = await self.session.send(self.method, self.url, state=self.state, **self.kwargs)
+            if key and entry and self.response.status == 304:
+                self.finish()
+                self.response.release()
+                self.cached = True
+                self.response = CachedResponse(cache.refresh(key, entry))
+            elif key and self.response.status == 200:
+                cache.store(key, url, self.response.status, self.response.headers, await self.response.read())
+            elif cache and self.method != "GET" and self.response.status < 400:
+                cache.invalidateFor(self.url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.finish(e)
+            raise
+        return self.response
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Release the connection back to the pool."""
+        self.response.release()
+        if isinstance(exc_value, (aiohttp.ClientError, asyncio.TimeoutError)):
+            self.finish(exc_value)
+        else:
+            self.finish()
+
+    def finish(self, error: Optional[Exception] = None):
+        """Record the request, if there are metrics."""
+        metrics = self.session.metrics
+        if not metrics or self.cached:
+            return
+        response = self.response
+        data = self.kwargs.get("data")
+        if data is None and self.kwargs.get("json") is not None:
+            data = json.dumps(self.kwargs["json"])
+        if response is not None:
+            status = response.status
+            received = response.content.total_bytes or response.content_length or 0
+        else:
+            status = getattr(error, "status", None)
+            received = 0
+        metrics.record(
+            self.method,
+            self.url,
+            status=status,
+            elapsed=time.monotonic() - self.started,
+            sent=bodySize(data),
+            received=received,
+            retries=self.state["retries"],
+            error=error,
+            span=self.span,
+        )
+
+
+class RetrySession(object):
+    """Wrap an aiohttp.ClientSession, so requests follow a RetryPolicy.
+
+    The methods match aiohttp.ClientSession, with an extra 'idempotent'
+    keyword argument to allow retrying a request that is safe to send
+    again, such as a POST with a client generated UUID. A file or stream
+    can only be sent once, so to retry it pass a function as the 'data',
+    which opens it again for each attempt.
+    If metrics are set, each request is recorded, and if a cache is set,
+    the responses are cached as per the ResponseCache.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        policy: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        metrics: Optional[RequestMetrics] = None,
+        cache: Optional[ResponseCache] = None,
+    ):
+        """Wrap an aiohttp session.
+
+        Args:
+            session (aiohttp.ClientSession): The session to send requests with.
+            policy (RetryPolicy): When to retry, the defaults if not set.
+            breaker (CircuitBreaker): The circuit breaker for every request,
+                if not set one is shared per server endpoint.
+            metrics (RequestMetrics): Where to record requests, none if not set.
+            cache (ResponseCache): Where to cache responses, none if not set.
+
+        Returns:
+            (RetrySession): An instance of this object
+        """
+        self.session = session
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker
+        self.metrics = metrics
+        self.cache = cache
+
+    @property
+    def headers(self):
+        """The default headers of the wrapped session."""
+        return self.session.headers
+
+    @property
+    def closed(self) -> bool:
+        """If the wrapped session is closed."""
+        return self.session.closed
+
+    async def close(self):
+        """Close the wrapped session."""
+        await self.session.close()
+
+    def request(self, method: str, url: str, **kwargs) -> RequestContext:
+        """Send a request, see aiohttp.ClientSession.request."""
+        return RequestContext(self, method, url, kwargs)
+
+    def get(self, url: str, **kwargs) -> RequestContext:
+        """Send a GET request."""
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> RequestContext:
+        """Send a HEAD request."""
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> RequestContext:
+        """Send a POST request."""
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> RequestContext:
+        """Send a PUT request."""
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> RequestContext:
+        """Send a PATCH request."""
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> RequestContext:
+        """Send a DELETE request."""
+        return self.request("DELETE", url, **kwargs)
+
+    async def send(
+        self,
+        method: str,
+        url: str,
+        idempotent: Optional[bool] = None,
+        state: Optional[dict] = None,
+        **kwargs,
+    ) -> aiohttp.ClientResponse:
+        """Send a request, retrying temporary failures.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL of the request.
+            idempotent (bool): Override if the request is safe to send twice.
+            state (dict): Updated with the number of retries so far.
+            kwargs: Passed on to aiohttp.ClientSession.request.
+
+        Returns:
+            (aiohttp.ClientResponse): The response.
+        """
+        policy = self.policy
+        breaker = self.breaker or getCircuitBreaker(url)
+        if "timeout" not in kwargs:
+            kwargs["timeout"] = aiohttp.ClientTimeout(
+                total=None, sock_connect=policy.connect_timeout, sock_read=policy.timeoutFor(url, method)
+            )
+        raise_for_status = kwargs.pop("raise_for_status", self.session._raise_for_status)
+        # A file, stream or form can only be sent once, unless reopened
+        opener = kwargs["data"] if callable(kwargs.get("data")) else None
+        replayable = opener is not None or isinstance(kwargs.get("data"), (bytes, str, type(None)))
+
+        # The breaker counts the request once, after any retries
+        breaker.before(url)
+        attempt = 0
+        while True:
+            if state is not None:
+                state["retries"] = attempt
+            if opener:
+                # Opening a file may block, so not in the event loop
+                kwargs["data"] = await asyncio.to_thread(opener)
+            try:
+                response = await self.session.request(method, url, raise_for_status=False, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= policy.retries or not replayable or (wasSent(e) and not policy.isIdempotent(method, idempotent)):
+                    breaker.failure()
+                    raise
+                wait = policy.delay(attempt)
+                log.warning(f"{method} {url} failed ({e!r}), retrying in {wait:.1f}s")
+            else:
+                if attempt >= policy.retries or not replayable or not policy.shouldRetry(method, response.status, idempotent):
+                    if response.status in policy.statuses:
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                    if raise_for_status is True:
+                        # Releases the connection and raises ClientResponseError
+                        response.raise_for_status()
+                    elif raise_for_status:
+                        await raise_for_status(response)
+                    return response
+                wait = policy.delay(attempt, response.headers.get("Retry-After"))
+                log.warning(f"{method} {url} returned {response.status}, retrying in {wait:.1f}s")
+                response.release()
+            finally:
+                if opener:
+                    await asyncio.to_thread(kwargs["data"].close)
+            await asyncio.sleep(wait)
+            attempt += 1
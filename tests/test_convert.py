@@ -86,6 +86,21 @@ def test_multiple_value():
     assert hits == 1
 
 
+def test_compiled_tables():
+    """Test the precomputed conversions match the config, and aren't shared."""
+    entry = csv.convertEntry("cemetery_services", "cemetery")
+    assert entry == [{"amenity": "grave_yard"}]
+    entry[0]["amenity"] = "changed"
+    assert csv.convertEntry("cemetery_services", "cemetery") == [{"amenity": "grave_yard"}]
+
+    assert csv.convertValue("amenity", "coffee") == [{"amenity": "cafe"}, {"cuisine": "coffee_shop"}]
+    assert csv.convertValue("amenity", "bank") == [{"amenity": "bank"}]
+    assert csv.convertEntry("altitude", "123.4567891") == [{"ele": "123.456"}]
+    assert csv.convertEntry("Foo", "bar") == {"Foo": "bar"}
+    assert csv.convertEntry("deviceid", "1234") is None
+    assert csv.ignoreData("DEVICEID")
+
+
 # Run standalone for easier debugging when not under pytest
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Read and convert a JSON file from ODK Central")
@@ -107,3 +122,4 @@ if __name__ == "__main__":
     test_single_value()
     test_sub_value()
     test_multiple_value()
+    test_compiled_tables()
@@ -19,10 +19,18 @@
 #
 
 import argparse
+import json
 import os
+from io import BytesIO
+from pathlib import Path
+from zipfile import ZipFile
 
-from osm_fieldwork.parsers import ODKParsers
-from osm_fieldwork.support import OutSupport
+import pytest
+
+from osm_fieldwork.odk2osm import findInstances, parseInstances
+from osm_fieldwork.OdkCentral import SubmissionArchive
+from osm_fieldwork.parsers import ODKParsers, flatten, iterJSONRows
+from osm_fieldwork.support import FieldPlan, OutSupport, basename
 
 # find the path of root tests dir
 rootdir = os.path.dirname(os.path.abspath(__file__))
@@ -36,6 +44,153 @@ def test_csv():
     assert len(data) > 0
 
 
+def test_iter_csv():
+    """Convert the CSV file one row at a time."""
+    csv = ODKParsers()
+    rows = csv.iterCSV(f"{rootdir}/testdata/test.csv")
+    first = next(rows)
+    assert first == csv.CSVparser(f"{rootdir}/testdata/test.csv")[0]
+    rows.close()
+
+    entries = list(csv.createEntries(csv.iterCSV(f"{rootdir}/testdata/test.csv")))
+    assert entries == [csv.createEntry(row) for row in csv.CSVparser(f"{rootdir}/testdata/test.csv")]
+
+
+def test_csv_frames():
+    """Convert the CSV file a column at a time."""
+    csv = ODKParsers()
+    rows = [row for frame in csv.iterCSVFrames(f"{rootdir}/testdata/test.csv") for row in csv.iterFrameRows(frame)]
+    assert rows == csv.CSVparser(f"{rootdir}/testdata/test.csv")
+
+    # The choices of a select_multiple question become tags
+    csv.types["amenities"] = "select_multiple"
+    data = "amenities,amenity\nfire_pit picnic_table Parking,cafe\nopenfire fire_pit,\n,\n"
+    frame = next(csv.iterCSVFrames(None, data))
+    assert list(csv.iterFrameRows(frame)) == list(csv.iterCSV(None, data.splitlines()))
+    assert list(csv.iterFrameRows(frame)) == [
+        {"leisure": "firepit;picnic_table", "parking": "yes", "amenity": "cafe"},
+        {"leisure": "firepit;firepit"},
+        {},
+    ]
+
+
+def test_field_plan():
+    """Resolve the CSV header once for the whole file."""
+    assert basename("buildings-building_material") == "building_material"
+    assert basename("orx:meta:instanceID") == "instanceID"
+    assert basename("latitude") == "latitude"
+
+    csv = ODKParsers()
+    csv.types["amenities"] = "select_multiple"
+    fields = FieldPlan(csv, lower=True)
+    plan = fields.plan(["deviceid", "gps-Latitude", "more-Amenities", "more-name", "buildings-amenity", "KEY"])
+    assert plan == [
+        ("gps-Latitude", "latitude", FieldPlan.CONVERT),
+        ("more-Amenities", "amenities", FieldPlan.MULTIPLE),
+        ("more-name", "name", FieldPlan.PASS),
+        ("buildings-amenity", "amenity", FieldPlan.CONVERT),
+    ]
+    assert fields.resolve("KEY") == ("key", FieldPlan.IGNORE)
+
+
+def test_iter_json(tmp_path):
+    """Read the JSON rows incrementally, from either format."""
+    with open(f"{rootdir}/testdata/testcamps.json") as infile:
+        rows = json.load(infile)["value"]
+    # A small chunk size splits the rows across chunks
+    with open(f"{rootdir}/testdata/testcamps.json") as infile:
+        assert list(iterJSONRows(infile, chunk_size=100)) == rows
+
+    ndjson = tmp_path / "testcamps.ndjson"
+    ndjson.write_text("".join(f"{json.dumps(row)}\n" for row in rows))
+    csv = ODKParsers()
+    data = list(csv.iterJSON(str(ndjson)))
+    assert len(data) == len(rows)
+    assert data == csv.JSONparser(f"{rootdir}/testdata/testcamps.json")
+
+    assert list(flatten({"a": 1, "group": {"b": 2, "empty": {}, "c:d": 3}})) == [("a", 1), ("b", 2), ("empty", {}), ("d", 3)]
+
+
+def test_xml_instances(tmp_path):
+    """Find and convert the XML instance files copied off a phone."""
+    for index in range(3):
+        instance = tmp_path / f"buildings_{index}"
+        instance.mkdir()
+        (instance / "1.jpg").write_bytes(b"photo")
+        (instance / f"buildings_{index}.xml").write_text(
+            f"""<data id="buildings" xmlns:orx="http://openrosa.org/xforms">
+            <username>user{index}</username>
+            <location>38.36974{index} -106.30788 2825.9 4.5</location>
+            <group><altitude>2825.99812</altitude></group>
+            <orx:meta><orx:instanceID>uuid:{index}</orx:instanceID></orx:meta>
+            </data>"""
+        )
+    (tmp_path / "other").mkdir()
+
+    xmlfiles = findInstances(f"{tmp_path}/buildings*")
+    assert [Path(xmlfile).name for xmlfile in xmlfiles] == ["buildings_0.xml", "buildings_1.xml", "buildings_2.xml"]
+
+    csv = ODKParsers()
+    row = csv.XMLparser(None, data=Path(xmlfiles[1]).read_text())
+    assert row == [{"lat": "38.369741", "lon": "-106.30788"}]
+
+    entries = list(parseInstances(xmlfiles, processes=1))
+    assert [entry["attrs"]["lat"] for entry in entries] == ["38.369740", "38.369741", "38.369742"]
+
+
+def test_csv_archive():
+    """Parse the CSV file from a submissions.csv.zip export."""
+    spool = BytesIO()
+    with ZipFile(spool, "w") as archive:
+        archive.write(f"{rootdir}/testdata/test.csv", "test.csv")
+        archive.writestr("media/1.jpg", b"photo")
+    spool.seek(0)
+
+    csv = ODKParsers()
+    with SubmissionArchive(spool, "test") as export:
+        assert export.csvFiles() == ["test.csv"]
+        data = csv.CSVparser(None, data=export.openCsv())
+        media = [(filename, photo.read()) for filename, photo in export.media()]
+    assert data == csv.CSVparser(f"{rootdir}/testdata/test.csv")
+    assert media == [("1.jpg", b"photo")]
+
+
+def test_geojson_output(tmp_path):
+    """Write the GeoJSON features as they are converted."""
+    csv = ODKParsers()
+    entries = list(csv.createEntries(csv.iterCSV(f"{rootdir}/testdata/test.csv")))
+    out = OutSupport()
+    out.WriteData(str(tmp_path / "test"), entries)
+    with open(tmp_path / "test.geojson") as infile:
+        collection = json.load(infile)
+    assert len(collection["features"]) == len(entries)
+    assert collection["features"][0]["geometry"] == {"type": "Point", "coordinates": [-106.416623, 38.406495]}
+    assert collection["features"][0]["properties"] == entries[0]["tags"]
+
+    out = OutSupport()
+    out.WriteData(str(tmp_path / "test"), entries, geojson="geojsonseq")
+    records = (tmp_path / "test.geojsons").read_text().split("\x1e")[1:]
+    assert [json.loads(record) for record in records] == collection["features"]
+
+
+def test_pbf_geoparquet_output(tmp_path):
+    """Write OSM PBF instead of OSM XML, and GeoParquet."""
+    csv = ODKParsers()
+    entries = list(csv.createEntries(csv.iterCSV(f"{rootdir}/testdata/test.csv")))
+    out = OutSupport()
+    out.WriteData(str(tmp_path / "test"), entries, osm="pbf")
+    assert (tmp_path / "test.osm.pbf").read_bytes()[4:15] == b"\n\tOSMHeader"
+    assert not (tmp_path / "test.osm").exists()
+
+    parquet = pytest.importorskip("pyarrow.parquet")
+    out = OutSupport()
+    out.WriteData(str(tmp_path / "test"), entries, geoparquet=True)
+    table = parquet.read_table(tmp_path / "test.parquet")
+    assert table.num_rows == len(entries)
+    assert json.loads(table.schema.metadata[b"geo"])["primary_column"] == "geometry"
+    assert dict(table.column("properties")[0].as_py()) == entries[0]["tags"]
+
+
 def test_init():
     """Make sure the YAML file got loaded."""
     csv = ODKParsers()
@@ -68,4 +223,5 @@ if __name__ == "__main__":
 
     test_init()
     test_csv()
+    test_iter_csv()
     test_osm_entry(infile=args.infile)
@@ -23,6 +23,8 @@ from uuid import uuid4
 import pytest
 from aiohttp.client_exceptions import ClientError
 
+from osm_fieldwork.OdkCentralAsync import EntityCache
+
 
 async def test_entity_modify(odk_dataset_cleanup):
     """Test modifying an entity."""
@@ -105,6 +107,52 @@ async def test_bulk_create_entity_count(odk_dataset_cleanup):
     assert entity_count >= 4
 
 
+async def test_bulk_create_entity_chunks(odk_dataset_cleanup):
+    """Test bulk creation of Entities split into multiple requests."""
+    odk_id, dataset_name, entity_uuid, dataset = odk_dataset_cleanup
+    async with dataset:
+        result = await dataset.createEntities(
+            odk_id,
+            dataset_name,
+            [{"label": f"chunked entity {index}", "data": {"osm_id": str(index), "geometry": "test"}} for index in range(5)],
+            chunk_size=2,
+        )
+    assert result == {"success": True, "created": 5, "failed": []}
+
+    async with dataset:
+        result = await dataset.createEntities(
+            odk_id,
+            dataset_name,
+            [{"label": "invalid entity", "data": {"osm_id": 77, "geometry": "test"}}],
+            raise_on_error=False,
+        )
+    assert not result["success"]
+    assert result["failed"][0]["start"] == 0 and result["failed"][0]["end"] == 1
+
+
+async def test_bulk_update_delete_entities(odk_dataset_cleanup):
+    """Test bulk update of Entities, including a stale baseVersion, then delete."""
+    odk_id, dataset_name, entity_uuid, dataset = odk_dataset_cleanup
+    async with dataset:
+        await dataset.createEntities(
+            odk_id,
+            dataset_name,
+            [{"label": f"bulk update entity {index}", "data": {"geometry": "test"}} for index in range(3)],
+        )
+        entities = await dataset.getEntityData(odk_id, dataset_name, url_params="$filter=startswith(label, 'bulk update')")
+        entity_uuids = [entity["__id"] for entity in entities]
+
+        # NOTE baseVersion 0 never matches, so the conflict must be resolved
+        updates = [{"uuid": uuid, "data": {"status": "RESET"}, "baseVersion": 0} for uuid in entity_uuids]
+        results = await dataset.updateEntities(odk_id, dataset_name, updates)
+        assert [result["uuid"] for result in results] == entity_uuids
+        assert all(result["success"] for result in results)
+        assert all(result["entity"]["currentVersion"]["data"]["status"] == "RESET" for result in results)
+
+        results = await dataset.deleteEntities(odk_id, dataset_name, entity_uuids)
+        assert all(result["success"] for result in results)
+
+
 async def test_get_entity_data(odk_dataset_cleanup):
     """Test getting entity data, inluding via a OData filter."""
     odk_id, dataset_name, entity_uuid, dataset = odk_dataset_cleanup
@@ -187,3 +235,43 @@ async def test_get_single_entity(odk_dataset_cleanup):
     # if ran in parallel, this is updated by test_entity_modify!
     assert (label := entity_info.get("label")) == "test entity" or label == "new label"
     assert entity_info.get("data", {}).get("osm_id") == "1"
+
+
+async def test_iter_entity_data(odk_dataset_cleanup):
+    """Test paginating entity data, with only selected properties."""
+    odk_id, dataset_name, entity_uuid, dataset = odk_dataset_cleanup
+    async with dataset:
+        entity_count = await dataset.getEntityCount(odk_id, dataset_name)
+        entities = [
+            entity async for entity in dataset.iterEntityData(odk_id, dataset_name, select=["__id", "geometry"], page_size=2)
+        ]
+
+    assert len(entities) == entity_count
+    assert len({entity["__id"] for entity in entities}) == entity_count
+    assert all(sorted(entity.keys()) == ["__id", "geometry"] for entity in entities)
+
+
+async def test_sync_entities(odk_dataset_cleanup):
+    """Test syncing only the Entities changed since the last poll."""
+    odk_id, dataset_name, entity_uuid, dataset = odk_dataset_cleanup
+    cache = EntityCache()
+    async with dataset:
+        changes = await dataset.syncEntities(odk_id, dataset_name, cache)
+        assert entity_uuid in changes["updated"]
+        assert len(cache) == await dataset.getEntityCount(odk_id, dataset_name)
+
+        await dataset.updateEntity(odk_id, dataset_name, entity_uuid, data={"status": "SYNCED"})
+        changes = await dataset.syncEntities(odk_id, dataset_name, cache)
+        assert changes["updated"] == [entity_uuid]
+        assert cache.get(entity_uuid)["status"] == "SYNCED"
+
+        extra_uuid = (await dataset.createEntity(odk_id, dataset_name, "sync entity", {"osm_id": "2", "geometry": "test"}))["uuid"]
+        await dataset.syncEntities(odk_id, dataset_name, cache)
+        await dataset.deleteEntity(odk_id, dataset_name, extra_uuid)
+        deleted = (await dataset.syncEntities(odk_id, dataset_name, cache))["deleted"]
+        # Only deletions since the last sync are requested
+        unchanged = await dataset.syncEntities(odk_id, dataset_name, cache)
+
+    assert deleted == [extra_uuid]
+    assert extra_uuid not in cache
+    assert unchanged["deleted"] == []
@@ -0,0 +1,83 @@
+# Copyright (c) Humanitarian OpenStreetMap Team
+#
+# This file is part of osm_fieldwork.
+#
+#     osm-fieldwork is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     osm-fieldwork is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with osm_fieldwork.  If not, see <https:#www.gnu.org/licenses/>.
+#
+"""Test the OData query builder."""
+
+from datetime import date, datetime, timezone
+
+import pytest
+
+from osm_fieldwork.odata import ODataQuery, literal
+from osm_fieldwork.OdkCentralAsync import pageParams
+
+
+def test_literal():
+    """Test Python values are formatted as OData literals."""
+    assert literal("O'Brien") == "'O''Brien'"
+    assert literal(None) == "null"
+    assert literal(True) == "true"
+    assert literal(5) == "5"
+    assert literal(date(2024, 11, 15)) == "2024-11-15"
+    assert literal(datetime(2024, 11, 15, 12, 28, 23, 641000)) == "2024-11-15T12:28:23.641Z"
+    assert literal(datetime(2024, 11, 15, 14, tzinfo=timezone.utc).astimezone()) == "2024-11-15T14:00:00.000Z"
+
+
+def test_submission_query():
+    """Test a query for today's reviewed submissions."""
+    query = (
+        ODataQuery()
+        .submittedOn(date(2024, 11, 15))
+        .reviewState("approved", "received")
+        .submitterId(7)
+        .select("__id", "task_id")
+        .orderBy("__system/submissionDate", descending=True)
+        .top(100)
+        .count()
+    )
+    assert query.params() == {
+        "$filter": (
+            "(__system/submissionDate ge 2024-11-15T00:00:00.000Z)"
+            " and (__system/submissionDate lt 2024-11-16T00:00:00.000Z)"
+            " and (__system/reviewState eq 'approved' or __system/reviewState eq null)"
+            " and (__system/submitterId eq 7)"
+        ),
+        "$select": "__id,task_id",
+        "$orderby": "__system/submissionDate desc",
+        "$top": "100",
+        "$count": "true",
+    }
+    assert str(ODataQuery().where("status", "eq", "2").top(10)) == "$filter=status%20eq%20'2'&$top=10"
+    assert ODataQuery().params() == {}
+    assert ODataQuery().anyOf("status", [1, 2]).params() == {"$filter": "status eq 1 or status eq 2"}
+
+    with pytest.raises(ValueError):
+        ODataQuery().reviewState("done")
+    with pytest.raises(ValueError):
+        ODataQuery().where("status", "like", "2")
+
+
+def test_or_filter():
+    """Test a raw 'or' filter isn't changed by another clause."""
+    query = ODataQuery().filter("a eq 1 or b eq 2").reviewState("approved")
+    assert query.params() == {"$filter": "(a eq 1 or b eq 2) and (__system/reviewState eq 'approved')"}
+
+
+def test_page_params():
+    """Test $top limits the rows, separately from the page size."""
+    assert pageParams(None, 1000) == ({"$top": "1000"}, None)
+    assert pageParams(ODataQuery().top(50).params(), 20) == ({"$top": "20"}, 50)
+    assert pageParams({"$top": "5", "$skip": "10"}, 1000) == ({"$top": "5", "$skip": "10"}, 5)
@@ -17,15 +17,20 @@
 #
 """Test functionalty of OdkCentral.py and OdkCentralAsync.py."""
 
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
 from pathlib import Path
+from zipfile import ZipFile
 
 import pytest
 import requests
 import segno
 
 from osm_fieldwork.OdkCentral import OdkCentral
+from osm_fieldwork.OdkCentralAsync import OdkAppUser as OdkAppUserAsync
 from osm_fieldwork.OdkCentralAsync import OdkCentral as OdkCentralAsync
+from osm_fieldwork.OdkCentralAsync import OdkCentralSession, OdkDataset, OdkProject
+from osm_fieldwork.OdkCentralAsync import OdkForm as OdkFormAsync
 
 testdata_dir = Path(__file__).parent / "testdata"
 
@@ -80,6 +85,25 @@ def test_create_qrcode(appuser, appuser_details):
     assert qrcode_file.exists()
 
 
+async def test_bulk_create_appusers_qrcodes(project_details, odk_form_cleanup, tmp_path):
+    """Create app-users in parallel, assign a form, then render all QR codes."""
+    odk_id, form_name, xform = odk_form_cleanup
+    xform.publishForm(odk_id, form_name)
+    users = [{"name": f"test_bulk_appuser_{index}", "forms": [form_name]} for index in range(3)]
+
+    async with OdkAppUserAsync("https://proxy", "test@hotosm.org", "Password1234") as odk_appuser:
+        results = await odk_appuser.createAppUsers(odk_id, users)
+        assert all(result["success"] for result in results)
+        assert [result["appuser"]["displayName"] for result in results] == [user["name"] for user in users]
+
+        appusers = [result["appuser"] for result in results]
+        outfile = await odk_appuser.createQRCodes(odk_id, "test project", appusers, tmp_path / "qrcodes.zip", processes=2)
+
+    with ZipFile(outfile) as archive:
+        assert archive.namelist() == [f"{user['name']}.png" for user in users]
+        assert archive.read(archive.namelist()[0]).startswith(b"\x89PNG")
+
+
 def test_create_form_delete(project, odk_form):
     """Create form and delete."""
     odk_id, xform = odk_form
@@ -222,6 +246,31 @@ def test_upload_media_bytesio_publish(project, odk_form):
     assert len(project.listForms(odk_id)) == 0
 
 
+async def test_create_form_upload_media_async(project, odk_form):
+    """Create a published form, then upload media in parallel, async code."""
+    odk_id, xform = odk_form
+    test_xform = testdata_dir / "buildings_geojson_upload.xml"
+
+    async with OdkFormAsync("https://proxy", "test@hotosm.org", "Password1234") as odk_form_async:
+        form_name = await odk_form_async.createForm(odk_id, test_xform, publish=True)
+        assert form_name == "test_form_geojson"
+        # The XForm is only used to check the media of the same form
+        assert odk_form_async.xform == form_name
+
+        uploaded = await odk_form_async.uploadMediaFiles(odk_id, form_name, [testdata_dir / "osm_buildings.geojson"])
+        assert uploaded == ["osm_buildings.geojson"]
+
+        with pytest.raises(ValueError):
+            await odk_form_async.uploadMedia(odk_id, form_name, b"{}", filename="not_in_form.geojson")
+
+    # The form was published again, with the new attachment
+    xform.draft = False
+    assert xform.listMedia(odk_id, form_name)[0]["exists"]
+
+    success = xform.deleteForm(odk_id, form_name)
+    assert success
+
+
 def test_form_fields_no_form(odk_form_cleanup):
     """Attempt usage of form_fields when form does not exist."""
     odk_id, form_name, xform = odk_form_cleanup
@@ -282,3 +331,47 @@ async def test_invalid_connection_async():
     with pytest.raises(ConnectionError, match="ODK credentials are invalid, or may have changed. Please update them."):
         async with OdkCentralAsync("https://proxy", "thisuser@notexist.org", "Password1234"):
             pass
+
+
+async def test_shared_session_async(project_details):
+    """Test reusing one authenticated session across many async clients."""
+    odk_id = project_details.get("id")
+    async with OdkCentralSession("https://proxy", "test@hotosm.org", "Password1234") as central:
+        token = central.session.headers["Authorization"]
+
+        async with OdkProject(session=central) as odk_project:
+            forms = await odk_project.listForms(odk_id)
+        async with OdkDataset(session=central) as odk_dataset:
+            datasets = await odk_dataset.listDatasets(odk_id)
+
+        # No new login, and the session is still open for the next request
+        assert central.session.headers["Authorization"] == token
+        assert not central.session.closed
+    assert isinstance(forms, list)
+    assert isinstance(datasets, list)
+
+    with pytest.raises(ConnectionError, match="ODK credentials are invalid, or may have changed. Please update them."):
+        async with OdkCentralSession("https://proxy", "thisuser@notexist.org", "Password1234"):
+            pass
+
+
+async def test_shared_session_refresh_failure(project_details):
+    """Test a failed token refresh keeps the shared session open."""
+    odk_id = project_details.get("id")
+    async with OdkCentralSession("https://proxy", "test@hotosm.org", "Password1234") as central:
+        token = central.session.headers["Authorization"]
+        refresher = central.refresher
+
+        # The token expires soon, and the refresh is rejected
+        central.expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+        central.passwd = "WrongPassword"
+        assert not await central.refreshToken()
+
+        # The current token and the background refresh are kept
+        assert central.session.headers["Authorization"] == token
+        assert not central.session.closed
+        assert central.refresher is refresher
+        assert not refresher.done()
+        async with OdkProject(session=central) as odk_project:
+            forms = await odk_project.listForms(odk_id)
+    assert isinstance(forms, list)
@@ -17,13 +17,17 @@
 #
 """Test functionalty of OdkCentralAsync.py, specifically the OdkForm class."""
 
+import json
+import sqlite3
 import uuid
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
 from pyodk.client import Client
 
+from osm_fieldwork.odata import ODataQuery
 from osm_fieldwork.OdkCentralAsync import OdkForm as OdkFormAsync
+from osm_fieldwork.OdkCentralAsync import OdkProject as OdkProjectAsync
 
 odk_config_file = str(Path(__file__).parent / ".pyodk_config.toml")
 testdata_dir = Path(__file__).parent / "testdata"
@@ -141,3 +145,106 @@ async def test_list_submission_attachment_urls(odk_submission):
     ) as form_async:
         attachment_urls = await form_async.getSubmissionAttachmentUrls(odk_id, form_name, submission_id)
         assert len(attachment_urls) == 3
+
+
+async def test_download_submission_attachments(odk_submission, tmp_path):
+    """Bulk download attachments, skipping those not uploaded yet."""
+    odk_id, form_name = odk_submission
+    photo_bytes = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x01\x00\x60\x00\x60\x00\x00\xff\xdb\x00C\x00"
+
+    async with OdkFormAsync(
+        url="https://proxy",
+        user="test@hotosm.org",
+        passwd="Password1234",
+    ) as form_async:
+        submissions = await form_async.listSubmissions(odk_id, form_name)
+        submission_ids = [submission["instanceId"] for submission in submissions]
+
+        # Upload one of the three photos the fixture submission references
+        url = f"{form_async.base}projects/{odk_id}/forms/{form_name}/submissions/{submission_ids[0]}/attachments/1.jpg"
+        async with form_async.session.post(url, data=photo_bytes, headers={"Content-Type": "image/jpeg"}, ssl=form_async.verify):
+            pass
+
+        result = await form_async.downloadSubmissionAttachments(odk_id, form_name, submission_ids, tmp_path)
+        photo = tmp_path / submission_ids[0] / "1.jpg"
+        assert result["downloaded"] == [str(photo)]
+        assert result["failed"] == {}
+        assert photo.read_bytes() == photo_bytes
+        assert not photo.with_name("1.jpg.part").exists()
+
+        # The manifest skips the files already downloaded
+        result = await form_async.downloadSubmissionAttachments(odk_id, form_name, submission_ids, tmp_path)
+        assert result["downloaded"] == []
+        assert result["skipped"] == [str(photo)]
+
+
+async def test_export_project_submissions(odk_submission, tmp_path):
+    """Export the submissions of every form, to each output format."""
+    odk_id, form_name = odk_submission
+
+    async with OdkProjectAsync(
+        url="https://proxy",
+        user="test@hotosm.org",
+        passwd="Password1234",
+    ) as project_async:
+        result = await project_async.exportSubmissions(odk_id, tmp_path / "submissions.ndjson", xforms=[form_name, "missing"])
+        assert result["exported"] == {form_name: 1}
+        assert list(result["failed"]) == ["missing"]
+
+        with open(tmp_path / "submissions.ndjson") as ndjson:
+            submission = json.loads(ndjson.readline())
+        assert submission["__xform"] == form_name
+        assert submission["status"] == "2"
+
+        await project_async.exportSubmissions(odk_id, tmp_path / "submissions.geojsons")
+        with open(tmp_path / "submissions.geojsons") as geojsonseq:
+            feature = json.loads(geojsonseq.readline().lstrip("\x1e"))
+        assert feature["geometry"]["type"] == "Point"
+
+        await project_async.exportSubmissions(odk_id, tmp_path / "submissions.db")
+        db = sqlite3.connect(tmp_path / "submissions.db")
+        assert db.execute("SELECT xform FROM submissions").fetchall() == [(form_name,)]
+        db.close()
+
+
+async def test_get_all_project_submissions(odk_submission):
+    """Get the list of submissions for many forms, skipping any that fail, and filter it."""
+    odk_id, form_name = odk_submission
+
+    async with OdkProjectAsync(
+        url="https://proxy",
+        user="test@hotosm.org",
+        passwd="Password1234",
+    ) as project_async:
+        submissions = await project_async.getAllProjectSubmissions(odk_id, [form_name, "missing"])
+        # The filters pick the rows, which keep the same fields
+        approved = await project_async.getAllProjectSubmissions(odk_id, [form_name], ODataQuery().reviewState("approved"))
+        received = await project_async.getAllProjectSubmissions(odk_id, [form_name], {"$filter": "__system/reviewState eq null"})
+
+    # The same rows as listSubmissions, not the OData submission data
+    assert len(submissions) == 1
+    assert "instanceId" in submissions[0]
+    assert "__id" not in submissions[0]
+    assert approved == []
+    assert received == submissions
+
+
+async def test_update_review_states(odk_submission):
+    """Approve submissions in bulk, updating the loaded submissions."""
+    odk_id, form_name = odk_submission
+
+    async with OdkFormAsync(
+        url="https://proxy",
+        user="test@hotosm.org",
+        passwd="Password1234",
+    ) as form_async:
+        submissions = [submission async for submission in form_async.iterSubmissions(odk_id, form_name)]
+        reviews = {submission["__id"]: "approved" for submission in submissions}
+        reviews["uuid:missing"] = "approved"
+
+        results = await form_async.updateReviewStates(odk_id, form_name, reviews, submissions=submissions)
+        assert [result["success"] for result in results] == [True] * len(submissions) + [False]
+        assert submissions[0]["__system"]["reviewState"] == "approved"
+
+        approved = ODataQuery().reviewState("approved")
+        assert await form_async.getSubmissionCount(odk_id, form_name, approved) == len(submissions)
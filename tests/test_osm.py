@@ -20,8 +20,11 @@
 
 import argparse
 import os
+import struct
+import zlib
 
-from osm_fieldwork.osmfile import OsmFile
+from osm_fieldwork.osmfile import OsmFile, xmlEscape
+from osm_fieldwork.osmpbf import OsmPbfFile, deltas, varint, zigzag
 
 # find the path of root tests dir
 rootdir = os.path.dirname(os.path.abspath(__file__))
@@ -102,6 +105,127 @@ def test_create_way():
     # print(tmp)
 
 
+def test_escape():
+    """Escape the XML special characters in the tags and attributes."""
+    assert xmlEscape('Joe\'s <Bar> & "Grill"\n') == "Joe&apos;s &lt;Bar&gt; &amp; &quot;Grill&quot;&#10;"
+    assert xmlEscape(12345) == "12345"
+
+    osm = OsmFile(f"{rootdir}/testdata/test-out.osm")
+    node = dict(attrs=dict(id=12345, lat=1, lon=2, user="O'Brien"), tags=dict(name="Fish & Chips", empty=""))
+    tmp = osm.createNode(node, now="2024-01-01T00:00:00Z")
+    assert tmp == (
+        "  <node id='12345' version='1' lat='1' lon='2' timestamp='2024-01-01T00:00:00Z' user='O&apos;Brien' >\n"
+        "    <tag k='name' v='Fish &amp; Chips'/>\n"
+        "  </node>\n"
+    )
+
+
+def test_write_features(tmp_path):
+    """Write a batch of nodes and ways with one timestamp."""
+    outfile = tmp_path / "batch.osm"
+    osm = OsmFile(str(outfile))
+    nodes = [dict(attrs=dict(lat=1, lon=2), tags=dict(amenity="cafe")) for _ in range(3)]
+    way = dict(attrs=dict(id=-10), refs=[-1, -2, -3], tags=dict(building="yes"))
+    assert osm.writeFeatures([*nodes, way]) == 4
+    osm.footer()
+
+    xml = outfile.read_text()
+    assert xml.count("<node id=") == 3
+    assert '<nd ref="-2"/>' in xml
+    assert len(set(line.split("timestamp=")[1][:22] for line in xml.splitlines() if "timestamp=" in line)) == 1
+    assert xml.endswith("  </way>\n\n</osm>\n")
+
+    data = OsmFile().loadFile(str(outfile))
+    assert data[("way", -10)]["refs"] == [-1, -2, -3]
+    assert data[("way", -10)]["tags"] == {"building": "yes"}
+
+
+def test_load_file(infile=f"{rootdir}/testdata/odk_pois.osm"):
+    """Load an OSM XML file, indexed by type and ID."""
+    osm = OsmFile()
+    data = osm.loadFile(infile)
+    assert len(data) == 14
+    node = osm.getFeature("node", -25370)
+    assert node["attrs"] == {"id": -25370, "lat": "38.536522", "lon": "-105.99221", "timestamp": "2023-07-11T18:25:41Z"}
+    assert node["tags"]["cuisine"] == "mexican"
+    assert osm.getFeature("node", 1) is None
+    assert osm.getFeature("way", -25370) is None
+    assert osm.getFields()[:3] == ["name", "note", "cuisine"]
+    assert len([item for item in data.values() if "refs" in item]) == 6
+
+
+def test_load_file_shared_id(tmp_path):
+    """A node and a way with the same ID are both kept."""
+    outfile = tmp_path / "shared.osm"
+    osm = OsmFile(str(outfile))
+    node = dict(attrs=dict(id=-1, lat=1, lon=2), tags=dict(amenity="cafe"))
+    way = dict(attrs=dict(id=-1), refs=[-1, -1], tags=dict(building="yes"))
+    assert osm.writeFeatures([node, way]) == 2
+    osm.footer()
+
+    osm = OsmFile()
+    data = osm.loadFile(str(outfile))
+    assert len(data) == 2
+    assert osm.getFeature("node", -1)["tags"] == {"amenity": "cafe"}
+    assert osm.getFeature("way", -1)["refs"] == [-1, -1]
+
+
+def readFields(data: bytes) -> dict:
+    """Decode a protobuf message, which only has varint and length delimited fields."""
+    fields = dict()
+    offset = 0
+    while offset < len(data):
+        values = list()
+        for _ in range(2):
+            value = shift = 0
+            while True:
+                byte = data[offset]
+                offset += 1
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            values.append(value)
+        key = values[0]
+        if key & 7 == 2:
+            fields[key >> 3] = data[offset : offset + values[1]]
+            offset += values[1]
+        else:
+            fields[key >> 3] = values[1]
+    return fields
+
+
+def test_pbf(tmp_path):
+    """Write the nodes and ways as OSM PBF blocks."""
+    assert varint(1) == b"\x01"
+    assert varint(300) == b"\xac\x02"
+    assert varint(-1) == b"\xff" * 9 + b"\x01"
+    assert [zigzag(value) for value in (0, -1, 1, -2)] == [0, 1, 2, 3]
+    assert deltas([-1, -2, -3, -1]) == [1, 1, 1, 4]
+
+    outfile = tmp_path / "test.osm.pbf"
+    osm = OsmPbfFile(str(outfile))
+    nodes = [dict(attrs=dict(id=-1 - index, lat="38.5", lon="-106.1", user="bar"), tags=dict(amenity="cafe")) for index in range(3)]
+    way = dict(attrs=dict(id=-10), refs=[-1, -2, -3], tags=dict(building="yes"))
+    assert osm.writeFeatures([*nodes, way]) == 4
+    osm.footer()
+
+    # Each block is a BlobHeader, then a Blob with the zlib compressed data
+    data = outfile.read_bytes()
+    blocks = list()
+    while data:
+        size = struct.unpack(">I", data[:4])[0]
+        header = readFields(data[4 : 4 + size])
+        blob = readFields(data[4 + size : 4 + size + header[3]])
+        assert len(zlib.decompress(blob[3])) == blob[2]
+        blocks.append((header[1], zlib.decompress(blob[3])))
+        data = data[4 + size + header[3] :]
+    assert [kind for kind, _ in blocks] == [b"OSMHeader", b"OSMData"]
+    assert b"DenseNodes" in blocks[0][1]
+    for string in (b"bar", b"amenity", b"cafe", b"building", b"yes"):
+        assert string in blocks[1][1]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Read and parse a CSV file from ODK Central")
     parser.add_argument("--infile", default=f"{rootdir}/testdata/odk_pois.osm", help="The CSV input file")
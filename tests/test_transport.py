@@ -0,0 +1,218 @@
+# Copyright (c) Humanitarian OpenStreetMap Team
+#
+# This file is part of osm_fieldwork.
+#
+#     osm-fieldwork is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     osm-fieldwork is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with osm_fieldwork.  If not, see <https:#www.gnu.org/licenses/>.
+#
+"""Test the retry policy, circuit breaker, metrics and cache used by the Central clients."""
+
+import asyncio
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+
+import aiohttp
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from osm_fieldwork.transport import (
+    CircuitBreaker,
+    CircuitOpenError,
+    DiskCache,
+    MemoryCache,
+    RequestMetrics,
+    ResponseCache,
+    RetryAdapter,
+    RetryPolicy,
+    RetrySession,
+    endpointName,
+    getCircuitBreaker,
+)
+
+
+def test_retry_policy():
+    """Test which requests are retried, and for how long."""
+    policy = RetryPolicy(backoff_factor=1, backoff_max=4)
+
+    # Only idempotent requests are retried after reaching the server
+    assert policy.shouldRetry("GET", 502)
+    assert not policy.shouldRetry("POST", 502)
+    assert policy.shouldRetry("POST", 502, idempotent=True)
+    # Unless the server refused to process the request
+    assert policy.shouldRetry("POST", 429)
+    assert policy.shouldRetry("PATCH", 503)
+    assert not policy.shouldRetry("GET", 404)
+
+    assert 0 <= policy.delay(0) <= 1
+    assert 0 <= policy.delay(10) <= 4
+    assert policy.delay(0, "7") == 7
+    assert policy.delay(0, "Wed, 21 Oct 2015 07:28:00 GMT") <= 1
+    assert RetryPolicy(retry_after_max=10).delay(0, "3600") == 10
+
+    assert policy.timeoutFor("https://central/v1/projects/1/forms/test/submissions.csv.zip") == 600
+    assert policy.timeoutFor("https://central/v1/projects/1/forms/test.svc/Submissions") == 180
+    assert policy.timeoutFor("https://central/v1/projects/1/forms") == policy.timeout
+    # Creating a form or Entities in bulk can take a while on the server
+    assert policy.timeoutFor("https://central/v1/projects/1/forms", "post") == 300
+    assert policy.timeoutFor("https://central/v1/projects/1/forms/test/draft", "POST") == 300
+    assert policy.timeoutFor("https://central/v1/projects/1/datasets/features/entities", "POST") == 300
+    assert policy.timeoutFor("https://central/v1/projects/1/datasets/features/entities") == policy.timeout
+
+
+def test_retry_file_upload(tmp_path: Path):
+    """Test a file is opened again for each attempt, so can be retried."""
+    media = tmp_path / "features.geojson"
+    media.write_bytes(b"{}")
+    files = []
+    statuses = [503, 200]
+
+    class Response(object):
+        """Just enough of an aiohttp.ClientResponse."""
+
+        def __init__(self, status: int):
+            self.status = status
+            self.headers = {}
+
+        def release(self):
+            pass
+
+    class Session(object):
+        """Just enough of an aiohttp.ClientSession."""
+
+        _raise_for_status = False
+
+        async def request(self, method: str, url: str, raise_for_status: bool, data, **kwargs):
+            files.append(data)
+            assert data.read() == b"{}"
+            return Response(statuses.pop(0))
+
+    async def upload():
+        session = RetrySession(Session(), RetryPolicy(backoff_factor=0))
+        return await session.send("POST", "https://central/v1/upload", idempotent=True, data=partial(media.open, "rb"))
+
+    assert asyncio.run(upload()).status == 200
+    assert len(files) == 2
+    assert all(sent.closed for sent in files)
+
+
+def test_circuit_breaker():
+    """Test the circuit opens after repeated failures, then recovers."""
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0)
+    url = "https://central/v1/projects"
+
+    for _ in range(3):
+        breaker.before(url)
+        breaker.failure()
+    # With no cool down, a trial request is allowed straight away
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.before(url)
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.reset_timeout = 60
+    for _ in range(3):
+        breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before(url)
+
+    # The existing error handling of both clients catches it
+    assert issubclass(CircuitOpenError, requests.exceptions.ConnectionError)
+    assert issubclass(CircuitOpenError, aiohttp.ClientConnectionError)
+
+
+def test_circuit_breaker_endpoints(monkeypatch):
+    """Test a request counts as one failure, only for its endpoint."""
+
+    def send(adapter, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 502
+        response.raw = BytesIO()
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, "send", send)
+    session = requests.Session()
+    session.mount("https://", RetryAdapter(RetryPolicy(retries=2, backoff_factor=0)))
+    response = session.get("https://breaker-test/v1/projects/1/forms/buildings/submissions.csv.zip")
+    assert response.status_code == 502
+    assert response.retries == 2
+
+    assert getCircuitBreaker("https://breaker-test/v1/projects/2/forms/other/submissions.csv.zip").failures == 1
+    assert getCircuitBreaker("https://breaker-test/v1/projects/1/forms").failures == 0
+    assert getCircuitBreaker("https://breaker-test/v1/sessions").failures == 0
+
+
+def test_request_metrics():
+    """Test requests are grouped by endpoint, and exported."""
+    assert endpointName("https://central/v1/projects/12/forms/buildings/submissions.csv.zip?attachments=true") == (
+        "/v1/projects/{id}/forms/{id}/submissions.csv.zip"
+    )
+    assert endpointName("https://central/v1/projects/1/forms/buildings.svc/Submissions('uuid:1234')") == (
+        "/v1/projects/{id}/forms/{id}.svc/Submissions({id})"
+    )
+
+    events = []
+    metrics = RequestMetrics(callbacks=[events.append], buckets=(0.1, 1))
+    metrics.record("GET", "https://central/v1/projects/1/forms", status=200, elapsed=0.05, received=100)
+    metrics.record("GET", "https://central/v1/projects/2/forms", status=502, elapsed=2, retries=3)
+    metrics.record("POST", "https://central/v1/sessions", elapsed=0.5, sent=50, error=ConnectionError("refused"))
+
+    assert len(events) == 3
+    assert events[0]["endpoint"] == "/v1/projects/{id}/forms"
+    forms, sessions = metrics.summary()
+    assert forms["count"] == 2
+    assert forms["errors"] == 1
+    assert forms["retries"] == 3
+    assert forms["received"] == 100
+    assert forms["statuses"] == {"200": 1, "502": 1}
+    assert sessions["statuses"] == {"error": 1}
+
+    text = metrics.prometheus()
+    assert 'odk_central_requests_total{method="GET",endpoint="/v1/projects/{id}/forms",status="502"} 1' in text
+    assert 'odk_central_request_duration_seconds_bucket{method="GET",endpoint="/v1/projects/{id}/forms",le="1"} 1' in text
+    assert 'odk_central_request_duration_seconds_bucket{method="GET",endpoint="/v1/projects/{id}/forms",le="+Inf"} 2' in text
+    assert 'odk_central_request_bytes_total{method="POST",endpoint="/v1/sessions"} 50' in text
+
+
+@pytest.mark.parametrize("backend", ["memory", "disk"])
+def test_response_cache(backend, tmp_path: Path):
+    """Test caching, revalidation and invalidation of form metadata."""
+    cache = ResponseCache(MemoryCache(maxsize=2) if backend == "memory" else DiskCache(str(tmp_path / "cache.db")))
+    base = "https://central/v1/projects/1"
+    headers = {"Content-Type": "application/json", "ETag": '"1"', "Content-Encoding": "gzip"}
+
+    # Only the metadata endpoints are cached
+    assert cache.lookup(f"{base}/forms/buildings/submissions", {}) == (None, None)
+    key, entry = cache.lookup(f"{base}/forms", {})
+    assert entry is None
+    cache.store(key, f"{base}/forms", 200, headers, b"[]")
+    key, entry = cache.lookup(f"{base}/forms", {})
+    assert entry["body"] == b"[]"
+    assert entry["etag"] == '"1"'
+    assert "Content-Encoding" not in entry["headers"]
+    assert cache.isFresh(entry)
+
+    # The extended metadata has the submission counts, so isn't cached
+    assert cache.lookup(f"{base}/forms", {"X-Extended-Metadata": "true"}) == (None, None)
+
+    # Expired entries are revalidated
+    entry["expires"] = 0
+    assert not cache.isFresh(entry)
+    assert cache.isFresh(cache.refresh(key, entry))
+
+    cache.store(f"{base}/forms/buildings.xml", f"{base}/forms/buildings.xml", 200, headers, b"<h:html/>")
+    cache.invalidateFor(f"{base}/forms/buildings/draft/publish")
+    assert cache.lookup(f"{base}/forms", {})[1] is None
+    assert cache.lookup(f"{base}/forms/buildings.xml", {})[1] is None